@@ -4,4 +4,7 @@ from devices import (device_template,
                      stage_ASI_MS2000,
                      deformable_mirror_Mirao52e,
                      hamamatsu_camera,
-                     lightsheet_generator)
+                     lightsheet_generator,
+                     orchestrator,
+                     trigger_sync,
+                     motion_coordinator)
@@ -9,6 +9,8 @@ import kekse
 import logging
 import sys
 import os
+import threading
+import time
 import numpy as np
 from functools import partial
 from PyQt5 import QtCore, QtWidgets
@@ -17,9 +19,80 @@ from PyQt5.QtCore import pyqtSignal
 config = {
     'simulation': True,
     'dll_path': "./drivers/mirao52_x64/mirao52e.dll",
-    'flat_file': './drivers/mirao52_x64/flat.mro'}
+    'flat_file': './drivers/mirao52_x64/flat.mro',
+    # command sequence block
+    'sequence_period_ms': 10.0,  # timer period of play()
+    'sequence_loop': False,  # restart from the first command after the last one
+    'sequence_trigger': False,  # step() preloads the command, the DM applies it on the next TTL of its trigger input
+    'spin_ms': 1.0,  # play() sleeps until this close to the next command time, then busy-waits
+    # safety block
+    'max_neighbor_diff': 0.6,  # max difference between adjacent actuators, None for no limit
+    'unsafe_commands': 'reject'}  # 'reject' or 'clip' commands out of limits
 logging.basicConfig()
 
+MAX_ACTUATOR_VALUE = 1.0  # Mirao52e specs, see MRO_INVALID_COMMAND_ERROR
+MAX_TOTAL_STROKE = 25.0  # sum of absolute actuator values
+ACTUATOR_ROWS = (4, 6, 8, 8, 8, 8, 6, 4)  # actuators per row of the 8 x 8 grid without corners, numbered row by row
+
+
+def actuator_layout(rows=ACTUATOR_ROWS):
+    """Grid (row, column) of each actuator: rows are centered on the 8-column grid.
+    Returns int array (n_actuators, 2)."""
+    n_columns = max(rows)
+    return np.array([(i, (n_columns - n) // 2 + j) for i, n in enumerate(rows) for j in range(n)])
+
+
+def neighbor_pairs(rows=ACTUATOR_ROWS):
+    """Pairs of adjacent actuators (horizontal and vertical neighbors on the grid), int array (n_pairs, 2)."""
+    layout = actuator_layout(rows)
+    index = {tuple(rc): i for i, rc in enumerate(layout)}
+    pairs = [(i, index[(r + dr, c + dc)]) for i, (r, c) in enumerate(layout)
+             for dr, dc in ((0, 1), (1, 0)) if (r + dr, c + dc) in index]
+    return np.array(pairs)
+
+
+NEIGHBOR_PAIRS = neighbor_pairs()
+
+
+def stroke_usage(commands):
+    """Fraction of the total stroke budget (sum of absolute values <= 25) used by each command."""
+    return np.sum(np.abs(np.atleast_2d(commands)), axis=1) / MAX_TOTAL_STROKE
+
+
+def neighbor_diff(commands):
+    """Largest difference between adjacent actuators of each command, array (N,)."""
+    commands = np.atleast_2d(commands)
+    return np.max(np.abs(commands[:, NEIGHBOR_PAIRS[:, 0]] - commands[:, NEIGHBOR_PAIRS[:, 1]]), axis=1)
+
+
+def check_commands(commands, max_neighbor_diff=None):
+    """Check a batch of commands (N x 52 array) against the Mirao52e specs and the neighbor difference limit,
+    in one pass. Returns bool array (N,), True for valid commands."""
+    commands = np.atleast_2d(commands)
+    valid = (np.all(np.isfinite(commands), axis=1) &
+             np.all(np.abs(commands) <= MAX_ACTUATOR_VALUE, axis=1) &
+             (stroke_usage(commands) <= 1.0))
+    if max_neighbor_diff is not None:
+        valid &= neighbor_diff(commands) <= max_neighbor_diff
+    return valid
+
+
+def clip_commands(commands, max_neighbor_diff=None):
+    """Make a batch of commands safe: clip each actuator to +-1, then scale each command down
+    (keeping its shape) until the total stroke and the neighbor differences are within limits.
+    Non-finite values are set to 0. Returns new array (N x 52)."""
+    commands = np.clip(np.nan_to_num(np.atleast_2d(commands), nan=0.0, posinf=0.0, neginf=0.0),
+                       -MAX_ACTUATOR_VALUE, MAX_ACTUATOR_VALUE)
+    shrink = 1 - 1e-12  # scaled commands stay within the limits after rounding
+    usage = stroke_usage(commands)
+    scale = np.divide(shrink, usage, where=usage > 1.0, out=np.ones_like(usage))
+    if max_neighbor_diff is not None:
+        diff = neighbor_diff(commands)
+        too_steep = diff > max_neighbor_diff
+        scale = np.minimum(scale, np.divide(shrink * max_neighbor_diff, diff, where=too_steep,
+                                            out=np.ones_like(diff)))
+    return commands * scale[:, np.newaxis]
+
 
 class DmController(QtCore.QObject):
     """
@@ -40,7 +113,17 @@ class DmController(QtCore.QObject):
         self.diameter_mm = 15.0
         self.command = np.zeros(self.n_actuators)
         self._status = ctypes.c_int64()  # possibly c_int32() in some versions, Todo: test
-        self._trigger = ctypes.c_int64()
+        self._neighbor_limit = self.config['max_neighbor_diff'] or 0.6  # GUI value, kept while the limit is off
+        self._trigger = ctypes.c_int64()  # single commands are applied immediately
+        self._hw_trigger = ctypes.c_int64(1)  # sequence commands wait for the TTL, if config['sequence_trigger']
+        # command sequence
+        self.sequence = np.zeros((0, self.n_actuators))
+        self.sequence_index = 0
+        self.step_times = []  # time.perf_counter() of applied sequence commands
+        self._sequence_ptrs = []
+        self._sequence_lock = threading.Lock()
+        self._player_thread = None
+        self._player_stop = threading.Event()
         self.logger = logging.getLogger(logger_name)
         self.logger.setLevel(logging.DEBUG)
         # GUI setup
@@ -96,13 +179,32 @@ class DmController(QtCore.QObject):
         else:
             self.logger.error("DM is not initialized")
 
+    def safe_commands(self, commands):
+        """Check a batch of commands (N x 52) against the actuator limits, total stroke and neighbor differences.
+        If config['unsafe_commands'] is 'clip', unsafe commands are clipped and scaled down to the limits.
+        Returns (commands, valid): commands as (N x 52) float64 array, and bool array of commands safe to apply."""
+        commands = np.atleast_2d(np.asarray(commands, dtype=np.float64))
+        valid = check_commands(commands, self.config['max_neighbor_diff'])
+        if self.config['unsafe_commands'] == 'clip' and not np.all(valid):
+            self.logger.warning(f"Clipped {np.count_nonzero(~valid)} unsafe commands")
+            commands = commands.copy()
+            commands[~valid] = clip_commands(commands[~valid], self.config['max_neighbor_diff'])
+            valid = check_commands(commands, self.config['max_neighbor_diff'])
+        return commands, valid
+
+    @kekse.profiler.timed('DM.apply_cmd')
     def apply_cmd(self, command: np.ndarray):
-        """Apply command (numpy array)"""
+        """Apply command (numpy array), if it is safe, see safe_commands()"""
         if command.shape[0] != self.n_actuators:
             self.logger.error("Command dimensions are incorrect")
         elif self.dev_handle is None:
             self.logger.error("DM is not initialized")
         else:
+            commands, valid = self.safe_commands(command)
+            if not valid[0]:
+                self.logger.error("Command rejected: out of actuator, stroke or neighbor difference limits")
+                return
+            command = commands[0]
             try:
                 self.dev_handle.mro_applySmoothCommand(command.ctypes.data_as(ctypes.POINTER(ctypes.c_float)),
                                                        self._trigger, ctypes.byref(self._status))
@@ -112,6 +214,112 @@ class DmController(QtCore.QObject):
             if self.gui_on:
                 self.sig_update_gui.emit()
 
+    def load_sequence(self, commands):
+        """Preload a sequence of commands (N x 52 array), e.g. one aberration correction per z plane.
+        Commands are stored as one contiguous float64 array (the command type of the DLL), with the pointer
+        of each row prepared, and validated once. Step through them with step() (e.g. from the camera trigger
+        callback), or play() them on a timer.
+        Returns True if loaded, False if the shape is wrong or any command is out of specs."""
+        commands = np.ascontiguousarray(commands, dtype=np.float64)
+        if commands.ndim != 2 or commands.shape[1] != self.n_actuators:
+            self.logger.error(f"Sequence must be N x {self.n_actuators}, got {commands.shape}")
+            return False
+        commands, valid = self.safe_commands(commands)
+        if not np.all(valid):
+            self.logger.error(f"Sequence rejected, invalid commands: {np.flatnonzero(~valid).tolist()}")
+            return False
+        commands = np.ascontiguousarray(commands, dtype=np.float64)
+        self.logger.debug(f"Sequence uses up to {100 * stroke_usage(commands).max():.1f}% of the stroke budget")
+        self.stop_sequence()
+        with self._sequence_lock:
+            self.sequence = commands
+            self._sequence_ptrs = [row.ctypes.data_as(ctypes.POINTER(ctypes.c_double)) for row in self.sequence]
+            self.sequence_index = 0
+        self.logger.info(f"Sequence of {len(commands)} commands loaded")
+        return True
+
+    def step(self):
+        """Apply the next command of the sequence. Returns its index, or None if the sequence is finished.
+        With config['sequence_trigger'], the command is only preloaded and the DM applies it on the next TTL
+        at its trigger input: call step() once to arm the first command, then from each camera trigger callback
+        to preload the command of the next plane."""
+        with self._sequence_lock:
+            if self.sequence_index >= len(self.sequence):
+                if not self.config['sequence_loop'] or len(self.sequence) == 0:
+                    return None
+                self.sequence_index = 0
+            index = self.sequence_index
+            trigger = self._hw_trigger if self.config['sequence_trigger'] else self._trigger
+            if self.dev_handle is not None:
+                try:
+                    self.dev_handle.mro_applySmoothCommand(self._sequence_ptrs[index], trigger,
+                                                           ctypes.byref(self._status))
+                except:
+                    pass
+                if self._status.value != 0:
+                    self.update_log(self._status.value)
+            elif not self.config['simulation']:
+                self.logger.error("DM is not initialized")
+                return None
+            self.command = self.sequence[index]
+            self.sequence_index += 1
+        self.step_times.append(time.perf_counter())
+        return index
+
+    def play(self, period_ms=None, n_steps=None):
+        """Step through the sequence in a timer thread, one command every period_ms (config['sequence_period_ms']).
+        The thread sleeps until config['spin_ms'] before each command time, then busy-waits, for sub-ms precision.
+        Stops after n_steps, or at the end of the sequence (unless config['sequence_loop'])."""
+        if self.config['sequence_trigger']:
+            self.logger.error("play() is timer-driven, uncheck the HW trigger of the sequence")
+            return
+        self.stop_sequence()
+        if period_ms is None:
+            period_ms = self.config['sequence_period_ms']
+        self.step_times = []
+        self._player_stop.clear()
+        self._player_thread = threading.Thread(target=self._player_loop, args=(period_ms / 1000., n_steps),
+                                               name='DM sequence', daemon=True)
+        self._player_thread.start()
+
+    def _player_loop(self, period_s, n_steps):
+        spin_s = self.config['spin_ms'] / 1000.
+        t_next = time.perf_counter()
+        n_done = 0
+        while not self._player_stop.is_set() and (n_steps is None or n_done < n_steps):
+            if t_next - time.perf_counter() > spin_s:
+                self._player_stop.wait(t_next - time.perf_counter() - spin_s)
+            while time.perf_counter() < t_next:
+                pass
+            if self.step() is None:
+                break
+            n_done += 1
+            t_next += period_s
+        if self.gui_on:
+            self.sig_update_gui.emit()
+
+    def stop_sequence(self):
+        if self._player_thread is not None:
+            self._player_stop.set()
+            if threading.get_ident() != self._player_thread.ident:
+                self._player_thread.join()
+            self._player_thread = None
+
+    def rewind_sequence(self):
+        with self._sequence_lock:
+            self.sequence_index = 0
+
+    def read_sequence_file(self, filepath=''):
+        """Load a sequence of commands from .npy file (N x 52).
+        If self.gui_on, open a file dialog. Otherwise, take filepath from arguments."""
+        if self.gui_on:
+            filepath, _filter = QtWidgets.QFileDialog.getOpenFileName(self.gui, "Open .npy file", "./",
+                                                                      "Numpy files (*.npy)")
+        try:
+            self.load_sequence(np.load(filepath))
+        except Exception as e:
+            self.logger.error(f'Numpy file {filepath} failed to open: {e}')
+
     def read_npy_file(self, filepath=''):
         """Read command from .npy file and apply immediately.
         If self.gui_on, open a file dialog. Otherwise, take filepath from arguments.
@@ -152,6 +360,7 @@ class DmController(QtCore.QObject):
 
     def close(self):
         """Close deformable mirror session"""
+        self.stop_sequence()
         if self.dev_handle is None:
             self.logger.error(f'DM was not initialized, cannot close.')
         else:
@@ -214,6 +423,14 @@ class DmController(QtCore.QObject):
         errors[34] = 'MRO_FILE_IO_ENOMEM, Not enough memory. The operation requested cannot be performed because the process is out of memory.'
         errors[35] = 'MRO_FILE_IO_ENOSPC, No space left on device. A file cannot be written because the hard drive lacks of space.'
 
+    def _set_neighbor_limit(self, on):
+        self.update_config('max_neighbor_diff', self._neighbor_limit if on else None)
+
+    def _set_max_neighbor_diff(self, value):
+        self._neighbor_limit = value
+        if self.config['max_neighbor_diff'] is not None:
+            self.update_config('max_neighbor_diff', value)
+
     def update_config(self, key, value):
         if key in self.config.keys():
             self.config[key] = value
@@ -240,7 +457,39 @@ class DmController(QtCore.QObject):
         self.gui.add_button('Apply flat', groupbox_name, lambda: self.apply_flat())
         self.gui.add_button('Load from .npy file', groupbox_name, lambda: self.read_npy_file())
 
+        groupbox_name = 'Sequence'
+        self.gui.add_groupbox(title=groupbox_name, parent=tab_name)
+        self.gui.add_button('Load sequence .npy', groupbox_name, lambda: self.read_sequence_file())
+        self.gui.add_numeric_field('Period, ms', groupbox_name,
+                                   value=self.config['sequence_period_ms'],
+                                   vrange=[0.1, 1e4, 0.1],
+                                   func=partial(self.update_config, 'sequence_period_ms'))
+        self.gui.add_checkbox('Loop', groupbox_name,
+                              value=self.config['sequence_loop'],
+                              func=partial(self.update_config, 'sequence_loop'))
+        self.gui.add_checkbox('HW trigger', groupbox_name,
+                              value=self.config['sequence_trigger'],
+                              func=partial(self.update_config, 'sequence_trigger'))
+        self.gui.add_button('Play', groupbox_name, lambda: self.play())
+        self.gui.add_button('Step', groupbox_name, lambda: self.step())
+        self.gui.add_button('Stop', groupbox_name, lambda: self.stop_sequence())
+        self.gui.add_button('Rewind', groupbox_name, lambda: self.rewind_sequence())
+
         tab_name = 'Config'
+        groupbox_name = 'Safety'
+        self.gui.add_groupbox(title=groupbox_name, parent=tab_name)
+        self.gui.add_checkbox('Limit neighbor difference', groupbox_name,
+                              value=self.config['max_neighbor_diff'] is not None,
+                              func=self._set_neighbor_limit)
+        self.gui.add_numeric_field('Max neighbor difference', groupbox_name,
+                                   value=self._neighbor_limit,
+                                   vrange=[0.01, 2, 0.01],
+                                   func=self._set_max_neighbor_diff)
+        self.gui.add_combobox('Unsafe commands', groupbox_name,
+                              items=['reject', 'clip'],
+                              value=self.config['unsafe_commands'],
+                              func=partial(self.update_config, 'unsafe_commands'))
+
         groupbox_name = 'Required files'
         self.gui.add_groupbox(title=groupbox_name, parent=tab_name)
         self.gui.add_string_field('DLL path', groupbox_name, value=self.dll_path, enabled=False)
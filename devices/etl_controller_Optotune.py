@@ -1,6 +1,13 @@
 import serial
 import time
+import json
+import os
+import itertools
+import queue
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
 from ctypes import c_ushort
+import numpy as np
 import kekse
 import sys
 from PyQt5 import QtCore, QtWidgets
@@ -8,10 +15,185 @@ from PyQt5.QtCore import pyqtSignal
 import logging
 logging.basicConfig()
 
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.kekse')  # per-user cache directory
+
 config = {'port': "COM11",
           'baud': 115200,
           'timeout_s': 0.2,
-          'ini_current_mA': -30.0}
+          'ini_current_mA': -30.0,
+          'calibration_file': None,  # JSON file of z-current calibration, loaded on start if given
+          'calibration_lut_step_um': 0.05,
+          # current ramp block
+          'ramp_duration_ms': 100.0,  # duration of a current ramp (soft close, large focus jumps)
+          'ramp_step_ms': 2.0,  # interval between current set-points of a ramp
+          'ramp_shape': 'cosine',  # 'linear' or 'cosine' (smooth start and stop)
+          'ramp_threshold_mA': 20.0,  # current jumps larger than this are ramped, None to never ramp
+          # telemetry block
+          'telemetry_period_s': 1.0,
+          'telemetry_capacity': 86400,  # readings in the ring buffer, oldest are overwritten
+          'temp_limits_C': (10.0, 45.0),  # alert outside of these limits
+          'temp_drift_alert_C': 3.0,  # alert if temperature drifts more than this from the start of telemetry
+          # EEPROM block
+          'eeprom_size': 256,
+          'eeprom_cache_file': os.path.join(CACHE_DIR, 'etl_eeprom_cache.json'),  # EEPROM images by lens serial number, None for no cache
+          # identity block
+          'identity_cache_file': os.path.join(CACHE_DIR, 'etl_identity_cache.json'),  # lens identity by port, None for no cache
+          'identity_ttl_s': 7 * 24 * 3600,  # identity is queried again when the cache entry is older
+          'identity_verify': True}  # on cache hit, check the serial number (1 query) to detect a swapped lens
+
+IDENTITY_QUERIES = ('firmwaretype', 'firmwarebranch', 'partnumber', 'serialnumber', 'firmwareversion', 'deviceid')
+_identity_lock = threading.Lock()  # ETLs connecting in parallel share the identity cache file
+
+
+def connect_all(etls):
+    """Connect several ETLs concurrently, e.g. both lenses of a dual-ETL setup.
+    Returns list of True/False (connected) in the order of etls, a failing port does not stop the others."""
+    if len(etls) == 0:
+        return []
+    with ThreadPoolExecutor(max_workers=len(etls)) as executor:
+        return list(executor.map(_connect_one, etls))
+
+
+def _connect_one(etl):
+    try:
+        return etl.connect()
+    except Exception as e:
+        etl.logger.fatal(f"Failed to connect ETL on {etl.port}: {e}")
+        return False
+
+
+def ramp_profile(start_mA, stop_mA, duration_ms, step_ms, shape='cosine'):
+    """Current set-points (mA) from start_mA (excluded) to stop_mA (included), one every step_ms.
+    Shape 'linear' has constant slope, 'cosine' has zero slope at both ends."""
+    assert shape in ('linear', 'cosine'), f"Unknown ramp shape: {shape}"
+    n_steps = max(int(np.ceil(duration_ms / step_ms)), 1)
+    x = np.arange(1, n_steps + 1) / n_steps
+    if shape == 'cosine':
+        x = 0.5 * (1 - np.cos(np.pi * x))
+    return start_mA + (stop_mA - start_mA) * x
+
+
+PRIORITY_COMMAND = 0
+PRIORITY_TELEMETRY = 10
+TELEMETRY_DTYPE = np.dtype([('time_s', np.float64), ('temperature_C', np.float32),
+                            ('current_mA', np.float32), ('status', np.uint32)])
+
+
+def focus_metric(image):
+    """Brenner gradient of the image, normalized by its mean intensity squared: high when in focus."""
+    image = np.asarray(image, dtype=np.float32)
+    diff = image[:, 2:] - image[:, :-2]
+    return float(np.mean(diff * diff) / max(float(np.mean(image)) ** 2, 1e-12))
+
+
+def _isotonic(y):
+    """Least-squares non-decreasing fit of y (pool adjacent violators)."""
+    values, weights = [], []
+    for v in y:
+        values.append(float(v))
+        weights.append(1)
+        while len(values) > 1 and values[-2] > values[-1]:
+            w = weights[-2] + weights[-1]
+            values[-2] = (values[-2] * weights[-2] + values[-1] * weights[-1]) / w
+            weights[-2] = w
+            values.pop()
+            weights.pop()
+    return np.repeat(values, weights)
+
+
+class ETLCalibration:
+    """
+    Calibration of ETL focus position z (um) vs current (mA), with linear temperature compensation:
+        z(current, T) = z_ref(current) + temp_coeff * (T - temp_ref)
+    z_ref is a monotonic piecewise-linear fit of the recorded points. After fit(), z -> current conversion
+    uses a precomputed lookup table on a uniform z grid: O(1) per plane, vectorized for whole sweeps.
+    """
+    def __init__(self, lut_step_um=0.05):
+        self.points = []  # (current_mA, z_um, temperature_C)
+        self.lut_step_um = lut_step_um
+        self.temp_ref = 25.0
+        self.temp_coeff = 0.0  # um per degree C
+        self.sign = 1  # +1 if z increases with current, -1 otherwise
+        self.lut_z0 = 0.0
+        self.lut = None  # currents on the z grid
+
+    def add_point(self, current_mA, z_um, temperature_C):
+        self.points.append((float(current_mA), float(z_um), float(temperature_C)))
+        self.lut = None
+
+    @property
+    def is_fitted(self):
+        return self.lut is not None
+
+    def fit(self, temp_coeff=None):
+        """Fit the calibration to the recorded points, and build the lookup table.
+        Parameters:
+            :param temp_coeff: float
+                Known temperature coefficient (um/C). If None, it is fitted when the points span > 0.5 C.
+        """
+        assert len(self.points) >= 2, "At least 2 calibration points needed"
+        pts = np.array(self.points)
+        current, z, temp = pts[:, 0], pts[:, 1], pts[:, 2]
+        self.temp_ref = float(np.mean(temp))
+        self.sign = 1 if np.polyfit(current, z, 1)[0] >= 0 else -1
+        if temp_coeff is None:
+            temp_coeff = 0.0
+            if np.ptp(temp) > 0.5:
+                # z = a + b * current + c * (T - temp_ref), linear near the working point
+                design = np.column_stack((np.ones_like(current), current, temp - self.temp_ref))
+                temp_coeff = float(np.linalg.lstsq(design, z, rcond=None)[0][2])
+        self.temp_coeff = float(temp_coeff)
+        z_ref = z - self.temp_coeff * (temp - self.temp_ref)
+        order = np.argsort(current)
+        self._currents = current[order]
+        self._z_ref = self.sign * _isotonic(self.sign * z_ref[order])
+        # lookup table of current on a uniform z grid
+        z_sorted_idx = np.argsort(self._z_ref, kind='stable')
+        z_grid_ref = self._z_ref[z_sorted_idx]
+        self.lut_z0 = float(z_grid_ref[0])
+        n = int(np.ceil((z_grid_ref[-1] - self.lut_z0) / self.lut_step_um)) + 1
+        z_grid = self.lut_z0 + np.arange(n) * self.lut_step_um
+        self.lut = np.interp(z_grid, z_grid_ref, self._currents[z_sorted_idx])
+        return self
+
+    def z_range(self, temperature_C=None):
+        """(min, max) z reachable with the calibrated currents."""
+        dz = 0.0 if temperature_C is None else self.temp_coeff * (temperature_C - self.temp_ref)
+        return self.lut_z0 + dz, self.lut_z0 + (len(self.lut) - 1) * self.lut_step_um + dz
+
+    def current(self, z_um, temperature_C=None):
+        """Current (mA) focusing at z_um, scalar or array. Values outside the calibrated range are clipped."""
+        assert self.is_fitted, "Calibration is not fitted"
+        z = np.asarray(z_um, dtype=float)
+        if temperature_C is not None:
+            z = z - self.temp_coeff * (temperature_C - self.temp_ref)
+        pos = np.clip((z - self.lut_z0) / self.lut_step_um, 0, len(self.lut) - 1)
+        i = np.minimum(pos.astype(int), len(self.lut) - 2) if len(self.lut) > 1 else np.zeros_like(pos, dtype=int)
+        frac = pos - i
+        nxt = np.minimum(i + 1, len(self.lut) - 1)
+        result = self.lut[i] * (1 - frac) + self.lut[nxt] * frac
+        return float(result) if result.ndim == 0 else result
+
+    def z(self, current_mA, temperature_C=None):
+        """Focus position (um) at current_mA."""
+        assert self.is_fitted, "Calibration is not fitted"
+        z = np.interp(current_mA, self._currents, self._z_ref)
+        if temperature_C is not None:
+            z = z + self.temp_coeff * (temperature_C - self.temp_ref)
+        return z
+
+    def save(self, filepath):
+        with open(filepath, 'w') as f:
+            json.dump({'points': self.points, 'lut_step_um': self.lut_step_um,
+                       'temp_coeff': self.temp_coeff if self.is_fitted else None}, f, indent=1)
+
+    def load(self, filepath):
+        """Load the points from a JSON file and refit, so the lookup table is rebuilt the same way."""
+        with open(filepath) as f:
+            data = json.load(f)
+        self.points = [tuple(p) for p in data['points']]
+        self.lut_step_um = data['lut_step_um']
+        return self.fit(temp_coeff=data['temp_coeff'])
 
 
 class ETLController(QtCore.QObject):
@@ -21,6 +203,7 @@ class ETLController(QtCore.QObject):
     Current units: mA.
     """
     sig_update_gui = pyqtSignal()
+    sig_telemetry_alert = pyqtSignal(str)
 
     def __init__(self, gui_on=True, logger_name='ETL'):
         super().__init__()
@@ -35,10 +218,34 @@ class ETLController(QtCore.QObject):
         self._current_max = self._current_upper = 292.84
         self._current_lower = -292.84
         self._status = "Unknown"
+        self.status_flags = 0
+        self._temp_reading = None
+        # serial request scheduler and telemetry
+        self._requests = queue.PriorityQueue()
+        self._request_counter = itertools.count()
+        self._io_thread = self._poll_thread = None
+        self._io_lock = threading.Lock()  # commands are queued only while the serial thread accepts them
+        self._ser_lock = threading.RLock()  # direct sends and the serial thread never overlap
+        self._telemetry_stop = threading.Event()
+        self.telemetry_buffer = np.zeros(config['telemetry_capacity'], dtype=TELEMETRY_DTYPE)
+        self._n_telemetry = 0
+        self._temp_start = None
+        self.alerts = []
+        self._alarm_on = False
+        self.calibration = ETLCalibration(config['calibration_lut_step_um'])
+        if config['calibration_file'] is not None:
+            self.load_calibration(config['calibration_file'])
+        self.eeprom = None  # cached EEPROM image (bytes) of the connected lens
+        self._eeprom_cache = None
+        self._eeprom_key = None
+        self.identity = {}
+        self._serialnumber = None
+        self._ramp_thread = None
+        self._ramp_cancel = threading.Event()
         # GUI
         self.gui_on = gui_on
         if self.gui_on:
-            self.gui = kekse.ProtoKeks("Optotune ETL")
+            self.gui = kekse.ProtoKeks("Optotune ETL", workers=1)
             self.logger.debug("ETL GUI on")
             self._setup_gui()
             # signals
@@ -56,8 +263,12 @@ class ETLController(QtCore.QObject):
 
     def connect(self):
         """
-        Open the serial port and connect
+        Open the serial port and connect. The lens identity is taken from the cache if it is fresh.
+
+        Returns:
+            True if connected
         """
+        t_start = time.perf_counter()
         self._ser = serial.Serial()
         self._ser.baudrate = self.baud
         self._ser.port = self.port
@@ -68,34 +279,113 @@ class ETLController(QtCore.QObject):
                 raise serial.SerialException('Handshake failed')
             else:
                 self._status = "Ready"
+                self.discover_identity()
+                if config['eeprom_cache_file'] is not None:
+                    self.eeprom_image()
                 self.set_current(config['ini_current_mA'])
+                self.logger.info(f"Connected on {self.port} in {time.perf_counter() - t_start:.3f} s")
                 if self.gui_on:
                     self.sig_update_gui.emit()
-        except serial.SerialException as e:
-            self.logger.fatal(f"Failed to open ETL serial port: {e}")
+                return True
+        except (serial.SerialException, OSError, ValueError, IndexError, KeyError) as e:
+            # a garbled reply or a corrupt cache entry fails this port only
+            self.logger.fatal(f"Failed to connect ETL on {self.port}: {e}")
+            if self._ser is not None and self._ser.is_open:
+                self._ser.close()
+            self._ser = None
+            return False
+
+    def _read_identity_cache(self):
+        filepath = config['identity_cache_file']
+        if filepath is not None and os.path.exists(filepath):
+            try:
+                with open(filepath) as f:
+                    return json.load(f)
+            except (OSError, ValueError) as e:
+                self.logger.error(f"Could not read identity cache {filepath}: {e}")
+        return {}
+
+    def discover_identity(self, refresh=False):
+        """
+        Query the lens identity (firmware, part and serial numbers, device ID), unless the identity cached
+        for this port is younger than config['identity_ttl_s']. On a cache hit, only the serial number is
+        checked (if config['identity_verify']), a different lens on the port triggers a full query.
+
+        Returns:
+            dict of identity values, bytes are stored as hex strings
+        """
+        with _identity_lock:
+            cache = self._read_identity_cache()
+        entry = cache.get(self.port)
+        fresh = entry is not None and time.time() - entry['time_s'] < config['identity_ttl_s']
+        if fresh and not refresh:
+            identity = entry['identity']
+            if config['identity_verify'] and bytes(self.serialnumber()).hex() != identity['serialnumber']:
+                self.logger.info(f"Different lens on {self.port}, querying identity")
+                fresh = False
+        if not fresh or refresh:
+            identity = {}
+            for name in IDENTITY_QUERIES:
+                value = getattr(self, name)()
+                identity[name] = bytes(value).hex() if isinstance(value, (bytes, bytearray)) else value
+            if config['identity_cache_file'] is not None:
+                with _identity_lock:
+                    cache = self._read_identity_cache()
+                    cache[self.port] = {'time_s': time.time(), 'identity': identity}
+                    os.makedirs(os.path.dirname(os.path.abspath(config['identity_cache_file'])), exist_ok=True)
+                    with open(config['identity_cache_file'], 'w') as f:
+                        json.dump(cache, f, indent=1)
+        self.identity = identity
+        self._serialnumber = bytes.fromhex(identity['serialnumber'])
+        self._partnumber = bytes.fromhex(identity['partnumber'])
+        self._deviceid = bytes.fromhex(identity['deviceid'])
+        self._firmwaretype, self._firmwarebranch = identity['firmwaretype'], identity['firmwarebranch']
+        self._firmwarerevision = identity['firmwareversion']
+        return identity
 
     def close(self, soft_close=None):
         """
         Close the serial port
         Args:
-            soft_close (bool): Step-down the current and set to 0 before close.
+            soft_close (bool): Ramp the current down to 0 in the background, and close the port when done.
+
+        Returns:
+            Future of the ramp if soft_close, else None
         """
         if soft_close is None:
             soft_close = False
+        if self._ser and self._current and soft_close:
+            future = self.ramp_current(0)
+            future.add_done_callback(lambda f: self.close(soft_close=False))
+            return future
+        self.cancel_ramp()
+        self.stop_telemetry()
         if self._ser:
-            if self._current and soft_close:
-                for f in range(5):
-                    self.set_current(self._current/2)
-                    self._current = self.get_current()
-                    time.sleep(0.100)
-                self.set_current(0)
             self._ser.close()
             self._ser = None
+            self._serialnumber = None
             self._status = 'Disconnected'
             if self.gui_on:
                 self.sig_update_gui.emit()
 
     def _send_cmd(self, cmd, include_crc=None, wait_for_resp=None):
+        """
+        Send a command. While telemetry is running, the command is queued to the serial thread
+        ahead of all telemetry reads, otherwise it is sent directly.
+        Arguments as in _send_cmd_now().
+        """
+        with self._io_lock:
+            io_thread = self._io_thread
+            if io_thread is not None and threading.get_ident() != io_thread.ident:
+                future = self._submit(PRIORITY_COMMAND, self._send_cmd_now, cmd, include_crc, wait_for_resp)
+            else:
+                future = None
+        if future is None:
+            return self._send_cmd_now(cmd, include_crc, wait_for_resp)
+        return future.result()
+
+    @kekse.profiler.timed('ETL.send_cmd')
+    def _send_cmd_now(self, cmd, include_crc=None, wait_for_resp=None):
         """
         Send a command
 
@@ -110,6 +400,10 @@ class ETLController(QtCore.QObject):
             include_crc = True
         if wait_for_resp is None:
             wait_for_resp = True
+        with self._ser_lock:
+            return self._write_read(cmd, include_crc, wait_for_resp)
+
+    def _write_read(self, cmd, include_crc, wait_for_resp):
         if self._ser is None:
             raise(serial.SerialException('Serial not connected'))
         if include_crc:
@@ -132,6 +426,101 @@ class ETLController(QtCore.QObject):
                     'Command error: {}').format(resp_content))
             return resp_content
 
+    def _submit(self, priority, func, *args):
+        """Queue func(*args) to the serial thread. Returns Future."""
+        future = Future()
+        self._requests.put((priority, next(self._request_counter), func, args, future))
+        return future
+
+    def _io_loop(self):
+        """Serial thread: executes queued requests, lowest priority number first, in order of submission."""
+        while True:
+            priority, _, func, args, future = self._requests.get()
+            if func is None:
+                break
+            try:
+                future.set_result(func(*args))
+            except Exception as e:
+                future.set_exception(e)
+
+    def start_telemetry(self, period_s=None):
+        """Start polling temperature, current and status in the background, interleaved with commands.
+        Readings are stored in telemetry_buffer (ring buffer), see telemetry()."""
+        if self._ser is None:
+            self.logger.error("ETL is not connected")
+            return
+        if self._poll_thread is not None:
+            return
+        if period_s is not None:
+            config['telemetry_period_s'] = period_s
+        self._telemetry_stop.clear()
+        self._temp_start = None
+        self._alarm_on = False
+        self._io_thread = threading.Thread(target=self._io_loop, name='ETL serial', daemon=True)
+        self._poll_thread = threading.Thread(target=self._poll_loop, name='ETL telemetry', daemon=True)
+        self._io_thread.start()
+        self._poll_thread.start()
+        self.logger.info(f"Telemetry started, every {config['telemetry_period_s']} s")
+
+    def stop_telemetry(self):
+        if self._poll_thread is None:
+            return
+        self._telemetry_stop.set()
+        self._poll_thread.join()
+        # commands already queued are executed before the serial thread exits, later ones are sent directly
+        with self._io_lock:
+            io_thread, self._io_thread = self._io_thread, None
+            self._requests.put((PRIORITY_TELEMETRY + 1, next(self._request_counter), None, (), None))
+        io_thread.join()
+        self._poll_thread = None
+        self.logger.info("Telemetry stopped")
+
+    def _poll_loop(self):
+        t_next = time.perf_counter()
+        while not self._telemetry_stop.is_set():
+            # separate requests, so that commands can be sent between them
+            reads = [self._submit(PRIORITY_TELEMETRY, func) for func in (self.temp_reading, self.get_current,
+                                                                         self.get_status)]
+            try:
+                temperature, current, status = [f.result() for f in reads]
+                self._store_telemetry(temperature, current, status)
+            except (serial.SerialException, ValueError, IndexError) as e:
+                self.logger.error(f"Telemetry read failed: {e}")
+            t_next += config['telemetry_period_s']
+            self._telemetry_stop.wait(max(t_next - time.perf_counter(), 0))
+
+    def _store_telemetry(self, temperature, current, status):
+        idx = self._n_telemetry % len(self.telemetry_buffer)
+        self.telemetry_buffer[idx] = (time.time(), temperature, current, status & 0xFFFFFFFF)
+        self._n_telemetry += 1
+        if self._temp_start is None:
+            self._temp_start = temperature
+        t_min, t_max = config['temp_limits_C']
+        message = None
+        if not t_min <= temperature <= t_max:
+            message = f"ETL temperature {temperature:.2f} C outside of limits ({t_min}, {t_max}) C"
+        elif abs(temperature - self._temp_start) > config['temp_drift_alert_C']:
+            message = f"ETL temperature drifted by {temperature - self._temp_start:+.2f} C"
+        # alert once when the condition appears, not on every reading
+        if message is not None and not self._alarm_on:
+            self._alert(message)
+        self._alarm_on = message is not None
+        if self.gui_on:
+            self.sig_update_gui.emit()
+
+    def _alert(self, message):
+        self.alerts.append((time.time(), message))
+        self.logger.warning(message)
+        self.sig_telemetry_alert.emit(message)
+
+    def telemetry(self):
+        """Stored telemetry readings (TELEMETRY_DTYPE records), oldest first."""
+        n = len(self.telemetry_buffer)
+        if self._n_telemetry <= n:
+            return self.telemetry_buffer[:self._n_telemetry].copy()
+        idx = self._n_telemetry % n
+        return np.concatenate((self.telemetry_buffer[idx:], self.telemetry_buffer[:idx]))
+
     def calc_crc(self, data):
         """
         Calculate a CRC
@@ -315,11 +704,143 @@ class ETLController(QtCore.QObject):
         Returns:
             None
         """
+        ramp = self._ramp_thread
+        if ramp is not None and threading.get_ident() != ramp.ident:  # a direct set stops the running ramp
+            self.cancel_ramp()
         data = int(value*4095/self._current_max)
         data = data.to_bytes(2, byteorder='big', signed=True)
         r = self._send_cmd(b'Aw'+data, wait_for_resp=False)
         self._current = value
 
+    def ramp_current(self, value, duration_ms=None, shape=None):
+        """
+        Ramp the current to value along a precomputed profile (see ramp_profile()), in a background thread.
+        A running ramp is cancelled and the new one starts from the last current set.
+
+        Args:
+            value (float): Target current in mA
+            duration_ms (float): Ramp duration, default config['ramp_duration_ms']
+            shape (str): 'linear' or 'cosine', default config['ramp_shape']
+
+        Returns:
+            Future, resolved with the last current set when the ramp ends or is cancelled
+        """
+        self.cancel_ramp()
+        if duration_ms is None:
+            duration_ms = config['ramp_duration_ms']
+        if shape is None:
+            shape = config['ramp_shape']
+        profile = ramp_profile(self._current, value, duration_ms, config['ramp_step_ms'], shape)
+        future = Future()
+        future.set_running_or_notify_cancel()
+        self._ramp_cancel.clear()
+        self._ramp_thread = threading.Thread(target=self._ramp_loop, args=(profile, config['ramp_step_ms'], future),
+                                             name='ETL ramp', daemon=True)
+        self._ramp_thread.start()
+        return future
+
+    def _ramp_loop(self, profile, step_ms, future):
+        t_start = time.perf_counter()
+        try:
+            for i, current in enumerate(profile):
+                self._ramp_cancel.wait(max(t_start + i * step_ms / 1000. - time.perf_counter(), 0))
+                if self._ramp_cancel.is_set():
+                    break
+                self.set_current(float(current))
+            future.set_result(self._current)
+        except Exception as e:
+            self.logger.error(f"Current ramp failed: {e}")
+            future.set_exception(e)
+        if self.gui_on:
+            self.sig_update_gui.emit()
+
+    def cancel_ramp(self):
+        """Stop a running current ramp at the last set-point, and wait for its thread to end."""
+        if self._ramp_thread is not None:
+            self._ramp_cancel.set()
+            if threading.get_ident() != self._ramp_thread.ident:
+                self._ramp_thread.join()
+            self._ramp_thread = None
+
+    def move_current(self, value):
+        """Set the current, ramping it (non-blocking) if the jump is larger than config['ramp_threshold_mA']."""
+        threshold = config['ramp_threshold_mA']
+        if threshold is not None and abs(value - self._current) > threshold:
+            self.ramp_current(value)
+        else:
+            self.set_current(value)
+
+    def record_calibration_point(self, z_um, currents, snap_func, settle_s=0.02):
+        """Sweep the currents, find the sharpest image, and store (current, z_um, temperature) calibration point.
+        The best current is refined by a parabola through the focus metric around the maximum.
+        Parameters:
+            :param z_um: float
+                Known focus position (e.g. z stage position of a thin bead sample).
+            :param currents: array
+                Currents to sweep (mA), uniformly spaced.
+            :param snap_func: function reference
+                snap_func() returns a camera image (2D array).
+        Returns (best current, focus metrics)."""
+        currents = np.asarray(currents, dtype=float)
+        metrics = np.zeros(len(currents))
+        for i, current in enumerate(currents):
+            self.set_current(current)
+            time.sleep(settle_s)
+            metrics[i] = focus_metric(snap_func())
+        i = int(np.argmax(metrics))
+        best = currents[i]
+        if 0 < i < len(currents) - 1:
+            m0, m1, m2 = metrics[i - 1:i + 2]
+            denom = m0 - 2 * m1 + m2
+            if denom < 0:
+                best += 0.5 * (m0 - m2) / denom * (currents[i + 1] - currents[i])
+        else:
+            self.logger.warning(f"z={z_um} um: best focus at the end of the current sweep")
+        temperature = self.temp_reading()
+        self.calibration.add_point(best, z_um, temperature)
+        self.logger.info(f"Calibration point: z={z_um:.2f} um, I={best:.3f} mA, T={temperature:.2f} C")
+        return best, metrics
+
+    def calibrate(self, z_positions_um, currents, snap_func, move_z_func, filepath=None):
+        """Record calibration points at several focus positions, fit the calibration, and save it if filepath given.
+        move_z_func(z_um) moves the sample (or detection objective) to the focus position z_um."""
+        self.calibration = ETLCalibration(config['calibration_lut_step_um'])
+        for z_um in z_positions_um:
+            move_z_func(z_um)
+            self.record_calibration_point(z_um, currents, snap_func)
+        self.calibration.fit()
+        self.logger.info(f"Calibration fitted: z range {self.calibration.z_range()} um, "
+                         f"temperature coefficient {self.calibration.temp_coeff:.3f} um/C")
+        if filepath is not None:
+            self.calibration.save(filepath)
+        return self.calibration
+
+    def load_calibration(self, filepath):
+        try:
+            self.calibration.load(filepath)
+            self.logger.info(f"Calibration loaded: {filepath}")
+        except (OSError, ValueError, KeyError, AssertionError) as e:
+            self.logger.error(f"Could not load calibration {filepath}: {e}")
+
+    def save_calibration(self, filepath):
+        self.calibration.save(filepath)
+
+    def z_to_current(self, z_um, temperature_C=None):
+        """Current (mA) focusing at z_um (scalar or array, e.g. all planes of a volume).
+        Uses the last temperature reading, if temperature_C is not given: call temp_reading() to update it."""
+        if temperature_C is None:
+            temperature_C = self._temp_reading
+        return self.calibration.current(z_um, temperature_C)
+
+    def set_z(self, z_um):
+        """Focus at z_um, using the calibration."""
+        if not self.calibration.is_fitted:
+            self.logger.error("ETL is not calibrated")
+            return
+        self.move_current(float(self.z_to_current(z_um)))
+        if self.gui_on:
+            self.sig_update_gui.emit()
+
     def siggen_upper(self, value=None):
         """
         Get/set signal generator upper current swing limit (ID #0305)
@@ -408,6 +929,7 @@ class ETLController(QtCore.QObject):
         else:
             if value[0] > value[1]:
                 raise ValueError
+            config['temp_limits_C'] = tuple(value)  # telemetry alerts use the same limits
             data = ((value[1]*16).to_bytes(2, byteorder='big', signed=True) +
                     (value[0]*16).to_bytes(2, byteorder='big', signed=True))
             r = self._send_cmd(b'PwTA'+data)
@@ -474,10 +996,14 @@ class ETLController(QtCore.QObject):
     def get_status(self):
         """
         Return firmware status information (ID #0503)
+
+        Returns:
+            Status flags (int), 0 if no error. Status shown in the GUI is updated.
         """
         r = self._send_cmd(b'Sr')
-        self._status = r[1:]
-        return self._status
+        self.status_flags = int.from_bytes(r[1:], byteorder='big')
+        self._status = "Ready" if self.status_flags == 0 else f"Status flags 0x{self.status_flags:08X}"
+        return self.status_flags
 
     def eeprom_read(self, value):
         """
@@ -492,7 +1018,7 @@ class ETLController(QtCore.QObject):
         Todo:
             Test
         """
-        data = int(value).to_bytes(1, byteorder='big', signed=True)
+        data = int(value).to_bytes(1, byteorder='big', signed=False)
         r = self._send_cmd(b'Zr'+data)
         return r[1]
 
@@ -520,8 +1046,8 @@ class ETLController(QtCore.QObject):
         Todo:
             Test
         """
-        data_a = int(address).to_bytes(1, byteorder='big', signed=True)
-        data_b = int(value).to_bytes(1, byteorder='big', signed=True)
+        data_a = int(address).to_bytes(1, byteorder='big', signed=False)
+        data_b = int(value).to_bytes(1, byteorder='big', signed=False)
         r = self._send_cmd(b'Zw'+data_a+data_b)
         return r[1]
 
@@ -535,6 +1061,93 @@ class ETLController(QtCore.QObject):
         r = self._send_cmd(b'D\x00\x00')
         return r[1:]
 
+    def _load_eeprom_cache(self):
+        if self._eeprom_cache is None:
+            self._eeprom_cache = {}
+            filepath = config['eeprom_cache_file']
+            if filepath is not None and os.path.exists(filepath):
+                try:
+                    with open(filepath) as f:
+                        self._eeprom_cache = json.load(f)
+                except (OSError, ValueError) as e:
+                    self.logger.error(f"Could not read EEPROM cache {filepath}: {e}")
+        return self._eeprom_cache
+
+    def _save_eeprom_cache(self):
+        filepath = config['eeprom_cache_file']
+        if filepath is not None:
+            os.makedirs(os.path.dirname(os.path.abspath(filepath)), exist_ok=True)
+            with open(filepath, 'w') as f:
+                json.dump(self._eeprom_cache, f, indent=1)
+
+    def _cache_eeprom(self, serial_number, data):
+        self._load_eeprom_cache()[serial_number] = {'time': time.strftime('%Y-%m-%d %H:%M:%S'), 'data': data.hex()}
+        self._save_eeprom_cache()
+
+    def eeprom_read_all(self):
+        """
+        Read the whole EEPROM: one dump command, or byte by byte if the dump is incomplete.
+
+        Returns:
+            bytes of length config['eeprom_size']
+        """
+        size = config['eeprom_size']
+        try:
+            data = bytes(self.eeprom_contents())
+            if len(data) >= size:
+                return data[:size]
+            self.logger.debug(f"EEPROM dump returned {len(data)} of {size} bytes, reading byte by byte")
+        except serial.SerialException as e:
+            self.logger.debug(f"EEPROM dump failed ({e}), reading byte by byte")
+        return bytes(self.eeprom_read(address) for address in range(size))
+
+    def eeprom_image(self, refresh=False):
+        """
+        EEPROM contents of the connected lens, from the cache if this lens (serial number) was seen before.
+
+        Args:
+            refresh (bool): Read the EEPROM from the lens even if it is cached.
+
+        Returns:
+            bytes
+        """
+        cache = self._load_eeprom_cache()
+        serial_number = self._serialnumber if self._serialnumber is not None else self.serialnumber()
+        key = self._eeprom_key = bytes(serial_number).hex()
+        if not refresh and key in cache:
+            self.eeprom = bytes.fromhex(cache[key]['data'])
+            self.logger.debug(f"EEPROM of lens {key} loaded from cache")
+        else:
+            self.eeprom = self.eeprom_read_all()
+            self._cache_eeprom(key, self.eeprom)
+        return self.eeprom
+
+    def eeprom_write_all(self, data):
+        """
+        Write EEPROM contents, sending only the bytes that differ from the cached image.
+
+        Args:
+            data (bytes or dict): Full image, or {address: value} of bytes to change.
+
+        Returns:
+            List of written addresses
+        """
+        current = self.eeprom_image()
+        new = bytearray(current)
+        if isinstance(data, dict):
+            for address, value in data.items():
+                new[int(address)] = int(value)
+        else:
+            assert len(data) == len(current), f"EEPROM image must have {len(current)} bytes"
+            new[:] = data
+        written = [address for address in range(len(new)) if new[address] != current[address]]
+        for address in written:
+            self.eeprom_write(address, new[address])
+        self.eeprom = bytes(new)
+        self._cache_eeprom(self._eeprom_key, self.eeprom)
+        self.logger.info(f"EEPROM: {len(written)} bytes written")
+        return written
+
     def mode(self, mode_str=None):
         """
         Get/set operation mode (ID #0301, 0302, 0303, 0304, 0308, 0321)
@@ -591,14 +1204,22 @@ class ETLController(QtCore.QObject):
         self.gui.add_numeric_field('Current, mA', parent_name,
                                    value=self._current,
                                    vrange=[self._current_lower, self._current_upper, 0.1],
-                                   func=self.set_current)
+                                   func=self.move_current)
+        self.gui.add_numeric_field('Focus z, um', parent_name,
+                                   value=0, vrange=[-1e4, 1e4, 0.1],
+                                   func=self.set_z)
 
-        self.gui.add_button('Disconnect', parent_name, lambda: self.close())
+        self.gui.add_checkbox('Telemetry', parent_name, value=False,
+                              func=lambda on: self.start_telemetry() if on else self.stop_telemetry())
+        self.gui.add_numeric_field('Temperature, C', parent_name, value=0, vrange=[-100, 200, 0.01], enabled=False)
+        self.gui.add_button('Disconnect', parent_name, lambda: self.close(soft_close=True))
 
     @QtCore.pyqtSlot()
     def _update_gui(self):
         self.gui.update_param('Status', self._status)
         self.gui.update_param('Current, mA', self._current)
+        if self._temp_reading is not None:
+            self.gui.update_param('Temperature, C', self._temp_reading)
 
 # run if the module is launched as a standalone program
 if __name__ == "__main__":
@@ -15,6 +15,22 @@ config = {
     'image_shape': (2048, 2048),  # (Y,X)
     'sensor_shape': (2048, 2048),  # (Y,X)
     'exposure_ms': 20,
+    # ROI block
+    'roi_step_px': 4,  # subarray size and position must be multiples of it
+    'roi_min_px': 4,
+    'binning_options': (1, 2, 4),
+    'line_time_ms': 9.74436E-3,  # 1-row readout time
+    'roi_presets': {  # [hsize, vsize, hpos, vpos, binning], pos None for centered ROI
+        'full': [2048, 2048, 0, 0, 1],
+        'center 1024': [2048, 1024, None, None, 1],
+        'center 512': [2048, 512, None, None, 1],
+        'survey bin2': [2048, 2048, 0, 0, 2]},
+    # on-the-fly frame reduction block, see kekse.stacks.FrameReducer
+    'reduce_frames': False,
+    'reduce_crop': None,  # (top, bottom, left, right) in image pixels, None for full image
+    'reduce_binning': 1,
+    'reduce_projections': ('max',),  # 'max', 'mean'
+    'reduce_workers': 2,
     # triggers in block
     'trigger_in': True,
     'trig_in_mode': 'NORMAL',  # 'NORMAL', 'START'
@@ -40,9 +56,12 @@ config = {
 import ctypes
 import ctypes.util
 import numpy
+import time
 
 # for debugging
 import sys
+from kekse import profiler
+from kekse.stacks import FrameReducer
 
 dcam = ctypes.windll.dcamapi  # get the DLL handle
 
@@ -177,6 +196,32 @@ class DCAMBUF_FRAME(ctypes.Structure):
             ("camerastamp", ctypes.c_int32)]
 
 
+## FRAME_METADATA_DTYPE
+#
+# Metadata record of one frame, filled from DCAMBUF_FRAME
+#
+FRAME_METADATA_DTYPE = numpy.dtype([("frame_index", numpy.int64),  # framestamp, counted by the camera
+                                    ("buffer_index", numpy.int32),
+                                    ("camera_stamp", numpy.int64),
+                                    ("timestamp", numpy.int64),  # DCAM timestamp
+                                    ("host_time_ns", numpy.int64),  # time.perf_counter_ns() at frame retrieval
+                                    ("left", numpy.int32),
+                                    ("top", numpy.int32),
+                                    ("width", numpy.int32),
+                                    ("height", numpy.int32)])
+
+
+def findFrameGaps(frame_index):
+    """
+    Find gaps in the sequence of frame indices (framestamps).
+    Returns the frame indices after which frames are missing, and the numbers of missing frames.
+    """
+    frame_index = numpy.asarray(frame_index, dtype=numpy.int64)
+    steps = numpy.diff(frame_index)
+    gap_pos = numpy.nonzero(steps != 1)[0]
+    return frame_index[gap_pos], steps[gap_pos] - 1
+
+
 ## DCAMDEV_STRING
 #
 # The dcam device string structure
@@ -295,7 +340,7 @@ class HamamatsuCamera(object):
 
         self.acquisition_mode = "run_till_abort"
         self.number_frames = 0
-
+        self.allocateMetadata(0)
 
         # Get camera model.
         self.camera_model = self.getModelInfo(camera_id)
@@ -407,31 +452,91 @@ class HamamatsuCamera(object):
                              "dcamprop_getname")
         return properties
 
+    @profiler.timed('DCAM.getFrames')
     def getFrames(self):
         """
         Gets all of the available frames.
 
         This will block waiting for new frames even if
         there new frames available when it is called.
+        Frame metadata is available from getMetadata().
         """
         frames = []
-        for n in self.newFrames():
-            paramlock = DCAMBUF_FRAME(
-                    0, 0, 0, n, None, 0, 0, 0, 0, 0, 0, 0, 0, 0)
-            paramlock.size = ctypes.sizeof(paramlock)
-
+        new_frames = self.newFrames()
+        for n in new_frames:
             # Lock the frame in the camera buffer & get address.
-            self.checkStatus(dcam.dcambuf_lockframe(self.camera_handle,
-                                                ctypes.byref(paramlock)),
-                             "dcambuf_lockframe")
+            address = self.lockFrame(n)
 
             # Create storage for the frame & copy into this storage.
             hc_data = HCamData(self.frame_bytes)
-            hc_data.copyData(paramlock.buf)
+            hc_data.copyData(address)
             frames.append(hc_data)
 
+        self.checkFrameGaps(new_frames)
         return [frames, [self.frame_y, self.frame_x]]
 
+    def allocateMetadata(self, n_buffers):
+        """
+        Preallocate the frame metadata records (one per camera buffer), and
+        the frame structure reused by lockFrame().
+        """
+        self.frame_metadata = numpy.zeros(n_buffers, dtype=FRAME_METADATA_DTYPE)
+        # field views, so that writing a value does not create new objects
+        self._metadata_fields = {name: self.frame_metadata[name] for name in FRAME_METADATA_DTYPE.names}
+        self.paramlock = DCAMBUF_FRAME(0, 0, 0, 0, None, 0, 0, 0, 0, 0, 0, 0, 0, 0)
+        self.paramlock.size = ctypes.sizeof(self.paramlock)
+        self.last_frame_ids = []
+        self.last_framestamp = -1
+        self.dropped_frames = 0
+        self.frame_gaps = []
+
+    def lockFrame(self, n):
+        """
+        Lock frame n in the camera buffer, record its metadata and return its address.
+        """
+        paramlock = self.paramlock
+        paramlock.iFrame = n
+        self.checkStatus(dcam.dcambuf_lockframe(self.camera_handle,
+                                            ctypes.byref(paramlock)),
+                         "dcambuf_lockframe")
+        fields = self._metadata_fields
+        fields["frame_index"][n] = paramlock.framestamp
+        fields["buffer_index"][n] = n
+        fields["camera_stamp"][n] = paramlock.camerastamp
+        fields["timestamp"][n] = paramlock.timestamp
+        fields["host_time_ns"][n] = time.perf_counter_ns()
+        fields["left"][n] = paramlock.left
+        fields["top"][n] = paramlock.top
+        fields["width"][n] = paramlock.width
+        fields["height"][n] = paramlock.height
+        return paramlock.buf
+
+    def checkFrameGaps(self, frame_ids):
+        """
+        Detect dropped frames from the framestamps of the new frames.
+        """
+        self.last_frame_ids = frame_ids
+        if len(frame_ids) == 0:
+            return
+        stamps = self._metadata_fields["frame_index"][frame_ids]
+        if self.last_framestamp >= 0:
+            stamps = numpy.concatenate(([self.last_framestamp], stamps))
+        after, n_missing = findFrameGaps(stamps)
+        if after.size > 0:
+            self.dropped_frames += int(n_missing.sum())
+            self.frame_gaps.extend(zip(after.tolist(), n_missing.tolist()))
+            print(">> Warning! hamamatsu camera dropped", int(n_missing.sum()), "frames after frame", int(after[0]))
+        self.last_framestamp = stamps[-1]
+
+    def getMetadata(self, frame_ids=None):
+        """
+        Return a copy of the metadata records of the frames returned by the last getFrames() call,
+        or of the frames in the frame_ids list.
+        """
+        if frame_ids is None:
+            frame_ids = self.last_frame_ids
+        return self.frame_metadata[frame_ids]
+
     def getModelInfo(self, camera_id):
         """
         Returns the model of the camera
@@ -600,6 +705,7 @@ class HamamatsuCamera(object):
         else:
             return False
 
+    @profiler.timed('DCAM.newFrames')
     def newFrames(self):
         """
         Return a list of the ids of all the new frames since the last check.
@@ -673,6 +779,7 @@ class HamamatsuCamera(object):
 
         return new_frames
 
+    @profiler.timed('DCAM.setPropertyValue')
     def setPropertyValue(self, property_name, property_value):
         """
         Set the value of a property.
@@ -744,6 +851,7 @@ class HamamatsuCamera(object):
             raise DCAMException("Unrecognized acqusition mode: " + mode)
 
 
+    @profiler.timed('DCAM.startAcquisition')
     def startAcquisition(self):
         """
         Start data acquisition.
@@ -771,10 +879,12 @@ class HamamatsuCamera(object):
         elif self.acquisition_mode is "fixed_length":
             n_buffers = self.number_frames
         self.number_image_buffers = n_buffers
+        self.allocateMetadata(n_buffers)
         self.checkStatus(dcam.dcambuf_alloc(self.camera_handle,
                                             ctypes.c_int32(self.number_image_buffers)),
                          "dcambuf_alloc")
 
+    @profiler.timed('DCAM.stopAcquisition')
     def stopAcquisition(self):
         """
         Stop data acquisition.
@@ -841,6 +951,7 @@ class HamamatsuCameraMR(HamamatsuCamera):
 
         self.setPropertyValue("output_trigger_kind[0]", 2)
 
+    @profiler.timed('DCAM.getFrames')
     def getFrames(self):
         """
         Gets all of the available frames.
@@ -852,9 +963,12 @@ class HamamatsuCameraMR(HamamatsuCamera):
                be zero. Are frames getting dropped? Some sort of race condition?
         """
         frames = []
-        for n in self.newFrames():
+        new_frames = self.newFrames()
+        for n in new_frames:
+            self.lockFrame(n)
             frames.append(self.hcam_data[n])
 
+        self.checkFrameGaps(new_frames)
         return [frames, [self.frame_x, self.frame_y]]
 
     def startAcquisition(self):
@@ -891,6 +1005,8 @@ class HamamatsuCameraMR(HamamatsuCamera):
 
             self.old_frame_bytes = self.frame_bytes
 
+        self.allocateMetadata(self.number_image_buffers)
+
         # Attach image buffers and start acquisition.
         #
         # We need to attach & release for each acquisition otherwise
@@ -943,6 +1059,7 @@ class HamamatsuCameraMR(HamamatsuCamera):
 import kekse
 import numpy as np
 import logging
+import time
 from functools import partial
 from PyQt5 import QtCore, QtWidgets
 from PyQt5.QtCore import pyqtSignal
@@ -961,9 +1078,19 @@ class CamController(QtCore.QObject):
         self.status = 'Not_connected'  # 'Not_connected', 'Connected', 'Idle', 'Running'
         self.abort = False
         self.last_image = None
-        self.frame_height_px = self.config['image_shape'][1]
+        self.n_frames_requested = 0
+        self._sim_frame = None
+        self.last_metadata = np.zeros(0, dtype=FRAME_METADATA_DTYPE)
+        self.dropped_frames = 0
+        self.reducer = None
+        self.last_reduction = None
+        self.n_frames_collected = 0
+        self.frame_height_px = self.config['image_shape'][0]
         self.cam_voffset = 0
-        self.frame_readout_ms = 10.0
+        self.roi = (self.config['sensor_shape'][1], self.config['sensor_shape'][0], 0, 0, 1)  # hsize, vsize, hpos, vpos, bin
+        self._roi_timing_cache = {}
+        self.frame_readout_ms = self.roi_readout_ms(self.roi)
+        self.max_frame_rate_hz = self.roi_max_frame_rate(self.roi)
         self.trigger_in = self.config['trigger_in']
         self.trigger_out = self.config['trigger_out']
         self.logger = logging.getLogger(logger_name)
@@ -1014,6 +1141,7 @@ class CamController(QtCore.QObject):
 
     def set_exposure(self, exposure_ms):
         self.exposure_ms = exposure_ms
+        self.max_frame_rate_hz = self.roi_max_frame_rate(self.roi)
         self.setup()
         if self.gui_on:
             self.sig_update_gui.emit()
@@ -1124,6 +1252,102 @@ class CamController(QtCore.QObject):
             self.logger.error("Camera is not initialized!")
             self.last_image = np.random.randint(100, 200, size=self.config['image_shape'], dtype='uint16')
 
+    def start_acquisition(self, n_frames):
+        """Arm the camera for a fixed-length acquisition of n_frames (e.g. a stack), usually externally triggered.
+        Frames are retrieved by collect_frames()."""
+        self.setup()
+        self.n_frames_requested = int(n_frames)
+        self.n_frames_collected = 0
+        self.setup_reducer()
+        if self.config['simulation']:
+            self._sim_frame = np.random.randint(100, 200, size=self.config['image_shape'], dtype='uint16')
+            self.status = 'Running'
+        elif self.dev_handle is not None:
+            self.dev_handle.setACQMode("fixed_length", number_frames=self.n_frames_requested)
+            self.dev_handle.startAcquisition()
+            self.status = 'Running'
+        else:
+            self.logger.error("Camera is not initialized!")
+        if self.gui_on:
+            self.sig_update_gui.emit()
+
+    def setup_reducer(self):
+        """Create the frame reducer for the requested stack, if frame reduction is on."""
+        self._close_reducer()
+        if self.config['reduce_frames'] and self.n_frames_requested > 0:
+            self.reducer = FrameReducer(self.config['image_shape'], self.n_frames_requested,
+                                        crop=self.config['reduce_crop'],
+                                        binning=self.config['reduce_binning'],
+                                        projections=self.config['reduce_projections'],
+                                        workers=self.config['reduce_workers'])
+            self.logger.debug(f"Frame reduction {self.reducer.reduction_factor:.1f}x, "
+                              f"reduced shape {self.reducer.out_shape}")
+
+    @profiler.timed('Camera.collect_frames')
+    def collect_frames(self, n_frames=None, timeout_s=10.0):
+        """Wait until n_frames (default: all requested frames) are acquired, or timeout.
+        Returns list of 2D arrays. Their metadata (FRAME_METADATA_DTYPE records) is stored in self.last_metadata.
+        If frame reduction is on, frames are reduced while waiting for the next ones,
+        and the reduced stack and projections are stored in self.last_reduction after the last frame."""
+        if n_frames is None:
+            n_frames = self.n_frames_requested
+        images = []
+        metadata = []
+        if self.config['simulation']:
+            time.sleep(n_frames * self.exposure_ms / 1000.)
+            images = [self._sim_frame] * n_frames
+            self._reduce_frames(images)
+            sim_metadata = np.zeros(n_frames, dtype=FRAME_METADATA_DTYPE)
+            sim_metadata['frame_index'] = np.arange(n_frames)
+            sim_metadata['host_time_ns'] = time.perf_counter_ns() + np.arange(n_frames) * int(self.exposure_ms * 1e6)
+            sim_metadata['height'], sim_metadata['width'] = self._sim_frame.shape
+            metadata.append(sim_metadata)
+        elif self.dev_handle is not None:
+            t_end = time.time() + timeout_s
+            while len(images) < n_frames and time.time() < t_end and not self.abort:
+                [frames, dims] = self.dev_handle.getFrames()
+                new_images = [np.reshape(frame.getData(), dims) for frame in frames]
+                self._reduce_frames(new_images)
+                images.extend(new_images)
+                metadata.append(self.dev_handle.getMetadata())
+            if len(images) < n_frames:
+                self.logger.error(f"Acquired {len(images)} frames out of {n_frames}")
+            if self.dev_handle.dropped_frames > self.dropped_frames:
+                self.logger.warning(f"Dropped frames: {self.dev_handle.dropped_frames}, "
+                                    f"gaps (after frame, missing): {self.dev_handle.frame_gaps}")
+            self.dropped_frames = self.dev_handle.dropped_frames
+        else:
+            self.logger.error("Camera is not initialized!")
+        self.last_metadata = np.concatenate(metadata) if metadata else np.zeros(0, dtype=FRAME_METADATA_DTYPE)
+        if len(images) > 0:
+            self.last_image = images[-1]
+        if self.reducer is not None and self.n_frames_collected >= self.n_frames_requested:
+            self.last_reduction = self.reducer.finish()
+            self._close_reducer()
+        return images
+
+    def _reduce_frames(self, images):
+        if self.reducer is not None:
+            n = min(len(images), self.n_frames_requested - self.n_frames_collected)
+            self.reducer.submit_frames(images[:n], self.n_frames_collected)
+        self.n_frames_collected += len(images)
+
+    def _close_reducer(self):
+        """Shut down the worker threads of the reducer, the next stack gets a new one."""
+        if self.reducer is not None:
+            self.reducer.close()
+            self.reducer = None
+
+    def stop_acquisition(self):
+        self._close_reducer()
+        if self.config['simulation']:
+            self._sim_frame = None
+        elif self.dev_handle is not None:
+            self.dev_handle.stopAcquisition()
+        self.status = 'Idle'
+        if self.gui_on:
+            self.sig_update_gui.emit()
+
     def disconnect(self):
         """Close the connection to camera"""
         if self.dev_handle is not None:
@@ -1135,36 +1359,131 @@ class CamController(QtCore.QObject):
             self.logger.error("Camera already disconnected")
 
     def set_frame_height(self, new_height):
-        self.frame_height_px = int(new_height)
-        self.set_readout_time(new_height)
+        """Set a vertically centered ROI of new_height rows, keeping the ROI width and binning."""
+        hsize, _, hpos, _, binning = self.roi
+        step = self.config['roi_step_px'] * binning
+        self.set_roi(hsize, int(new_height) // step * step, hpos, None, binning)
+
+    def validate_roi(self, hsize, vsize, hpos=None, vpos=None, binning=1):
+        """Check the ROI against the sensor constraints. Position None centers the ROI on the sensor.
+        Returns ROI tuple (hsize, vsize, hpos, vpos, binning), raises ValueError if ROI is invalid."""
+        sensor_h, sensor_w = self.config['sensor_shape']
+        step = self.config['roi_step_px']
+        if hpos is None:
+            hpos = (sensor_w - hsize) // 2 // step * step
+        if vpos is None:
+            vpos = (sensor_h - vsize) // 2 // step * step
+        roi = tuple(int(v) for v in (hsize, vsize, hpos, vpos, binning))
+        hsize, vsize, hpos, vpos, binning = roi
+        if binning not in self.config['binning_options']:
+            raise ValueError(f"Binning {binning} not in {self.config['binning_options']}")
+        if any(v % step for v in (hsize, vsize, hpos, vpos)):
+            raise ValueError(f"ROI size and position must be multiples of {step} px: {roi}")
+        if hsize < self.config['roi_min_px'] or vsize < self.config['roi_min_px']:
+            raise ValueError(f"ROI size smaller than {self.config['roi_min_px']} px: {roi}")
+        if hpos < 0 or vpos < 0 or hpos + hsize > sensor_w or vpos + vsize > sensor_h:
+            raise ValueError(f"ROI outside of the sensor {self.config['sensor_shape']}: {roi}")
+        if hsize % (step * binning) or vsize % (step * binning):
+            raise ValueError(f"ROI size must be a multiple of {step * binning} px for binning {binning}: {roi}")
+        return roi
+
+    def roi_readout_ms(self, roi):
+        """Frame readout time of the ROI (cached), in Sync Readout mode.
+        The sensor is read out from the center towards top and bottom in parallel,
+        so the readout time is set by the ROI row farthest from the center."""
+        readout_ms = self._roi_timing_cache.get(roi)
+        if readout_ms is None:
+            hsize, vsize, hpos, vpos, binning = roi
+            center = self.config['sensor_shape'][0] / 2.0
+            n_rows = max(center - vpos, vpos + vsize - center)
+            readout_ms = (n_rows + 5) * self.config['line_time_ms']
+            self._roi_timing_cache[roi] = readout_ms
+        return readout_ms
+
+    def roi_max_frame_rate(self, roi, exposure_ms=None):
+        """Maximum frame rate (Hz) of the ROI at given exposure, frames can't be shorter than the readout."""
+        if exposure_ms is None:
+            exposure_ms = self.exposure_ms
+        return 1000. / max(exposure_ms, self.roi_readout_ms(roi))
+
+    def set_roi(self, hsize, vsize, hpos=None, vpos=None, binning=1):
+        """Set camera ROI and binning. Only the properties that change are written to the camera.
+        Position None centers the ROI on the sensor."""
+        try:
+            roi = self.validate_roi(hsize, vsize, hpos, vpos, binning)
+        except ValueError as e:
+            self.logger.error(f"set_roi(): {e}")
+            return
+        if self.dev_handle is not None:
+            self._write_roi(self.roi, roi)
+        elif not self.config['simulation']:
+            self.logger.error("Camera is not initialized!")
+            return
+        self._crop_last_image(self.roi, roi)
+        self.roi = roi
+        self.frame_height_px = roi[1]
+        self.cam_voffset = roi[3]
+        self.frame_readout_ms = self.roi_readout_ms(roi)
+        self.max_frame_rate_hz = self.roi_max_frame_rate(roi)
+        self.config['image_shape'] = (roi[1] // roi[4], roi[0] // roi[4])
+        self.logger.debug(f"ROI {roi}, readout {self.frame_readout_ms:.3f} ms, "
+                          f"max frame rate {self.max_frame_rate_hz:.1f} Hz")
         if self.gui_on:
             self.sig_update_gui.emit()
-        if self.dev_handle is not None:
-            self.cam_voffset = int((self.config['sensor_shape'][0] - self.frame_height_px) / 2.0)
-            img_voffset = int((self.last_image.shape[0] - self.frame_height_px) / 2.0)
-            self.dev_handle.setPropertyValue("subarray_vsize", self.frame_height_px)
-            self.dev_handle.setPropertyValue("subarray_vpos", self.cam_voffset)
-            if (img_voffset >= 0) and (img_voffset + self.frame_height_px < self.last_image.shape[0]):
-                self.last_image = self.last_image[img_voffset:(img_voffset + self.frame_height_px), :]
-            else:
-                self.last_image = np.random.randint(100, 200,
-                                              size=(self.frame_height_px, self.last_image.shape[1]), dtype='uint16')
-            #self.display_image(self.last_image, position=(0, cam_voffset))
-            self.logger.debug(f"New image dimensions {self.last_image.shape}")
-            v_pos = self.dev_handle.getPropertyValue("subarray_vpos")[0]
-            self.logger.debug(f"New subarray_vpos: {v_pos}")
+
+    def _write_roi(self, old, new):
+        """Write only the changed subarray properties. For each axis, the position is written first
+        if the ROI grows, otherwise the size is written first, so that the ROI never leaves the sensor."""
+        full = (self.config['sensor_shape'][1], self.config['sensor_shape'][0], 0, 0)
+        if new[:4] != full and old[:4] == full:
+            self.dev_handle.setPropertyValue("subarray_mode", "ON")
+        for i_size, i_pos, axis in ((0, 2, 'h'), (1, 3, 'v')):
+            writes = [(f"subarray_{axis}pos", i_pos), (f"subarray_{axis}size", i_size)]
+            if new[i_size] < old[i_size]:
+                writes.reverse()
+            for prop_name, i in writes:
+                if new[i] != old[i]:
+                    self.dev_handle.setPropertyValue(prop_name, new[i])
+        if new[4] != old[4]:
+            self.dev_handle.setPropertyValue("binning", new[4])
+        if new[:4] == full and old[:4] != full:
+            self.dev_handle.setPropertyValue("subarray_mode", "OFF")
+
+    def _crop_last_image(self, old, new):
+        """Crop the last image to the new ROI, if the new ROI lies within the old one."""
+        if self.last_image is None:
+            return
+        top = (new[3] - old[3]) // old[4]
+        left = (new[2] - old[2]) // old[4]
+        height, width = new[1] // new[4], new[0] // new[4]
+        if new[4] == old[4] and top >= 0 and left >= 0 and \
+                top + height <= self.last_image.shape[0] and left + width <= self.last_image.shape[1]:
+            self.last_image = self.last_image[top:top + height, left:left + width]
         else:
-            self.logger.error("Camera is not initialized!")
+            self.last_image = np.random.randint(100, 200, size=(height, width), dtype='uint16')
+
+    def add_roi_preset(self, name, hsize, vsize, hpos=None, vpos=None, binning=1):
+        """Store a validated ROI preset, and precompute its readout time."""
+        try:
+            roi = self.validate_roi(hsize, vsize, hpos, vpos, binning)
+        except ValueError as e:
+            self.logger.error(f"add_roi_preset(): {e}")
+            return
+        self.config['roi_presets'][name] = list(roi)
+        self.roi_readout_ms(roi)
+
+    def apply_roi_preset(self, name):
+        if name in self.config['roi_presets']:
+            self.set_roi(*self.config['roi_presets'][name])
+        else:
+            self.logger.error(f"ROI preset not found: {name}")
 
-    def set_readout_time(self, vsize):
-        """Compute the frame readout time based on its vertical extent.
-        Assuming triggered Sync Readout mode.
-        Parameters:
-            vsize: int
-                Number of rows in the frame (ROI).
-        """
-        h1 = 9.74436E-3  # 1-row readout time, ms
-        self.frame_readout_ms = ((vsize / 2.0) + 5) * h1
+    def roi_presets_by_speed(self, exposure_ms=None):
+        """Return list of (preset name, max frame rate Hz), fastest first."""
+        rates = []
+        for name, roi in self.config['roi_presets'].items():
+            rates.append((name, self.roi_max_frame_rate(self.validate_roi(*roi), exposure_ms)))
+        return sorted(rates, key=lambda x: -x[1])
 
     def update_config(self, key, value):
         if key in self.config.keys():
@@ -1200,8 +1519,25 @@ class CamController(QtCore.QObject):
                                    func=self.set_frame_height)
         self.gui.add_numeric_field('Readout time, ms', groupbox_name,
                                    value=self.frame_readout_ms,
-                                   vrange=[0, 10, 0.1],
+                                   vrange=[0, 100, 0.1],
                                    enabled=False)
+        self.gui.add_combobox('ROI preset', groupbox_name,
+                              items=list(self.config['roi_presets'].keys()),
+                              value=list(self.config['roi_presets'].keys())[0],
+                              func=self.apply_roi_preset)
+        self.gui.add_numeric_field('Max frame rate, Hz', groupbox_name,
+                                   value=self.max_frame_rate_hz,
+                                   vrange=[0, 1e5, 0.1],
+                                   enabled=False)
+
+        groupbox_name = 'Frame reduction'
+        self.gui.add_groupbox(title=groupbox_name, parent=tab_name)
+        self.gui.add_checkbox('Reduce frames', groupbox_name, self.config['reduce_frames'],
+                              func=partial(self.update_config, 'reduce_frames'))
+        self.gui.add_numeric_field('Binning', groupbox_name,
+                                   value=self.config['reduce_binning'],
+                                   vrange=[1, 16, 1],
+                                   func=lambda x: self.update_config('reduce_binning', int(x)))
 
         tab_name = 'Trigger IN'
         self.gui.add_checkbox('Trigger in', tab_name, self.trigger_in, func=self.setup_trig_in)
@@ -1230,6 +1566,8 @@ class CamController(QtCore.QObject):
     def _update_gui(self):
         self.gui.update_param('Status', self.status)
         self.gui.update_param('Readout time, ms', self.frame_readout_ms)
+        self.gui.update_param('Image height, px', self.frame_height_px)
+        self.gui.update_param('Max frame rate, Hz', self.max_frame_rate_hz)
 
 
 # run if the module is launched as a standalone program
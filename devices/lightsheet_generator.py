@@ -1,12 +1,17 @@
 '''This is class for generating triggered AO waveforms.
 The AO task listens to the input TTL pulse (eg from camera) and generates
 short finite AO waveform to synchronously move galvo and turn on the laser.
+Alternatively, in streaming mode the AO task runs continuously, and long non-repeating waveforms
+are computed chunk by chunk while playing (e.g. slow galvo offset or laser power ramps during a time-lapse).
 Copyright @nvladimus, 2020
 '''
 
 from PyQt5 import QtCore, QtWidgets
 import sys
 import logging
+import queue
+import threading
+import time
 import numpy as np
 import PyDAQmx as pd
 import ctypes as ct
@@ -16,19 +21,25 @@ from functools import partial
 
 config = {
     'swipe_duration_ms': 1.0,
+    'laser_delay_ms': 0.2,  # laser onset after the galvo ramp start, for galvo inertia
     'L-galvo_offsets_volts': -0.30,
     'R-galvo_offsets_volts': 0.47,
     'L-galvo_amp_volts': 0.50,
     'R-galvo_amp_volts': 0.50,
     'laser_max_volts': 5.0,
     'laser_pow_volts': 5.0,
+    'arm_switch_source': 'arduino',  # 'daq': left/right waveforms alternate in the AO buffer, 'arduino': switcher board
     'arduino_switcher_port': 'COM6', # set None is no arduino board is used.
     'active_arm': 'left',
     'switch_auto': True,
     'switch_every_n_pulses': 100,
     'DAQ_trig_in_ch': '/Dev1/PFI0',
     'DAQ_AO_ch': '/Dev1/ao0:1',
-    'DAQ_sample_rate_Hz': 20000
+    'DAQ_sample_rate_Hz': 20000,
+    # streaming mode block
+    'stream_chunk_samples': 4000,  # samples per channel in one chunk
+    'stream_n_buffers': 2,  # chunks computed ahead of the DAQ
+    'stream_write_timeout_s': 10.0
 }
 
 logging.basicConfig()
@@ -43,6 +54,12 @@ class LightsheetGenerator(QtCore.QObject):
         self.daqmx_task = self.serial_arduino = None
         self.initialized = False
         self.status = "OFF"
+        self.streaming = False
+        self._stream_threads = []
+        self._stream_stop = threading.Event()
+        self._stream_lock = threading.Lock()  # the stream is ended once, by the writer or by stop_stream()
+        self.stream_samples_written = 0
+        self.stream_errors = 0
         # logger setup
         self.logger_name = logger_name
         self.logger = logging.getLogger(logger_name)
@@ -56,7 +73,7 @@ class LightsheetGenerator(QtCore.QObject):
             self.sig_update_gui.connect(self._update_gui)
 
     def initialize(self):
-        if self.config['arduino_switcher_port']:
+        if self.config['arm_switch_source'] == 'arduino' and self.config['arduino_switcher_port']:
             self.connect_arduino(self.config['arduino_switcher_port'])
             self.setup_arduino()
         self.create_daqmx_task()
@@ -114,6 +131,8 @@ class LightsheetGenerator(QtCore.QObject):
     def setup_arduino(self):
         """"Send the galvo bias values and N(frames per stack) to the Arduino switcher that flips the galvo bias
         every N input pulses"""
+        if self.config['arm_switch_source'] != 'arduino':
+            return
         # automatic switching mode
         if self.config['switch_auto']:
             if self.serial_arduino:
@@ -139,17 +158,25 @@ class LightsheetGenerator(QtCore.QObject):
     def setup_ls(self):
         """Set up the lightsheet DAQmx task. """
         assert self.config['laser_pow_volts'] <= self.config['laser_max_volts'], 'Laser voltage too high'
+        if self.streaming:
+            self.logger.error("setup_ls(): AO streaming is running, stop it first")
+            return
         if self.daqmx_task:
             try:
                 if self.config['active_arm'] == 'left':
                     offset, amp = self.config['L-galvo_offsets_volts'], self.config['L-galvo_amp_volts']
+                    other_offset = self.config['R-galvo_offsets_volts']
                 else:
                     offset, amp = self.config['R-galvo_offsets_volts'], self.config['R-galvo_amp_volts']
+                    other_offset = self.config['L-galvo_offsets_volts']
+                daq_switching = self.config['switch_auto'] and self.config['arm_switch_source'] == 'daq'
                 self.task_config(wf_duration_ms=self.config['swipe_duration_ms'],
-                                 galvo_offset_V=offset * (not self.config['switch_auto']),
+                                 galvo_offset_V=offset * (not self.config['switch_auto'] or daq_switching),
                                  galvo_amplitude_V=amp,
                                  laser_amplitude_V=self.config['laser_pow_volts'],
-                                 galvo_inertia_ms=0.2)
+                                 galvo_inertia_ms=self.config['laser_delay_ms'],
+                                 switch_offset_V=other_offset if daq_switching else None,
+                                 switch_every_n=int(self.config['switch_every_n_pulses']))
                 self.logger.info('DAQmx AO task configured.')
                 self.status = "ON"
                 if self.gui_on: self.sig_update_gui.emit()
@@ -159,8 +186,9 @@ class LightsheetGenerator(QtCore.QObject):
         else:
             self.logger.error("DAQmx task is None")
 
+    @kekse.profiler.timed('Lightsheet.task_config')
     def task_config(self, wf_duration_ms, galvo_offset_V, galvo_amplitude_V, laser_amplitude_V,
-                    galvo_inertia_ms=0.20):
+                    galvo_inertia_ms=0.20, switch_offset_V=None, switch_every_n=1):
         """Configuration and automatic restart of light-sheet generation DAQmx AO task.
         Channels:
             ao0, galvo
@@ -172,8 +200,12 @@ class LightsheetGenerator(QtCore.QObject):
             galvo_amplitude_V
             laser_amplitude_V.
             galvo_inertia_ms, delay in laser onset after galvo, to accomodate galvo inertia.
+            switch_offset_V, galvo offset of the other arm. If given, the AO buffer holds switch_every_n waveforms
+                with galvo_offset_V, followed by switch_every_n waveforms with switch_offset_V. Each trigger
+                generates one waveform and advances through the buffer, so the arms alternate every switch_every_n
+                triggers, without a switcher board. Restarting the task starts again from the first arm.
         """
-        samples_per_ch = np.int(self.config['DAQ_sample_rate_Hz'] / 1000. * wf_duration_ms)
+        samples_per_ch = int(self.config['DAQ_sample_rate_Hz'] / 1000. * wf_duration_ms)
         self.daqmx_task.StopTask()
         self.daqmx_task.CfgSampClkTiming("", self.config['DAQ_sample_rate_Hz'],
                                          pd.DAQmx_Val_Rising, pd.DAQmx_Val_FiniteSamps, samples_per_ch)
@@ -192,15 +224,179 @@ class LightsheetGenerator(QtCore.QObject):
         wf_laser[laser_delay_samples:-1] = laser_amplitude_V  # laser wf must end with zero for safety reasons.
         # combine
         wform2D = np.column_stack((wf_galvo, wf_laser))
+        if switch_offset_V is not None:
+            n = max(int(switch_every_n), 1)
+            wf_other = wform2D.copy()
+            wf_other[:, 0] += switch_offset_V - galvo_offset_V
+            wform2D = np.concatenate((np.tile(wform2D, (n, 1)), np.tile(wf_other, (n, 1))))
+        n_buffer = wform2D.shape[0]
+        self.daqmx_task.CfgOutputBuffer(n_buffer)
         # write to buffer
         samples_per_ch_ct = ct.c_int32()
-        samples_per_ch_ct.value = samples_per_ch
-        self.daqmx_task.WriteAnalogF64(samples_per_ch, False, 10, pd.DAQmx_Val_GroupByScanNumber,
-                            wform2D, ct.byref(samples_per_ch_ct), None)
+        samples_per_ch_ct.value = n_buffer
+        self.daqmx_task.WriteAnalogF64(n_buffer, False, 10, pd.DAQmx_Val_GroupByScanNumber,
+                                       np.ascontiguousarray(wform2D), ct.byref(samples_per_ch_ct), None)
         # restart the task
         self.daqmx_task.StartTask()
 
+    def start_stream(self, fill_func):
+        """Start continuous AO generation of a waveform computed chunk by chunk.
+        A producer thread computes the chunks into preallocated buffers (stream_n_buffers ahead),
+        a writer thread writes them to the DAQ buffer, the DAQ is not allowed to regenerate old samples.
+        Parameters:
+            :param fill_func: function reference
+                fill_func(start_sample, out) fills the (stream_chunk_samples, 2) array out with (galvo, laser) volts
+                for samples starting at start_sample, and returns the number of valid samples.
+                Fewer samples than the chunk size end the waveform. See swipe_stream().
+        """
+        if self.daqmx_task is None:
+            self.logger.error("DAQmx task is None")
+            return
+        if self.streaming:
+            self.stop_stream()
+        n = int(self.config['stream_chunk_samples'])
+        n_buffers = int(self.config['stream_n_buffers'])
+        buffers = [np.zeros((n, 2)) for _ in range(n_buffers + 1)]
+        free, filled = queue.Queue(), queue.Queue()
+        for buf in buffers:
+            free.put(buf)
+        try:
+            self.daqmx_task.StopTask()
+            self.daqmx_task.CfgSampClkTiming("", self.config['DAQ_sample_rate_Hz'],
+                                             pd.DAQmx_Val_Rising, pd.DAQmx_Val_ContSamps, n * n_buffers)
+            self.daqmx_task.CfgOutputBuffer(n * n_buffers)  # task_config() sized it for one triggered waveform
+            self.daqmx_task.SetTrigAttribute(pd.DAQmx_StartTrig_Retriggerable, False)
+            self.daqmx_task.DisableStartTrig()
+            self.daqmx_task.SetWriteRegenMode(pd.DAQmx_Val_DoNotAllowRegen)
+        except pd.DAQException as e:
+            self.logger.error(f"Config DAQmx streaming: {e.message}")
+            return
+        self._stream_stop.clear()
+        self.stream_samples_written = self.stream_errors = 0
+        self.streaming = True
+        self._stream_threads = [threading.Thread(target=self._stream_producer, args=(fill_func, free, filled),
+                                                 daemon=True),
+                                threading.Thread(target=self._stream_writer, args=(free, filled), daemon=True)]
+        for thread in self._stream_threads:
+            thread.start()
+        self.status = "STREAMING"
+        self.logger.info(f"AO streaming started, chunk {n} samples, {n_buffers} buffers")
+        if self.gui_on:
+            self.sig_update_gui.emit()
+
+    def _stream_producer(self, fill_func, free, filled):
+        start = 0
+        while not self._stream_stop.is_set():
+            try:
+                buf = free.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            try:
+                n_valid = int(fill_func(start, buf))
+            except Exception as e:
+                self.logger.error(f"Streaming waveform error: {e}")
+                n_valid = 0
+            # laser off and galvo at rest after the last sample
+            buf[n_valid:] = 0
+            filled.put((buf, n_valid))
+            start += n_valid
+            if n_valid < len(buf):
+                break
+        filled.put((None, 0))
+
+    def _write_chunk(self, buf):
+        n_written = ct.c_int32()
+        self.daqmx_task.WriteAnalogF64(len(buf), False, self.config['stream_write_timeout_s'],
+                                       pd.DAQmx_Val_GroupByScanNumber, buf, ct.byref(n_written), None)
+
+    def _stream_writer(self, free, filled):
+        n_chunks, started = 0, False
+        while True:
+            buf, n_valid = filled.get()
+            if buf is None:
+                break
+            try:
+                if self._stream_stop.is_set():
+                    # stopped by user: laser off and galvo at rest before the task stops
+                    buf[:] = 0
+                    n_valid = 0
+                self._write_chunk(buf)
+                n_chunks += 1
+                self.stream_samples_written += n_valid
+                # the whole DAQ buffer is filled before the start, the writes then wait for free space
+                if not started and n_chunks == self.config['stream_n_buffers']:
+                    self.daqmx_task.StartTask()
+                    started = True
+            except pd.DAQException as e:
+                self.stream_errors += 1
+                self.logger.error(f"Streaming write error (buffer underflow?): {e.message}")
+                break
+            finally:
+                free.put(buf)
+            if n_valid < len(buf):
+                break
+        if not started and n_chunks > 0:
+            self.daqmx_task.StartTask()
+        # let the buffered samples play out, the last ones are zeros
+        time.sleep(self.config['stream_chunk_samples'] * self.config['stream_n_buffers'] /
+                   self.config['DAQ_sample_rate_Hz'])
+        self.logger.info(f"AO streaming finished, {self.stream_samples_written} samples, {self.stream_errors} errors")
+        if not self._stream_stop.is_set():  # waveform ended, else stop_stream() ends the stream
+            self._end_stream(restore=True)
+
+    def _end_stream(self, restore):
+        """Stop the continuous task, allow regeneration again, and restore the triggered light-sheet mode."""
+        with self._stream_lock:
+            if not self.streaming:
+                return
+            self.streaming = False
+            if self.daqmx_task is not None:
+                try:
+                    self.daqmx_task.StopTask()
+                    self.daqmx_task.SetWriteRegenMode(pd.DAQmx_Val_AllowRegen)
+                except pd.DAQException as e:
+                    self.logger.error(f"Stop streaming: {e.message}")
+            self.status = "STREAM DONE"
+            if restore and self.daqmx_task is not None:
+                self.setup_ls()  # status "ON" when the triggered mode is back
+        if self.gui_on:
+            self.sig_update_gui.emit()
+
+    def stop_stream(self, restore=True):
+        """Stop the stream after the chunks already in the DAQ buffer, and restore the triggered
+        light-sheet mode if restore is True."""
+        self._stream_stop.set()
+        for thread in self._stream_threads:
+            thread.join(timeout=self.config['stream_write_timeout_s'] + 1)
+        self._stream_threads = []
+        self._end_stream(restore)
+
+    def swipe_stream(self, duration_s, swipe_period_ms, galvo_amplitude_V, galvo_offset_V=(0.0, 0.0),
+                     laser_V=(0.0, 0.0)):
+        """Make a fill_func for start_stream(): continuous galvo sawtooth with laser on,
+        galvo offset and laser power changing linearly from the first to the second value over duration_s.
+        Samples are computed from their index, the full waveform is never held in memory."""
+        rate = self.config['DAQ_sample_rate_Hz']
+        n_total = int(duration_s * rate)
+        period = max(int(swipe_period_ms * rate / 1000.), 2)
+        assert max(laser_V) <= self.config['laser_max_volts'], 'Laser voltage too high'
+        index = np.arange(self.config['stream_chunk_samples'])
+
+        def fill(start, out):
+            n = max(min(len(out), n_total - start), 0)
+            i = index[:n] + start
+            ramp = i / max(n_total - 1, 1)
+            phase = (i % period) / (period - 1)
+            out[:n, 0] = galvo_offset_V[0] + (galvo_offset_V[1] - galvo_offset_V[0]) * ramp + \
+                galvo_amplitude_V * (phase - 0.5)
+            out[:n, 1] = laser_V[0] + (laser_V[1] - laser_V[0]) * ramp
+            return n
+        return fill
+
     def update_config(self, key, value):
+        if self.streaming:
+            self.logger.error(f"update_config(): AO streaming is running, {key} not changed")
+            return
         if key in self.config.keys():
             self.config[key] = value
             self.logger.debug(f'{key}: {value}')
@@ -224,6 +420,10 @@ class LightsheetGenerator(QtCore.QObject):
                                    value=self.config['swipe_duration_ms'],
                                    vrange=[0.1, 100, 0.1],
                                    func=partial(self.update_config, 'swipe_duration_ms'))
+        self.gui.add_numeric_field('Laser delay, ms', tab_name,
+                                   value=self.config['laser_delay_ms'],
+                                   vrange=[0, 100, 0.01],
+                                   func=partial(self.update_config, 'laser_delay_ms'))
         self.gui.add_numeric_field('L-arm galvo offset', tab_name,
                                    value=self.config['L-galvo_offsets_volts'],
                                    vrange=[-10, 10, 0.01],
@@ -252,9 +452,14 @@ class LightsheetGenerator(QtCore.QObject):
                                    value=self.config['switch_every_n_pulses'],
                                    vrange=[0, 10000, 1],
                                    func=partial(self.update_config, 'switch_every_n_pulses'))
+        self.gui.add_combobox('Switching by', tab_name,
+                              value=self.config['arm_switch_source'],
+                              items=['arduino', 'daq'],
+                              func=partial(self.update_config, 'arm_switch_source'))
         self.gui.add_checkbox('Auto-switching', tab_name,
                               value=self.config['switch_auto'],
                               func=partial(self.update_config, 'switch_auto'))
+        self.gui.add_button('Stop streaming', tab_name, lambda: self.stop_stream())
         self.gui.add_button('Disconnect', tab_name, lambda: self.close())
 
         tab_name = 'DAQ settings'
@@ -270,6 +475,8 @@ class LightsheetGenerator(QtCore.QObject):
         self.gui.update_param('Active arm', self.config['active_arm'])
         self.gui.update_param('Switch every N pulses', self.config['switch_every_n_pulses'])
         self.gui.update_param('Status', self.status)
+        self.gui.update_param('Swipe duration', self.config['swipe_duration_ms'])
+        self.gui.update_param('Laser delay, ms', self.config['laser_delay_ms'])
 
 
 # run if the module is launched as a standalone program
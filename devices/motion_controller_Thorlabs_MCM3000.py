@@ -8,6 +8,10 @@ Copyright Nikita Vladimirov, @nvladimus 2020
 import serial
 import struct
 import sys
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
 import kekse
 from PyQt5 import QtCore, QtWidgets
 from PyQt5.QtCore import pyqtSignal
@@ -34,9 +38,21 @@ class MotionController(QtCore.QObject):
         self.um_per_count = None
         self.step_size_um = 100
         self.target_um = 0.0
+        # move settle detection: encoder read in background, move is settled after N samples within tolerance
+        self.settle_tolerance_um = 0.5
+        self.settle_samples = 5
+        self.settle_timeout_s = 10.0
+        self.reader_period_s = 0.002
+        self.encoder_log = deque(maxlen=10000)  # (time.perf_counter(), encoder count) from the reader
+        self._ser_lock = threading.Lock()  # one transaction at a time, reader and commands share the port
+        self._reader_thread = None
+        self._reader_continuous = False  # reader runs until stop_reader(), not only while a move settles
+        self._reader_stop = threading.Event()
+        self._settle = None  # (target count, future, samples within tolerance, deadline) of the pending move
+        self._settle_lock = threading.Lock()
         self.set_stage_model(self.model_stage)
         # GUI
-        self.gui = kekse.ProtoKeks(self.model_controller)
+        self.gui = kekse.ProtoKeks(self.model_controller, workers=1)
         self._setup_gui()
         # signals
         self.sig_update_gui.connect(self._update_gui)
@@ -75,6 +91,7 @@ class MotionController(QtCore.QObject):
             print("Error:" + str(e) + "\n")
         self.set_ini_position()
 
+    @kekse.profiler.timed('MCM3000.get_current_position')
     def get_current_position(self, unit='count', echo=False):
         """Get the current reading of encoder position.
         Parameters
@@ -83,22 +100,7 @@ class MotionController(QtCore.QObject):
 
         Note: encoder values can be only positive. Negative values are forbidden in this controller.
         """
-        command = b'\x0A\x04\x00\x00\x00\x00'
-        try:
-            self.__ser_object.flushInput()
-            self.__ser_object.flushOutput()
-            self.__ser_object.write(command)
-        except Exception as e:
-            print("Error:" + str(e) + "\n")
-        try:
-            response = self.__ser_object.read(size=12)
-            if echo:
-                print('response: ' + str(response) + '\n')
-            if response[:6] == b'\x0B\x04\x06\x00\x00\x00':
-                self.position_encoder = int.from_bytes(response[-4:], 'little')
-                self.position_um = self.__counts2um(self.position_encoder - self.encoder_offset)
-        except Exception as e:
-            print("Error:" + str(e) + "\n")
+        self._read_encoder(echo)
         if unit == 'count':
             pos = self.position_encoder
         else:
@@ -106,6 +108,116 @@ class MotionController(QtCore.QObject):
         self.sig_update_gui.emit()
         return pos
 
+    def _read_encoder(self, echo=False, verbose=True):
+        """Read the encoder and update the position. Returns encoder count, None if the reading failed.
+        Errors are printed if verbose."""
+        command = b'\x0A\x04\x00\x00\x00\x00'
+        with self._ser_lock:
+            try:
+                self.__ser_object.flushInput()
+                self.__ser_object.flushOutput()
+                self.__ser_object.write(command)
+                response = self.__ser_object.read(size=12)
+                if echo:
+                    print('response: ' + str(response) + '\n')
+                if response[:6] == b'\x0B\x04\x06\x00\x00\x00':
+                    self.position_encoder = int.from_bytes(response[-4:], 'little')
+                    self.position_um = self.__counts2um(self.position_encoder - self.encoder_offset)
+                    return self.position_encoder
+            except Exception as e:
+                if verbose:
+                    print("Error:" + str(e) + "\n")
+        return None
+
+    def start_reader(self, period_s=None):
+        """Read the encoder in a background thread every period_s, into encoder_log, until stop_reader().
+        Without start_reader(), the reader runs only while a move is settling."""
+        if period_s is not None:
+            self.reader_period_s = period_s
+        self._start_reader(continuous=True)
+
+    def _start_reader(self, continuous):
+        with self._settle_lock:
+            self._reader_continuous = self._reader_continuous or continuous
+            if self._reader_thread is not None:
+                return
+            self._reader_stop.clear()
+            self._reader_thread = threading.Thread(target=self._reader_loop, name='MCM3000 reader', daemon=True)
+            self._reader_thread.start()
+
+    def stop_reader(self):
+        with self._settle_lock:
+            self._reader_continuous = False
+            thread = self._reader_thread
+        if thread is not None:
+            self._reader_stop.set()
+            thread.join()
+
+    def _reader_loop(self):
+        t_next = time.perf_counter()
+        error_printed = False
+        while True:
+            count = self._read_encoder(verbose=False)
+            t_now = time.perf_counter()
+            if count is not None:
+                self.encoder_log.append((t_now, count))
+                error_printed = False
+            elif not error_printed:  # once per series of failed readings
+                print("Error: encoder reading failed\n")
+                error_printed = True
+            with self._settle_lock:
+                if self._settle is not None:
+                    self._settle = self._update_settle(count, t_now, *self._settle)
+                stopped = self._reader_stop.is_set()
+                if stopped or (self._settle is None and not self._reader_continuous):
+                    # cleared under the same lock, so a new move starts a new reader
+                    self._reader_thread = None
+                    if stopped and self._settle is not None:
+                        self._settle[1].set_exception(RuntimeError("Encoder reader stopped before the move settled"))
+                        self._settle = None
+                    break
+            t_next += self.reader_period_s
+            self._reader_stop.wait(max(t_next - time.perf_counter(), 0))
+
+    def _settle_expired(self, future):
+        with self._settle_lock:
+            if future.done():
+                return
+            if self._settle is not None and self._settle[1] is future:
+                self._settle = None
+            future.set_exception(TimeoutError(f"Move not settled in {self.settle_timeout_s} s, no encoder reading"))
+
+    def _update_settle(self, count, t_now, target, future, n_within, deadline):
+        """Resolve the move future if settled or timed out. Returns the new settle state."""
+        if count is not None and abs(count - target) * self.um_per_count <= self.settle_tolerance_um:
+            n_within += 1
+        else:
+            n_within = 0
+        if n_within >= self.settle_samples:
+            future.set_result(self.__counts2um(count - self.encoder_offset))
+            return None
+        if t_now > deadline:
+            future.set_exception(TimeoutError(f"Move not settled in {self.settle_timeout_s} s, "
+                                              f"position {count}, target {target} counts"))
+            return None
+        return target, future, n_within, deadline
+
+    def _watch_move(self, target_count):
+        """Future of the move to target_count, resolved with the position (um) when settled."""
+        future = Future()
+        future.set_running_or_notify_cancel()
+        with self._settle_lock:
+            if self._settle is not None:  # superseded by the new move
+                self._settle[1].set_exception(RuntimeError("Move superseded by a new move"))
+            self._settle = (target_count, future, 0, time.perf_counter() + self.settle_timeout_s)
+        # the reader times the move out too, this only fires if no reading comes at all
+        timer = threading.Timer(self.settle_timeout_s + 1.0, self._settle_expired, args=(future,))
+        timer.daemon = True
+        timer.start()
+        future.add_done_callback(lambda f: timer.cancel())
+        self._start_reader(continuous=False)
+        return future
+
     def set_port(self, port, echo=False):
         self.port = port
         if echo:
@@ -123,23 +235,33 @@ class MotionController(QtCore.QObject):
             print("Error:" + str(e) + "\n")
 
     def move_abs(self, pos_um=0):
+        """Move to pos_um. Returns Future resolved with the position (um) when the move settled."""
         distance_um = pos_um - self.get_current_position('um')
-        self.move_rel(distance_um)
+        return self.move_rel(distance_um)
 
+    @kekse.profiler.timed('MCM3000.move_rel')
     def move_rel(self, pos_um, echo=False):
+        """Move by pos_um. Returns Future resolved with the position (um) when the move settled:
+        the controller doesn't report motor status, so the encoder is read in a background thread until then,
+        and the move is settled when settle_samples readings in a row are within settle_tolerance_um of the target.
+        Chain moves with move_rel(step).result()."""
         self.position_encoder = self.get_current_position('count')
         counts_int = self.position_encoder + self.__um2counts(pos_um)
         if echo:
             print('New target (encoder counts):' + str(counts_int) + '\n')
         counts_binary = struct.pack("<l", counts_int)
         command = b'\x53\x04\x06\x00\x00\x00\x00\x00' + counts_binary
-        try:
-            self.__ser_object.flushInput()
-            self.__ser_object.flushOutput()
-            self.__ser_object.write(command)
-            # motor status should be polled here, but it's not implemented by Thorlabs.
-        except Exception as e:
-            print("Error:" + str(e) + "\n")
+        with self._ser_lock:
+            try:
+                self.__ser_object.flushInput()
+                self.__ser_object.flushOutput()
+                self.__ser_object.write(command)
+            except Exception as e:
+                print("Error:" + str(e) + "\n")
+                future = Future()
+                future.set_exception(e)
+                return future
+        return self._watch_move(counts_int)
 
     def is_axis_busy(self):
         """Dummy placeholder, this function is not implemented by Thorlabs"""
@@ -158,12 +280,13 @@ class MotionController(QtCore.QObject):
 
     def stop(self):
         command = b'\x65\x04\x00\x01\x00\x00'
-        try:
-            self.__ser_object.flushInput()
-            self.__ser_object.flushOutput()
-            self.__ser_object.write(command)
-        except Exception as e:
-            print("Error:" + str(e) + "\n")
+        with self._ser_lock:
+            try:
+                self.__ser_object.flushInput()
+                self.__ser_object.flushOutput()
+                self.__ser_object.write(command)
+            except Exception as e:
+                print("Error:" + str(e) + "\n")
 
     def __um2counts(self, micron):
         return int(micron / self.um_per_count)
@@ -219,6 +342,7 @@ class MotionController(QtCore.QObject):
         self.gui.update_param('Position, um', self.position_um)
 
     def close(self):
+        self.stop_reader()
         try:
             self.__ser_object.close()
             if not self.__ser_object.open():
@@ -0,0 +1,184 @@
+"""
+Multi-axis motion coordinator: XY on the ASI MS2000 stage (mm) and Z on the Thorlabs MCM3000 (um),
+exposed as one position vector (x, y, z) in um. Moves of the two controllers are issued in parallel,
+so a 3D move takes the time of the slowest axis, not the sum.
+Devices are passed in by their role, add_device('xy', asi_stage), add_device('z', mcm3000).
+To launch as a standalone app, run `python motion_coordinator.py`.
+"""
+import logging
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import numpy as np
+import kekse
+from PyQt5 import QtCore, QtWidgets
+
+config = {
+    'xy_units_um': 1000.0,  # um per unit of the XY stage (mm)
+    'position_tolerance_um': 0.5,  # axes closer than this to the target are not moved
+    'z_settle_tolerance_um': 0.5,  # Z move is done when the position is this close to the target
+    'z_poll_s': 0.01,  # Z position polling interval, if the Z device does not return a future of the move
+    'z_timeout_s': 10.0
+}
+logging.basicConfig()
+
+
+class MotionCoordinator(QtCore.QObject):
+    sig_update_gui = QtCore.pyqtSignal()
+
+    def __init__(self, dev_name='Motion coordinator', gui_on=True, logger_name='MotionCoordinator'):
+        super().__init__()
+        self.config = config
+        self.devices = {}
+        self.position_um = np.full(3, np.nan)
+        self.target_um = np.zeros(3)
+        self.last_move_s = {}  # duration of the last move per axis group, and in total
+        self._executor = ThreadPoolExecutor(max_workers=2)
+        # logger setup
+        self.logger_name = logger_name
+        self.logger = logging.getLogger(logger_name)
+        self.logger.setLevel(logging.DEBUG)
+        # GUI setup
+        self.gui_on = gui_on
+        if self.gui_on:
+            self.logger.info("GUI activated")
+            self.gui = kekse.ProtoKeks(dev_name)
+            self._setup_gui()
+            self.sig_update_gui.connect(self._update_gui)
+
+    def add_device(self, role, device):
+        """Register a device under its role: 'xy' (ASI MS2000 stage) or 'z' (Thorlabs MCM3000)."""
+        assert role in ('xy', 'z'), f"Unknown role: {role}"
+        self.devices[role] = device
+        self.logger.info(f"{role}: {type(device).__name__}")
+
+    def _get_xy(self):
+        stage = self.devices['xy']
+        stage.get_position()
+        return np.array([stage.position_x_mm, stage.position_y_mm]) * self.config['xy_units_um']
+
+    def _get_z(self):
+        return float(self.devices['z'].get_current_position('um'))
+
+    def get_position(self):
+        """Read all axes (in parallel). Returns array (x, y, z) in um, NaN for axes without device."""
+        futures = {}
+        if 'xy' in self.devices:
+            futures['xy'] = self._executor.submit(self._get_xy)
+        if 'z' in self.devices:
+            futures['z'] = self._executor.submit(self._get_z)
+        position = np.full(3, np.nan)
+        if 'xy' in futures:
+            position[:2] = futures['xy'].result()
+        if 'z' in futures:
+            position[2] = futures['z'].result()
+        self.position_um = position
+        if self.gui_on:
+            self.sig_update_gui.emit()
+        return position
+
+    def _move_xy(self, xy_um):
+        t_start = time.perf_counter()
+        self.devices['xy'].move_abs(tuple(np.asarray(xy_um) / self.config['xy_units_um']))
+        return time.perf_counter() - t_start
+
+    def _move_z(self, z_um):
+        t_start = time.perf_counter()
+        device = self.devices['z']
+        move = device.move_abs(z_um)
+        if hasattr(move, 'result'):  # settle detected by the device
+            try:
+                move.result(timeout=self.config['z_timeout_s'])
+            except Exception as e:
+                self.logger.error(f"Z move to {z_um:.2f} um: {e}")
+            return time.perf_counter() - t_start
+        t_end = t_start + self.config['z_timeout_s']
+        while abs(device.get_current_position('um') - z_um) > self.config['z_settle_tolerance_um']:
+            if time.perf_counter() > t_end:
+                self.logger.error(f"Z move to {z_um:.2f} um timed out")
+                break
+            time.sleep(self.config['z_poll_s'])
+        return time.perf_counter() - t_start
+
+    def move_abs(self, position_um, wait=True):
+        """
+        Move to position (x, y, z) in um, all controllers in parallel.
+        Parameters:
+            :param position_um: array-like of 3 values, None (or NaN) for an axis that should not move
+            :param wait: bool
+                If True, return when all axes arrived, else return the futures of the moves.
+        Returns the new position (array, um) if wait, else dict of futures by role.
+        """
+        assert len(position_um) == 3, "move_abs(): position_um should be 3-element array-like"
+        target = np.array([np.nan if p is None else p for p in position_um], dtype=float)
+        current = self.position_um
+        if np.any(np.isnan(current[~np.isnan(target)])):
+            current = self.get_position()
+        self.target_um = np.where(np.isnan(target), current, target)
+        to_move = ~np.isnan(target) & (np.abs(target - current) > self.config['position_tolerance_um'])
+        t_start = time.perf_counter()
+        futures = {}
+        if 'xy' in self.devices and np.any(to_move[:2]):
+            futures['xy'] = self._executor.submit(self._move_xy, self.target_um[:2])
+        if 'z' in self.devices and to_move[2]:
+            futures['z'] = self._executor.submit(self._move_z, self.target_um[2])
+        if not wait:
+            return futures
+        self.last_move_s = {role: future.result() for role, future in futures.items()}
+        self.last_move_s['total'] = time.perf_counter() - t_start
+        self.logger.debug(f"move to {self.target_um} um: " +
+                          ", ".join(f"{role} {1000 * t:.1f} ms" for role, t in self.last_move_s.items()))
+        return self.get_position()
+
+    def move_rel(self, distance_um, wait=True):
+        """Move by distance (dx, dy, dz) in um, see move_abs()."""
+        assert len(distance_um) == 3, "move_rel(): distance_um should be 3-element array-like"
+        if np.any(np.isnan(self.position_um)):
+            self.get_position()
+        return self.move_abs(self.position_um + np.asarray(distance_um, dtype=float), wait)
+
+    def set_target(self, axis, value_um):
+        self.target_um[axis] = value_um
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+
+    def update_config(self, key, value):
+        if key in self.config.keys():
+            self.config[key] = value
+            self.logger.info(f"changed {key} to {value}")
+        else:
+            self.logger.error("Parameter name not found in config file")
+        if self.gui_on:
+            self.sig_update_gui.emit()
+
+    def _setup_gui(self):
+        groupbox_name = 'Position'
+        self.gui.add_groupbox(groupbox_name)
+        for name in 'XYZ':
+            self.gui.add_numeric_field(f'{name} pos., um', groupbox_name, value=0,
+                                       vrange=[-1e6, 1e6, 0.01], enabled=False)
+        self.gui.add_button('Update position', groupbox_name, func=self.get_position)
+        groupbox_name = 'Move'
+        self.gui.add_groupbox(groupbox_name)
+        for axis, name in enumerate('XYZ'):
+            self.gui.add_numeric_field(f'Target {name}, um', groupbox_name, value=0,
+                                       vrange=[-1e6, 1e6, 0.01], func=partial(self.set_target, axis))
+        self.gui.add_button('Move to target', groupbox_name, func=lambda: self.move_abs(self.target_um))
+        self.gui.add_numeric_field('Last move, ms', groupbox_name, value=0, vrange=[0, 1e6, 0.1], enabled=False)
+
+    @QtCore.pyqtSlot()
+    def _update_gui(self):
+        for axis, name in enumerate('XYZ'):
+            if not np.isnan(self.position_um[axis]):
+                self.gui.update_param(f'{name} pos., um', self.position_um[axis])
+        self.gui.update_param('Last move, ms', 1000 * self.last_move_s.get('total', 0))
+
+
+# run if the module is launched as a standalone program
+if __name__ == "__main__":
+    app = QtWidgets.QApplication(sys.argv)
+    dev = MotionCoordinator()
+    dev.gui.show()
+    app.exec_()
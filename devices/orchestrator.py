@@ -0,0 +1,374 @@
+"""
+Experiment orchestrator: runs an acquisition (time points x tiles x arms, one stack each) as a pipeline of device steps.
+While the camera finishes the current stack, the stage move, arm switch, ETL and DM setup for the next stack
+run in parallel (one thread per device). Preparation of devices that are not busy during the stack starts
+even earlier, during the stack acquisition.
+Devices are passed in by their role, e.g. add_device('camera', cam), so the module does not depend on other modules.
+Every device call is logged in a timeline, to measure the dead time between stacks.
+To launch as a standalone app, run `python orchestrator.py`.
+"""
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from functools import partial
+import numpy as np
+import kekse
+from PyQt5 import QtCore, QtWidgets
+
+config = {
+    'dry_run': True,  # call only devices in simulation mode, replace other calls by their expected durations
+    'n_timepoints': 1,
+    'interval_s': 0.0,  # time between time points, 0 for as fast as possible
+    'tiles_mm': [[0.0, 0.0]],  # list of (x, y) stage positions
+    'arms': ['left', 'right'],
+    'n_frames': 100,  # frames per stack
+    'stage_scan': True,  # stacks are acquired by stage scanning, stage sends camera triggers
+    'etl_current_mA': {'left': None, 'right': None},  # ETL current per arm, None for no change
+    'dm_commands': {'left': None, 'right': None},  # DM command (52 values) per arm, None for no change
+    'dm_rewind_sequence': False,  # rewind the loaded DM sequence (one command per plane) before each stack
+    # roles not touched until the stack ends, on top of the roles of the acquire actions (e.g. stage when scanning).
+    # Remove a role only if changing it mid-stack is safe, e.g. the ETL of the other arm.
+    'busy_during_stack': ['camera', 'lightsheet', 'stage', 'etl', 'dm'],
+    'dry_run_durations_s': {'camera': 0.005, 'lightsheet': 0.01, 'stage': 0.2, 'etl': 0.005, 'dm': 0.005},
+    # saving block, stacks are compressed by a process pool, see kekse.stacks.StackWriter
+    'save_dir': None,  # None for no saving
+    'save_codec': 'zlib',  # 'raw', 'zlib', 'lzma', 'bz2'
+    'save_level': 1,
+    'save_workers': 4
+}
+logging.basicConfig()
+
+
+class Action:
+    """A single device call of a step."""
+    def __init__(self, name, role, func, *args, duration_s=None, **kwargs):
+        """
+        Parameters:
+            :param name: str
+            :param role: str
+                Device role, e.g. 'camera', 'stage'. Actions of the same role are never executed in parallel.
+            :param func: function reference, called as func(*args, **kwargs)
+            :param duration_s: float
+                Expected duration in dry run. Default: config['dry_run_durations_s'][role].
+        """
+        self.name = name
+        self.role = role
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.duration_s = duration_s
+
+    def __call__(self):
+        return self.func(*self.args, **self.kwargs)
+
+
+class Step:
+    """One stack: preparation actions, acquisition actions (sequential), and finishing actions."""
+    def __init__(self, name, prepare=(), acquire=(), finish=(), start_time_s=0.0):
+        self.name = name
+        self.prepare = list(prepare)
+        self.acquire = list(acquire)
+        self.finish = list(finish)
+        self.start_time_s = start_time_s
+
+
+class Orchestrator(QtCore.QObject):
+    sig_update_gui = QtCore.pyqtSignal()
+
+    def __init__(self, dev_name='Orchestrator', gui_on=True, logger_name='Orchestrator'):
+        super().__init__()
+        self.config = config
+        self.devices = {}
+        self.steps = []
+        self.timeline = []  # list of (step, phase, action, role, t_start_s, t_end_s)
+        self._timeline_lock = threading.Lock()
+        self._t0 = time.perf_counter()
+        self.status = 'Idle'
+        self.abort = False
+        self._current_step = None
+        self.stack_callback = None  # called as stack_callback(step, frames) after each stack
+        self.save_stats = []  # (step name, compression ratio, MB/s per worker) of saved stacks
+        self._save_executor = None
+        self._saver = None  # thread that writes the stacks, off the acquisition path
+        self._pending_saves = []
+        self.mean_dead_time_ms = 0.0
+        # logger setup
+        self.logger_name = logger_name
+        self.logger = logging.getLogger(logger_name)
+        self.logger.setLevel(logging.DEBUG)
+        # GUI setup
+        self.gui_on = gui_on
+        if self.gui_on:
+            self.logger.info("GUI activated")
+            self.gui = kekse.ProtoKeks(dev_name)
+            self._setup_gui()
+            self.sig_update_gui.connect(self._update_gui)
+
+    def add_device(self, role, device):
+        """Register a device under its role: 'camera', 'lightsheet', 'stage', 'etl', or 'dm'."""
+        self.devices[role] = device
+        self.logger.info(f"{role}: {type(device).__name__}")
+
+    def _is_simulated(self, role):
+        dev_config = getattr(self.devices[role], 'config', {})
+        return isinstance(dev_config, dict) and dev_config.get('simulation', False)
+
+    def plan(self):
+        """Build the list of steps from config. Device settings that don't change between
+        consecutive stacks (e.g. the tile for the two arms) are not sent again."""
+        steps = []
+        cam = self.devices.get('camera')
+        n_frames = int(self.config['n_frames'])
+        frames_duration_s = n_frames * getattr(cam, 'exposure_ms', 0) / 1000.
+        last_tile = last_arm = last_current = last_dm_arm = None
+        for t in range(int(self.config['n_timepoints'])):
+            for i_tile, tile in enumerate(self.config['tiles_mm']):
+                for arm in self.config['arms']:
+                    prepare, acquire, finish = [], [], []
+                    if 'stage' in self.devices and tuple(tile) != last_tile:
+                        prepare.append(Action('move', 'stage', self.devices['stage'].move_abs, tuple(tile)))
+                        last_tile = tuple(tile)
+                    if 'lightsheet' in self.devices and arm != last_arm:
+                        prepare.append(Action('arm', 'lightsheet',
+                                              self.devices['lightsheet'].update_config, 'active_arm', arm))
+                        last_arm = arm
+                    current = self.config['etl_current_mA'].get(arm)
+                    if 'etl' in self.devices and current is not None and current != last_current:
+                        prepare.append(Action('current', 'etl', self.devices['etl'].set_current, current))
+                        last_current = current
+                    if 'dm' in self.devices:
+                        dm = self.devices['dm']
+                        command = self.config['dm_commands'].get(arm)
+                        if command is not None and arm != last_dm_arm:
+                            prepare.append(Action('command', 'dm', dm.apply_cmd, np.asarray(command, dtype=float)))
+                            last_dm_arm = arm
+                        if self.config['dm_rewind_sequence']:
+                            prepare.append(Action('rewind', 'dm', dm.rewind_sequence))
+                    if cam is not None:
+                        acquire.append(Action('start', 'camera', cam.start_acquisition, n_frames))
+                        if self.config['stage_scan'] and 'stage' in self.devices:
+                            acquire.append(Action('scan', 'stage', self.devices['stage'].start_scan))
+                        acquire.append(Action('collect', 'camera', self._collect, n_frames,
+                                              duration_s=frames_duration_s))
+                        finish.append(Action('stop', 'camera', cam.stop_acquisition))
+                    steps.append(Step(f"t{t} tile{i_tile} {arm}", prepare, acquire, finish,
+                                      start_time_s=t * self.config['interval_s']))
+        self.steps = steps
+        return steps
+
+    def _collect(self, n_frames):
+        frames = self.devices['camera'].collect_frames(n_frames)
+        if self.config['save_dir'] is not None and len(frames) > 0:
+            filepath = os.path.join(self.config['save_dir'], self._current_step.name.replace(' ', '_'))
+            # register before the next scan resets the stage trajectory and position log
+            metadata = getattr(self.devices['camera'], 'last_metadata', ())
+            stage = self.devices.get('stage')
+            if self.config['stage_scan'] and hasattr(stage, 'register_frames') and len(metadata) > 0:
+                stage.register_frames(metadata, filepath)
+            # camera buffers are reused by the next stack, so the saver gets copies
+            copies = [frame.copy() for frame in frames]
+            self._pending_saves.append(self._saver.submit(self._save_stack, self._current_step, filepath, copies))
+        if self.stack_callback is not None:
+            self.stack_callback(self._current_step, frames)
+        return frames
+
+    def _save_stack(self, step, filepath, frames):
+        """Compress and write one stack, runs in the saver thread while the next stack is acquired."""
+        # workers sets the chunks in flight, so that the whole shared pool is used
+        writer = kekse.stacks.StackWriter(filepath, frames[0].shape, dtype=frames[0].dtype,
+                                          codec=self.config['save_codec'], level=self.config['save_level'],
+                                          executor=self._save_executor, workers=self.config['save_workers'])
+        writer.write_frames(frames)
+        writer.close()
+        stats = writer.stats()
+        self.save_stats.append((step.name, stats['ratio'], stats['MB_per_s']))
+
+    def _log(self, step, phase, action, t_start, t_end):
+        with self._timeline_lock:
+            self.timeline.append((step.name, phase, action.name, action.role, t_start - self._t0, t_end - self._t0))
+
+    def _execute(self, step, phase, actions, dry_run):
+        """Execute actions sequentially and log them in the timeline."""
+        for action in actions:
+            if self.abort:
+                break
+            t_start = time.perf_counter()
+            with kekse.profiler.span(f"{action.role}.{action.name}"):
+                if dry_run and not self._is_simulated(action.role):
+                    duration_s = action.duration_s
+                    if duration_s is None:
+                        duration_s = self.config['dry_run_durations_s'].get(action.role, 0.0)
+                    time.sleep(duration_s)
+                else:
+                    action()
+            self._log(step, phase, action, t_start, time.perf_counter())
+
+    def _execute_parallel(self, executor, tasks, dry_run):
+        """Execute (step, phase, actions) tasks: actions of the same role sequentially, different roles in parallel.
+        Returns list of futures."""
+        chains = {}
+        for step, phase, actions in tasks:
+            for action in actions:
+                chains.setdefault(action.role, []).append((step, phase, action))
+        futures = []
+        for chain in chains.values():
+            futures.append(executor.submit(self._execute_chain, chain, dry_run))
+        return futures
+
+    def _execute_chain(self, chain, dry_run):
+        for step, phase, action in chain:
+            self._execute(step, phase, [action], dry_run)
+
+    def run(self, dry_run=None):
+        """Run the experiment planned from config. Returns the timeline."""
+        if dry_run is None:
+            dry_run = self.config['dry_run']
+        steps = self.plan()
+        self.timeline = []
+        self.abort = False
+        self.status = 'Running'
+        if self.gui_on:
+            self.sig_update_gui.emit()
+        self.logger.info(f"{'Dry run' if dry_run else 'Run'}: {len(steps)} stacks")
+        busy = set(self.config['busy_during_stack'])
+        early = {}  # index of step -> prepare actions already done during the previous stack
+        executor = ThreadPoolExecutor(max_workers=len(self.devices) + 1)
+        self.save_stats = []
+        if self.config['save_dir'] is not None:
+            os.makedirs(self.config['save_dir'], exist_ok=True)
+            self._save_executor = ProcessPoolExecutor(self.config['save_workers'])
+            self._saver = ThreadPoolExecutor(max_workers=1)
+            self._pending_saves = []
+        self._t0 = time.perf_counter()
+        try:
+            for i, step in enumerate(steps):
+                if self.abort:
+                    break
+                # finish of previous stack in parallel with preparation of the current one
+                tasks = [(step, 'prepare', [a for a in step.prepare if a not in early.get(i, [])])]
+                if i > 0:
+                    tasks.append((steps[i - 1], 'finish', steps[i - 1].finish))
+                for future in self._execute_parallel(executor, tasks, dry_run):
+                    future.result()
+                delay_s = step.start_time_s - (time.perf_counter() - self._t0)
+                if delay_s > 0:
+                    time.sleep(delay_s)
+                # prepare the next stack on idle devices while this stack is acquired
+                futures = []
+                if i + 1 < len(steps):
+                    busy_now = busy | {a.role for a in step.acquire}
+                    early[i + 1] = [a for a in steps[i + 1].prepare if a.role not in busy_now]
+                    futures = self._execute_parallel(executor, [(steps[i + 1], 'prepare', early[i + 1])], dry_run)
+                self._current_step = step
+                self._execute(step, 'acquire', step.acquire, dry_run)
+                for future in futures:
+                    future.result()
+            if len(steps) > 0:
+                self._execute(steps[-1], 'finish', steps[-1].finish, dry_run)
+        except Exception as e:
+            self.logger.error(f"Run stopped with error: {e}")
+        finally:
+            executor.shutdown(wait=True)
+            for future in self._pending_saves:
+                try:
+                    future.result()
+                except Exception as e:
+                    self.logger.error(f"Saving stack failed: {e}")
+            self._pending_saves = []
+            if self._saver is not None:
+                self._saver.shutdown()
+                self._saver = None
+            if self._save_executor is not None:
+                self._save_executor.shutdown()
+                self._save_executor = None
+        dead_times = self.dead_times()
+        self.mean_dead_time_ms = 1000 * sum(dead_times) / len(dead_times) if dead_times else 0.0
+        self.status = 'Aborted' if self.abort else 'Idle'
+        self.logger.info(f"Finished in {time.perf_counter() - self._t0:.3f} s, "
+                         f"mean dead time between stacks {self.mean_dead_time_ms:.1f} ms")
+        if self.gui_on:
+            self.sig_update_gui.emit()
+        return self.timeline
+
+    def run_in_thread(self):
+        """Start run() in a separate thread, e.g. from a GUI button."""
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def stop(self):
+        self.abort = True
+        self.logger.info("Abort requested, stopping after current action")
+
+    def dead_times(self):
+        """Idle time of the camera between consecutive stacks (s), excluding the waits between time points."""
+        acquire = {}
+        for step_name, phase, _, _, t_start, t_end in self.timeline:
+            if phase == 'acquire':
+                t0, t1 = acquire.get(step_name, (t_start, t_end))
+                acquire[step_name] = (min(t0, t_start), max(t1, t_end))
+        dead = []
+        steps = [s for s in self.steps if s.name in acquire]
+        for prev, step in zip(steps[:-1], steps[1:]):
+            if step.start_time_s == prev.start_time_s:
+                dead.append(acquire[step.name][0] - acquire[prev.name][1])
+        return dead
+
+    def save_timeline(self, filepath):
+        """Write the timeline into a JSON file."""
+        keys = ('step', 'phase', 'action', 'role', 't_start_s', 't_end_s')
+        with open(filepath, 'w') as f:
+            json.dump([dict(zip(keys, entry)) for entry in self.timeline], f, indent=1)
+        self.logger.info(f"Timeline saved: {filepath}")
+
+    def update_config(self, key, value):
+        if key in self.config.keys():
+            self.config[key] = value
+            self.logger.info(f"changed {key} to {value}")
+        else:
+            self.logger.error("Parameter name not found in config file")
+        if self.gui_on:
+            self.sig_update_gui.emit()
+
+    def _setup_gui(self):
+        groupbox_name = 'Experiment'
+        self.gui.add_groupbox(groupbox_name)
+        self.gui.add_numeric_field('Time points', groupbox_name,
+                                   value=self.config['n_timepoints'],
+                                   vrange=[1, 1e6, 1],
+                                   func=lambda x: self.update_config('n_timepoints', int(x)))
+        self.gui.add_numeric_field('Interval, s', groupbox_name,
+                                   value=self.config['interval_s'],
+                                   vrange=[0, 1e6, 0.1],
+                                   func=partial(self.update_config, 'interval_s'))
+        self.gui.add_numeric_field('Frames per stack', groupbox_name,
+                                   value=self.config['n_frames'],
+                                   vrange=[1, 1e6, 1],
+                                   func=lambda x: self.update_config('n_frames', int(x)))
+        self.gui.add_checkbox('Stage scan', groupbox_name,
+                              value=self.config['stage_scan'],
+                              func=partial(self.update_config, 'stage_scan'))
+        self.gui.add_checkbox('Dry run', groupbox_name,
+                              value=self.config['dry_run'],
+                              func=partial(self.update_config, 'dry_run'))
+        self.gui.add_button('Run', groupbox_name, func=self.run_in_thread)
+        self.gui.add_button('Abort', groupbox_name, func=self.stop)
+        self.gui.add_string_field('Status', groupbox_name, value=self.status, enabled=False)
+        self.gui.add_numeric_field('Dead time, ms', groupbox_name,
+                                   value=self.mean_dead_time_ms,
+                                   vrange=[0, 1e6, 0.1], enabled=False)
+
+    @QtCore.pyqtSlot()
+    def _update_gui(self):
+        self.gui.update_param('Status', self.status)
+        self.gui.update_param('Dead time, ms', self.mean_dead_time_ms)
+
+
+# run if the module is launched as a standalone program
+if __name__ == "__main__":
+    app = QtWidgets.QApplication(sys.argv)
+    dev = Orchestrator()
+    dev.gui.show()
+    app.exec_()
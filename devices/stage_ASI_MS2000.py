@@ -9,8 +9,11 @@ import serial
 import kekse
 import logging
 import sys
+import threading
 import time
+from collections import deque
 from functools import partial
+import numpy as np
 from PyQt5 import QtCore, QtWidgets
 from PyQt5.QtCore import pyqtSignal
 
@@ -21,9 +24,169 @@ config = {
     'timeout_s': 2.0,
     'units_mm': 1e-4,
     'max_speed_mm/s': 7.5,
-    'encoder_step_mm': 1.0/45397.6}
+    'encoder_step_mm': 1.0/45397.6,
+    # trajectory model
+    'acceleration_ms': 70.0,  # ramp time to full speed, as set by the AC command of the controller
+    'scan_runup_mm': 0.0,  # distance the stage starts before x_start (and stops after x_stop) on each line
+    'trajectory_dt_s': 1e-3,  # sampling of the modeled stage path
+    'position_log_size': 100000,  # positions read during scans and by get_position(), kept with their host times for registration
+    'scan_position_poll_s': 0.02}  # position sampling interval during start_scan(), None for no sampling
 logging.basicConfig()
 
+# Position of one frame, see register_frames()
+FRAME_POSITION_DTYPE = np.dtype([('frame_index', np.int64),  # camera framestamp
+                                 ('trigger_index', np.int64),  # stage trigger that started the frame
+                                 ('line', np.int32),
+                                 ('x_mm', np.float64),  # encoder position of the trigger
+                                 ('y_mm', np.float64),
+                                 ('t_s', np.float64),  # trigger time from the scan start, modeled
+                                 ('x_measured_mm', np.float64),  # from sampled stage positions, NaN if none
+                                 ('y_measured_mm', np.float64),
+                                 ('in_accel', np.bool_)])
+
+
+def _trapezoid(length_mm, speed_mms, acceleration_ms):
+    """Peak speed (mm/s), ramp time (s) and total duration (s) of a move of length_mm from rest to rest,
+    with trapezoidal velocity profile: constant acceleration up to speed_mms in acceleration_ms."""
+    accel = speed_mms / max(acceleration_ms / 1000., 1e-9)
+    if length_mm >= speed_mms ** 2 / accel:
+        peak = speed_mms
+    else:  # too short to reach full speed, triangular profile
+        peak = np.sqrt(accel * length_mm)
+    t_ramp = peak / accel
+    duration = 2 * t_ramp + (length_mm - peak * t_ramp) / peak if peak > 0 else 0.0
+    return peak, t_ramp, duration
+
+
+def trapezoid_position(t_s, length_mm, speed_mms, acceleration_ms):
+    """Distance travelled (mm) at times t_s (array) of a trapezoidal move, see _trapezoid()."""
+    peak, t_ramp, duration = _trapezoid(length_mm, speed_mms, acceleration_ms)
+    accel = peak / t_ramp if t_ramp > 0 else 0.0
+    t_s = np.clip(np.asarray(t_s, dtype=float), 0, duration)
+    return np.where(t_s < t_ramp, 0.5 * accel * t_s ** 2,
+                    np.where(t_s < duration - t_ramp, 0.5 * peak * t_ramp + peak * (t_s - t_ramp),
+                             length_mm - 0.5 * accel * (duration - t_s) ** 2))
+
+
+def trapezoid_time(s_mm, length_mm, speed_mms, acceleration_ms):
+    """Times (s) when a trapezoidal move reaches the distances s_mm (array), and the speeds (mm/s) there."""
+    peak, t_ramp, duration = _trapezoid(length_mm, speed_mms, acceleration_ms)
+    accel = peak / t_ramp if t_ramp > 0 else np.inf
+    s_mm = np.clip(np.asarray(s_mm, dtype=float), 0, length_mm)
+    d_ramp = 0.5 * peak * t_ramp
+    t_s = np.where(s_mm < d_ramp, np.sqrt(2 * s_mm / accel),
+                   np.where(s_mm <= length_mm - d_ramp, t_ramp + (s_mm - d_ramp) / peak,
+                            duration - np.sqrt(2 * (length_mm - s_mm) / accel)))
+    speed = np.minimum(peak, accel * np.minimum(t_s, duration - t_s))
+    return t_s, speed
+
+
+def scan_trajectory(scan_limits_xx_yy, n_lines, speed_x, speed_y, interval_mm, acceleration_ms,
+                    runup_mm=0.0, serpentine=True, dt_s=1e-3, speed_tolerance=0.01):
+    """
+    Model of a stage scan: X lines at speed_x with encoder triggers every interval_mm from x_start to x_stop,
+    Y steps between lines. Each move has a trapezoidal velocity profile with ramp time acceleration_ms.
+    Parameters:
+        :param scan_limits_xx_yy: [x_start, x_stop, y_start, y_stop], mm
+        :param runup_mm: float
+            Distance before x_start (and after x_stop) where the stage accelerates (decelerates).
+        :param speed_tolerance: float
+            Triggers where the speed is below (1 - speed_tolerance) * speed_x are flagged as in acceleration zone.
+    Returns dict of arrays:
+        't_s', 'x_mm', 'y_mm': sampled stage path,
+        'trigger_t_s', 'trigger_x_mm', 'trigger_y_mm', 'trigger_line', 'trigger_speed_mms',
+        'trigger_in_accel' (bool): trigger schedule,
+        and scalars 'duration_s', 'trigger_period_s' (at full speed), 'min_runup_mm' (for even spacing).
+    """
+    x_start, x_stop, y_start, y_stop = scan_limits_xx_yy
+    assert x_stop > x_start, "scan_trajectory(): x_stop must be larger than x_start"
+    assert interval_mm > 0 and speed_x > 0, "scan_trajectory(): interval and speed must be positive"
+    n_lines = max(int(n_lines), 1)
+    line_length = x_stop - x_start + 2 * runup_mm
+    _, _, line_duration = _trapezoid(line_length, speed_x, acceleration_ms)
+    y_lines = np.linspace(y_start, y_stop, n_lines)
+    y_step = abs(y_lines[1] - y_lines[0]) if n_lines > 1 else 0.0
+    _, _, y_duration = _trapezoid(y_step, speed_y, acceleration_ms) if y_step > 0 else (0, 0, 0.0)
+    # triggers along one line, as distance from the line start
+    n_triggers = int(np.floor((x_stop - x_start) / interval_mm + 1e-9)) + 1
+    trigger_s, trigger_speed = trapezoid_time(runup_mm + interval_mm * np.arange(n_triggers),
+                                              line_length, speed_x, acceleration_ms)
+    t_line = np.arange(0, line_duration, dt_s)
+    s_line = trapezoid_position(t_line, line_length, speed_x, acceleration_ms)
+    t_ystep = np.arange(0, y_duration, dt_s)
+    s_ystep = trapezoid_position(t_ystep, y_step, speed_y, acceleration_ms)
+    path_t, path_x, path_y = [], [], []
+    trig_t, trig_x, trig_y, trig_line = [], [], [], []
+    t0 = 0.0
+    for i_line, y in enumerate(y_lines):
+        forward = (i_line % 2 == 0) or not serpentine
+        x_line_start = x_start - runup_mm if forward else x_stop + runup_mm
+        sign = 1 if forward else -1
+        path_t.append(t0 + t_line)
+        path_x.append(x_line_start + sign * s_line)
+        path_y.append(np.full(len(t_line), y))
+        trig_t.append(t0 + trigger_s)
+        trig_x.append(x_line_start + sign * (runup_mm + interval_mm * np.arange(n_triggers)))
+        trig_y.append(np.full(n_triggers, y))
+        trig_line.append(np.full(n_triggers, i_line))
+        t0 += line_duration
+        if i_line < n_lines - 1:
+            x_end = x_stop + runup_mm if forward else x_start - runup_mm
+            path_t.append(t0 + t_ystep)
+            path_x.append(np.full(len(t_ystep), x_end))
+            path_y.append(y + np.sign(y_lines[i_line + 1] - y) * s_ystep)
+            t0 += y_duration
+            if not serpentine:  # raster: return to the line start at scan speed
+                path_t.append(t0 + t_line)
+                path_x.append(x_end - s_line)
+                path_y.append(np.full(len(t_line), y_lines[i_line + 1]))
+                t0 += line_duration
+    speed = np.tile(trigger_speed, n_lines)
+    return {'t_s': np.concatenate(path_t),
+            'x_mm': np.concatenate(path_x),
+            'y_mm': np.concatenate(path_y),
+            'trigger_t_s': np.concatenate(trig_t),
+            'trigger_x_mm': np.concatenate(trig_x),
+            'trigger_y_mm': np.concatenate(trig_y),
+            'trigger_line': np.concatenate(trig_line),
+            'trigger_speed_mms': speed,
+            'trigger_in_accel': speed < (1 - speed_tolerance) * speed_x,
+            'duration_s': t0,
+            'trigger_period_s': interval_mm / speed_x,
+            'min_runup_mm': 0.5 * speed_x * acceleration_ms / 1000.}
+
+
+def register_frames(metadata, trajectory, samples=None):
+    """
+    Position table of stage-triggered frames. Frame k of the stack (counted by the camera framestamps,
+    so dropped frames keep their place) was started by trigger k of the scan. Positions are the encoder positions
+    of the triggers. If sampled stage positions are given, they are interpolated (np.interp) at the host times
+    of the frames, shifted by the median offset between frame host times and modeled trigger times.
+    Parameters:
+        :param metadata: array with 'frame_index' and 'host_time_ns' fields (FRAME_METADATA_DTYPE of the camera)
+        :param trajectory: dict of scan_trajectory()
+        :param samples: array (n, 3) of (host time ns, x_mm, y_mm), e.g. from MotionController.position_log
+    Returns FRAME_POSITION_DTYPE array, one record per frame within the trigger schedule.
+    """
+    frame_index = np.asarray(metadata['frame_index'], dtype=np.int64)
+    trigger_index = frame_index - frame_index[0] if len(frame_index) else frame_index
+    valid = trigger_index < len(trajectory['trigger_t_s'])
+    trigger_index = trigger_index[valid]
+    table = np.zeros(len(trigger_index), dtype=FRAME_POSITION_DTYPE)
+    table['frame_index'] = frame_index[valid]
+    table['trigger_index'] = trigger_index
+    for field, key in (('line', 'trigger_line'), ('x_mm', 'trigger_x_mm'), ('y_mm', 'trigger_y_mm'),
+                       ('t_s', 'trigger_t_s'), ('in_accel', 'trigger_in_accel')):
+        table[field] = trajectory[key][trigger_index]
+    table['x_measured_mm'] = table['y_measured_mm'] = np.nan
+    if samples is not None and len(samples) > 1 and len(table) > 0:
+        host_s = np.asarray(metadata['host_time_ns'], dtype=np.int64)[valid] * 1e-9
+        trigger_host_s = table['t_s'] + np.median(host_s - table['t_s'])
+        sample_s = np.asarray(samples[:, 0], dtype=np.float64) * 1e-9
+        table['x_measured_mm'] = np.interp(trigger_host_s, sample_s, samples[:, 1], left=np.nan, right=np.nan)
+        table['y_measured_mm'] = np.interp(trigger_host_s, sample_s, samples[:, 2], left=np.nan, right=np.nan)
+    return table
+
 
 class MotionController(QtCore.QObject):
     """
@@ -49,6 +212,10 @@ class MotionController(QtCore.QObject):
         self.position_x_mm = self.position_y_mm = 0.0
         self.target_pos_x_mm = self.target_pos_y_mm = 0.0
         self.backlash_mm = 0.03 # some stages are configured without anti-BL gear for smooth motion, and need a margin.
+        self.trajectory = None
+        self.position_log = deque(maxlen=config['position_log_size'])  # (time.perf_counter_ns(), x_mm, y_mm)
+        self._ser_lock = threading.RLock()  # transactions from the scan monitor and other callers don't interleave
+        self._scan_monitor = None
         # logger setup
         self.logger_name = logger_name
         self.logger = logging.getLogger(logger_name)
@@ -69,8 +236,7 @@ class MotionController(QtCore.QObject):
             try:
                 self._ser = serial.Serial(self.port, self.baud, timeout=self.timeout_s)
                 self.logger.info(f"Connected to port {self.port}")
-                self.get_position()
-                self.get_speed()
+                self.get_position_speed()
                 self.initialized = True
             except Exception as e:
                 self.logger.error(f"Could not initialize stage: {e}")
@@ -79,12 +245,7 @@ class MotionController(QtCore.QObject):
 
     def get_position(self):
         if not self.config['simulation']:
-            response = self.write_with_response(b'W X Y')
-            if response[:2] == ":A" and len(response) >= 3:
-                words = response.split(" ")
-                if len(words) >= 3:
-                    self.position_x_mm = float(words[1]) * self.units
-                    self.position_y_mm = float(words[2]) * self.units
+            self._parse_position(self.write_with_response(b'W X Y'))
         else:
             self.logger.debug(f"Simulation: get_position().")
         if self.gui_on:
@@ -92,27 +253,69 @@ class MotionController(QtCore.QObject):
 
     def get_speed(self):
         if not self.config['simulation']:
-            response = self.write_with_response(b"s x? y?")
-            if response[:2] == ":A" and len(response) >= 3:
-                words = response.split(" ")
-                if len(words) >= 3:
-                    self.speed_x = float(words[1][2:])
-                    self.speed_y = float(words[2][2:])
-                    self.logger.info(f'speed: ({self.speed_x}, {self.speed_y})')
+            self._parse_speed(self.write_with_response(b"s x? y?"))
         else:
             self.logger.debug(f"Simulation: get_speed().")
         if self.gui_on:
             self.sig_update_gui.emit()
 
+    def get_position_speed(self):
+        """Query position and speed in one transaction."""
+        if not self.config['simulation']:
+            responses = self.transaction([b'W X Y', b"s x? y?"])
+            if responses is not None:
+                self._parse_position(responses[0])
+                self._parse_speed(responses[1])
+        else:
+            self.logger.debug(f"Simulation: get_position_speed().")
+        if self.gui_on:
+            self.sig_update_gui.emit()
+
+    def _parse_position(self, response):
+        if response is not None and response[:2] == ":A" and len(response) >= 3:
+            words = response.split(" ")
+            if len(words) >= 3:
+                self.position_x_mm = float(words[1]) * self.units
+                self.position_y_mm = float(words[2]) * self.units
+                self.position_log.append((time.perf_counter_ns(), self.position_x_mm, self.position_y_mm))
+
+    def _parse_speed(self, response):
+        if response is not None and response[:2] == ":A" and len(response) >= 3:
+            words = response.split(" ")
+            if len(words) >= 3:
+                self.speed_x = float(words[1][2:])
+                self.speed_y = float(words[2][2:])
+                self.logger.info(f'speed: ({self.speed_x}, {self.speed_y})')
+
+    @kekse.profiler.timed('ASI.write_with_response')
     def write_with_response(self, command, terminator=b'\r'):
-        try:
-            self._flush()
-            self._ser.write(command + terminator)
-            response = self._ser.read_until(terminator=b'\r\n').decode('utf-8')
-            return response[:-2]
-        except Exception as e:
-            self.logger.error(f"write_with_response() {e}")
-            return None
+        responses = self.transaction([command], terminator)
+        return None if responses is None else responses[0]
+
+    @kekse.profiler.timed('ASI.transaction')
+    def transaction(self, commands, terminator=b'\r'):
+        """Send the commands in one write, and read their responses in order.
+        The controller executes commands one by one from its input buffer, and answers each with one line.
+        Buffers are flushed only if stale bytes are waiting, and after an error.
+        Returns list of responses (str, without line end), or None on error."""
+        with self._ser_lock:
+            try:
+                if self._ser.in_waiting:
+                    self.logger.debug(f"transaction(): flushing {self._ser.in_waiting} stale bytes")
+                    self._flush()
+                self._ser.write(b''.join(command + terminator for command in commands))
+                responses = []
+                for command in commands:
+                    response = self._ser.read_until(b'\r\n')
+                    if not response.endswith(b'\r\n'):
+                        raise serial.SerialTimeoutException(f"no response to {command}")
+                    responses.append(response[:-2].decode('utf-8'))
+                return responses
+            except Exception as e:
+                self.logger.error(f"transaction() {e}")
+                if self._ser is not None:
+                    self._flush()
+                return None
 
     def _flush(self):
         if self._ser is not None:
@@ -144,6 +347,7 @@ class MotionController(QtCore.QObject):
     def set_target_y(self, target_y_mm): self.target_pos_y_mm = target_y_mm
 
     def set_speed(self, speed_mms, **kwargs):
+        self.trajectory = None
         if 'axis' in kwargs.keys():
             axis = kwargs['axis']
         else:
@@ -165,10 +369,17 @@ class MotionController(QtCore.QObject):
         if self.gui_on:
             self.sig_update_gui.emit()
 
+    @kekse.profiler.timed('ASI.move_abs')
     def move_abs(self, pos_mm, sleep_s=0.05):
         assert len(pos_mm) == 2, "move_abs(): argument pos_mm should be 2-element array-like"
         command = f'M X={round(pos_mm[0]/self.units)} Y={round(pos_mm[1]/self.units)}'
         self.logger.debug(command)
+        if self.config['simulation']:
+            self.position_x_mm, self.position_y_mm = pos_mm
+            self.logger.debug("Simulation: move_abs()")
+            if self.gui_on:
+                self.sig_update_gui.emit()
+            return
         _ = self.write_with_response(command.encode())
         response = self.write_with_response(b'/')
         while response[0] != 'N':
@@ -178,6 +389,7 @@ class MotionController(QtCore.QObject):
         self.get_position()
 
     def set_trigger_intervals(self, interval_mm, **kwargs):
+        self.trajectory = None
         if 'trigger_axis' in kwargs.keys():
             trigger_axis = kwargs['trigger_axis']
             if trigger_axis == 'X':
@@ -193,6 +405,7 @@ class MotionController(QtCore.QObject):
             self.logger.error("set_trigger_intervals(): keyword /'trigger_axis/' is misssing.")
 
     def set_scan_region(self, pos_mm, **kwargs):
+        self.trajectory = None
         # check which keyword is passed, and switch accordingly
         if 'scan_boundary' in kwargs.keys():
             boundary = kwargs['scan_boundary']
@@ -216,6 +429,7 @@ class MotionController(QtCore.QObject):
             self.logger.error("set_scan_region(): keyword /'scan_boundary/' is misssing.")
 
     def set_n_scan_lines(self, n):
+        self.trajectory = None
         self.n_scan_lines = n
         if not self.config['simulation']:
             self._setup_scan()
@@ -223,35 +437,117 @@ class MotionController(QtCore.QObject):
             self.sig_update_gui.emit()
 
     def _setup_scan(self):
-        """Send the scan parameters to the stage"""
+        """Send the scan parameters to the stage, in one transaction"""
         # set x-limits and trigger interval
-        command = f'SCANR X={self.scan_limits_xx_yy[0]:.4f} ' \
-                  f'Y={self.scan_limits_xx_yy[1]:.4f} ' \
-                  f'Z={self.enc_counts_per_pulse}'
-        _ = self.write_with_response(command.encode())
+        scanr = f'SCANR X={self.scan_limits_xx_yy[0]:.4f} ' \
+                f'Y={self.scan_limits_xx_yy[1]:.4f} ' \
+                f'Z={self.enc_counts_per_pulse}'
         # set y-limits and the number of lines
-        command = f'SCANV X={self.scan_limits_xx_yy[2]:.4f} ' \
-                  f'Y={self.scan_limits_xx_yy[3]:.4f} ' \
-                  f'Z={self.n_scan_lines}'
-        self.logger.debug(command)
-        _ = self.write_with_response(command.encode())
-        # set RASTER (0) or SERPENTINE (1) scan mode:
-        _ = self.write_with_response(b'SCAN F=1')
-        _ = self.write_with_response(b'TTL X=1')
+        scanv = f'SCANV X={self.scan_limits_xx_yy[2]:.4f} ' \
+                f'Y={self.scan_limits_xx_yy[3]:.4f} ' \
+                f'Z={self.n_scan_lines}'
+        self.logger.debug(scanv)
+        # set RASTER (0) or SERPENTINE (1) scan mode, and enable TTL output
+        commands = [scanr.encode(), scanv.encode(), b'SCAN F=1', b'TTL X=1']
+        responses = self.transaction(commands)
+        if responses is not None:
+            for command, response in zip(commands, responses):
+                if response[:2] != ":A":
+                    self.logger.warning(f"_setup_scan(): {command} returned {response}")
 
     def start_scan(self):
         """Scan the stage with ENC_INT module.
-        Functions set_scan_region() and set_trigger_intervals() must be called before it
+        Functions set_scan_region() and set_trigger_intervals() must be called before it.
+        The scan is modeled (compute_trajectory()), and the position is sampled during the scan
+        every config['scan_position_poll_s'] into position_log, for register_frames().
         """
         self.logger.debug(f'enc counts per pulse: {self.enc_counts_per_pulse}')
+        self.compute_trajectory()
+        if self.config['simulation']:
+            self.logger.debug("Simulation: start_scan()")
+            return
+        if self._scan_monitor is not None:
+            self._scan_monitor.join()
+        self.position_log.clear()
         response = self.write_with_response(b'SCAN')
         self.logger.debug(f'SCAN returned: {response}')
+        if self.config['scan_position_poll_s'] is not None:
+            self._scan_monitor = threading.Thread(target=self._monitor_scan, name='ASI scan monitor', daemon=True)
+            self._scan_monitor.start()
+
+    def _monitor_scan(self):
+        """Sample the position until the stage is idle after the scan, or the modeled scan time has passed twice."""
+        duration_s = self.trajectory['duration_s']  # the trajectory is reset if the scan settings change
+        t_start = time.perf_counter()
+        t_end = t_start + 2 * duration_s + 1.0
+        busy = False
+        while time.perf_counter() < t_end:
+            responses = self.transaction([b'W X Y', b'/'])
+            if responses is None:
+                break
+            self._parse_position(responses[0])
+            busy = busy or responses[1][:1] == 'B'
+            # the stage may report idle just after SCAN, before the motion starts
+            if responses[1][:1] == 'N' and (busy or time.perf_counter() - t_start > duration_s):
+                break
+            time.sleep(self.config['scan_position_poll_s'])
+        if self.gui_on:
+            self.sig_update_gui.emit()
+
+    def compute_trajectory(self):
+        """Model the scan set by set_scan_region(), set_trigger_intervals(), set_n_scan_lines() and the speed.
+        The trigger interval is rounded to whole encoder counts, as by the controller.
+        Returns dict of arrays, see scan_trajectory()."""
+        self.trajectory = scan_trajectory(self.scan_limits_xx_yy, self.n_scan_lines, self.speed_x, self.speed_y,
+                                          self.enc_counts_per_pulse * self.encoder_step_mm,
+                                          self.config['acceleration_ms'], self.config['scan_runup_mm'],
+                                          dt_s=self.config['trajectory_dt_s'])
+        n_accel = int(np.count_nonzero(self.trajectory['trigger_in_accel']))
+        self.logger.info(f"Scan: {len(self.trajectory['trigger_t_s'])} triggers in "
+                         f"{self.trajectory['duration_s']:.3f} s, period {1000 * self.trajectory['trigger_period_s']:.3f} ms")
+        if n_accel > 0:
+            self.logger.warning(f"{n_accel} triggers are in acceleration zones (uneven spacing in time): "
+                                f"set scan_runup_mm >= {self.trajectory['min_runup_mm']:.4f} mm, or lower the speed")
+        if self.gui_on:
+            self.sig_update_gui.emit()
+        return self.trajectory
+
+    def export_ttl_schedule(self, filepath):
+        """Save the trigger schedule of the modeled scan as .npz: trigger times (s), positions (mm), line indices,
+        speeds and acceleration-zone flags, for the camera and light-sheet to consume."""
+        if self.trajectory is None:
+            self.compute_trajectory()
+        np.savez(filepath, **{key: value for key, value in self.trajectory.items() if key.startswith('trigger_')},
+                 duration_s=self.trajectory['duration_s'], scan_limits_xx_yy=self.scan_limits_xx_yy,
+                 speed_x=self.speed_x, acceleration_ms=self.config['acceleration_ms'])
+        self.logger.info(f"TTL schedule saved: {filepath}")
+
+    def register_frames(self, metadata, filepath=None):
+        """Positions of the frames of a stage-scanned stack, see register_frames().
+        Parameters:
+            :param metadata: FRAME_METADATA_DTYPE records of the frames (camera last_metadata)
+            :param filepath: str
+                If given, the table is saved as filepath + '.positions.npy', next to the stack.
+        Returns FRAME_POSITION_DTYPE array."""
+        if self._scan_monitor is not None:  # position samples until the end of the scan
+            self._scan_monitor.join()
+        if self.trajectory is None:
+            self.compute_trajectory()
+        samples = np.array(self.position_log, dtype=float).reshape(-1, 3)
+        table = register_frames(metadata, self.trajectory, samples)
+        n_missing = len(metadata) - len(table)
+        if n_missing > 0:
+            self.logger.warning(f"{n_missing} frames are beyond the trigger schedule, not registered")
+        if filepath is not None:
+            np.save(filepath + '.positions.npy', table)
+        return table
 
     def halt(self):
         response = self.write_with_response(b'\\')
         self.logger.info(f'halt() response: {response}')
 
     def update_config(self, key, value):
+        self.trajectory = None
         if key in self.config.keys():
             self.config[key] = value
             self.logger.info(f"changed {key} to {value}")
@@ -343,6 +639,19 @@ class MotionController(QtCore.QObject):
                                    value=self.backlash_mm,
                                    vrange=[0, 0.05, 1e-3], enabled=False)
         self.gui.add_button('Start scanning', groupbox_name, func=self.start_scan)
+        groupbox_name = 'Trajectory'
+        self.gui.add_groupbox(title=groupbox_name, parent=tab_name)
+        self.gui.add_numeric_field('Acceleration, ms', groupbox_name,
+                                   value=self.config['acceleration_ms'],
+                                   vrange=[0, 1000, 1],
+                                   func=partial(self.update_config, 'acceleration_ms'))
+        self.gui.add_numeric_field('Run-up, mm', groupbox_name,
+                                   value=self.config['scan_runup_mm'],
+                                   vrange=[0, 5, 1e-4],
+                                   func=partial(self.update_config, 'scan_runup_mm'))
+        self.gui.add_button('Compute trajectory', groupbox_name, func=self.compute_trajectory)
+        self.gui.add_numeric_field('Triggers in accel. zones', groupbox_name, value=0, vrange=[0, 1e9, 1],
+                                   enabled=False)
 
     @QtCore.pyqtSlot()
     def _update_gui(self):
@@ -355,6 +664,8 @@ class MotionController(QtCore.QObject):
         self.gui.update_param('Y start, mm', self.scan_limits_xx_yy[2])
         self.gui.update_param('Y stop, mm', self.scan_limits_xx_yy[3])
         self.gui.update_param('Trigger interval X, mm', self.pulse_intervals_x)
+        if self.trajectory is not None:
+            self.gui.update_param('Triggers in accel. zones', int(np.count_nonzero(self.trajectory['trigger_in_accel'])))
 
 
 # run if the module is launched as a standalone program
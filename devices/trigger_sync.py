@@ -0,0 +1,213 @@
+"""
+Synchronization of camera exposure and light-sheet waveform from one target frame rate.
+The camera triggers the DAQ (retriggerable AO task) every frame. For a rolling-shutter camera, all rows are exposed
+simultaneously only between the end of the rolling start (readout time after the frame start) and the end of exposure.
+The laser must be on only in this window, the galvo starts moving laser_delay_ms earlier to settle.
+The camera trigger output must mark the global exposure (trig_out_kind 'EXPOSURE'): the galvo sweeps the whole
+waveform, so a trigger at the frame start would spend most of the sweep before the laser is on.
+From the target frame rate, the module derives the camera exposure, light-sheet swipe duration and laser delay,
+checks that the combination sustains the frame rate, and estimates the jitter and dead time per frame.
+Devices are passed in by their role, add_device('camera', cam), add_device('lightsheet', ls).
+To launch as a standalone app, run `python trigger_sync.py`.
+"""
+import logging
+import sys
+from functools import partial
+import numpy as np
+import kekse
+from PyQt5 import QtCore, QtWidgets
+
+config = {
+    'target_fps': 40.0,
+    'galvo_settle_ms': 0.2,  # galvo ramp starts this much before the laser is on
+    'margin_ms': 0.05,  # safety margin at both ends of the laser pulse
+    'min_laser_on_ms': 0.5,
+    'exposure_overhead_ms': 0.02,  # frame period minus exposure, in camera external trigger mode
+    'daq_rearm_samples': 2,  # retriggerable finite AO task needs a few sample clocks to rearm
+    'trigger_jitter_us': 0.1  # camera trigger output jitter (rms)
+}
+logging.basicConfig()
+
+
+class TriggerSync(QtCore.QObject):
+    sig_update_gui = QtCore.pyqtSignal()
+
+    def __init__(self, dev_name='Trigger sync', gui_on=True, logger_name='TriggerSync'):
+        super().__init__()
+        self.config = config
+        self.devices = {}
+        self.timing = {}
+        self.jitter = {}
+        # logger setup
+        self.logger_name = logger_name
+        self.logger = logging.getLogger(logger_name)
+        self.logger.setLevel(logging.DEBUG)
+        # GUI setup
+        self.gui_on = gui_on
+        if self.gui_on:
+            self.logger.info("GUI activated")
+            self.gui = kekse.ProtoKeks(dev_name)
+            self._setup_gui()
+            self.sig_update_gui.connect(self._update_gui)
+
+    def add_device(self, role, device):
+        """Register a device under its role: 'camera' or 'lightsheet'."""
+        assert role in ('camera', 'lightsheet'), f"Unknown role: {role}"
+        self.devices[role] = device
+
+    def _readout_ms(self):
+        return self.devices['camera'].frame_readout_ms
+
+    def _sample_ms(self):
+        return 1000. / self.devices['lightsheet'].config['DAQ_sample_rate_Hz']
+
+    def _trigger_at_exposure(self):
+        """True if the camera trigger output marks the start of global exposure (all rows exposed),
+        False if it marks the frame start."""
+        return self.devices['camera'].config['trig_out_kind'] == 'EXPOSURE'
+
+    def compute_timing(self, fps):
+        """Derive camera and light-sheet timing for the frame rate. All times in ms.
+        Returns dict, raises ValueError if the frame rate can't be sustained or the camera trigger output
+        is not the global exposure."""
+        assert 'camera' in self.devices and 'lightsheet' in self.devices, "Add camera and lightsheet devices first"
+        if not self._trigger_at_exposure():
+            raise ValueError("camera trig_out_kind must be 'EXPOSURE', frame-start triggers would sweep the galvo "
+                             "outside of the laser window")
+        if fps <= 0:
+            raise ValueError(f"Frame rate must be positive: {fps}")
+        period = 1000. / fps
+        readout = self._readout_ms()
+        sample = self._sample_ms()
+        margin = self.config['margin_ms']
+        exposure = period - self.config['exposure_overhead_ms']
+        # trigger time (start of global exposure) and laser window, relative to the frame start
+        t_trigger = readout
+        window_start, window_end = readout + margin, exposure - margin
+        laser_delay = max(self.config['galvo_settle_ms'], window_start - t_trigger)
+        # waveform ends with one zero sample, and must finish and rearm before the next trigger
+        laser_end = min(window_end, period - (self.config['daq_rearm_samples'] + 2) * sample)
+        laser_on = laser_end - (t_trigger + laser_delay) - sample  # DAQ starts up to one sample after trigger
+        swipe = float(np.ceil((laser_delay + laser_on) / sample) * sample + sample)
+        if laser_on < self.config['min_laser_on_ms']:
+            raise ValueError(f"{fps:.2f} fps: laser on {laser_on:.3f} ms < {self.config['min_laser_on_ms']} ms, "
+                             f"readout {readout:.3f} ms")
+        if t_trigger + swipe + self.config['daq_rearm_samples'] * sample > period:
+            raise ValueError(f"{fps:.2f} fps: waveform of {swipe:.3f} ms does not end before the next trigger")
+        return {'fps': fps,
+                'period_ms': period,
+                'exposure_ms': exposure,
+                'readout_ms': readout,
+                'laser_delay_ms': laser_delay,
+                'laser_on_ms': laser_on,
+                'swipe_duration_ms': swipe,
+                'dead_time_ms': period - laser_on}
+
+    def max_frame_rate(self, fps_max=10000.0, tol_fps=0.01):
+        """Highest frame rate with valid timing, by bisection."""
+        fps_low, fps_high = 1e-3, fps_max
+        while fps_high - fps_low > tol_fps:
+            fps = 0.5 * (fps_low + fps_high)
+            try:
+                self.compute_timing(fps)
+                fps_low = fps
+            except ValueError:
+                fps_high = fps
+        return fps_low
+
+    def apply(self, fps=None):
+        """Push the timing of the target frame rate to the camera and the light-sheet generator."""
+        if fps is None:
+            fps = self.config['target_fps']
+        if not self._trigger_at_exposure():
+            self.logger.error("Timing not applied: camera trig_out_kind must be 'EXPOSURE'")
+            return None
+        try:
+            timing = self.compute_timing(fps)
+        except ValueError as e:
+            self.logger.error(f"Timing not applied: {e}. Max frame rate {self.max_frame_rate():.2f} fps")
+            return None
+        ls = self.devices['lightsheet']
+        ls.config['swipe_duration_ms'] = float(timing['swipe_duration_ms'])
+        ls.config['laser_delay_ms'] = float(timing['laser_delay_ms'])
+        ls.setup()
+        self.devices['camera'].set_exposure(timing['exposure_ms'])
+        self.timing = timing
+        self.logger.info(f"{fps:.2f} fps: exposure {timing['exposure_ms']:.3f} ms, "
+                         f"swipe {timing['swipe_duration_ms']:.3f} ms, laser delay {timing['laser_delay_ms']:.3f} ms, "
+                         f"dead time {timing['dead_time_ms']:.3f} ms per frame")
+        if self.gui_on:
+            self.sig_update_gui.emit()
+        return timing
+
+    def simulate(self, fps=None, n_frames=10000, seed=0):
+        """Estimate the laser onset jitter relative to the global exposure window, and the dead time per frame.
+        The DAQ starts the waveform on the next sample clock after the trigger edge, so the onset is
+        quantized to the sample period, on top of the camera trigger jitter.
+        Returns dict: jitter_rms_us, jitter_pp_us, min_guard_us (closest laser edge to the window), dead_time_ms."""
+        if fps is None:
+            fps = self.config['target_fps']
+        timing = self.compute_timing(fps)
+        rng = np.random.default_rng(seed)
+        sample_us = 1000. * self._sample_ms()
+        delays_us = (rng.uniform(0, sample_us, n_frames) +
+                     rng.normal(0, self.config['trigger_jitter_us'], n_frames))
+        onset_us = 1000. * timing['readout_ms'] + delays_us + 1000. * timing['laser_delay_ms']
+        offset_us = onset_us + 1000. * timing['laser_on_ms']
+        window_start_us = 1000. * timing['readout_ms']
+        window_end_us = 1000. * (timing['exposure_ms'])
+        self.jitter = {'jitter_rms_us': float(np.std(delays_us)),
+                       'jitter_pp_us': float(np.ptp(delays_us)),
+                       'min_guard_us': float(min((onset_us - window_start_us).min(), (window_end_us - offset_us).min())),
+                       'dead_time_ms': timing['dead_time_ms']}
+        if self.jitter['min_guard_us'] < 0:
+            self.logger.warning(f"Laser pulse leaves the global exposure window by {-self.jitter['min_guard_us']:.1f} us,"
+                                f" increase margin_ms")
+        if self.gui_on:
+            self.sig_update_gui.emit()
+        return self.jitter
+
+    def update_config(self, key, value):
+        if key in self.config.keys():
+            self.config[key] = value
+            self.logger.info(f"changed {key} to {value}")
+        else:
+            self.logger.error("Parameter name not found in config file")
+        if self.gui_on:
+            self.sig_update_gui.emit()
+
+    def _setup_gui(self):
+        groupbox_name = 'Timing'
+        self.gui.add_groupbox(groupbox_name)
+        self.gui.add_numeric_field('Target frame rate, Hz', groupbox_name,
+                                   value=self.config['target_fps'],
+                                   vrange=[0.1, 10000, 0.1],
+                                   func=partial(self.update_config, 'target_fps'))
+        self.gui.add_numeric_field('Galvo settle, ms', groupbox_name,
+                                   value=self.config['galvo_settle_ms'],
+                                   vrange=[0, 10, 0.01],
+                                   func=partial(self.update_config, 'galvo_settle_ms'))
+        self.gui.add_button('Apply', groupbox_name, func=lambda: self.apply())
+        self.gui.add_button('Simulate jitter', groupbox_name, func=lambda: self.simulate())
+        groupbox_name = 'Result'
+        self.gui.add_groupbox(groupbox_name)
+        for title in ('Exposure, ms', 'Swipe duration, ms', 'Laser delay, ms', 'Dead time, ms',
+                      'Jitter rms, us', 'Jitter p-p, us'):
+            self.gui.add_numeric_field(title, groupbox_name, value=0, vrange=[0, 1e6, 0.001], enabled=False)
+
+    @QtCore.pyqtSlot()
+    def _update_gui(self):
+        self.gui.update_param('Exposure, ms', self.timing.get('exposure_ms', 0))
+        self.gui.update_param('Swipe duration, ms', self.timing.get('swipe_duration_ms', 0))
+        self.gui.update_param('Laser delay, ms', self.timing.get('laser_delay_ms', 0))
+        self.gui.update_param('Dead time, ms', self.jitter.get('dead_time_ms', self.timing.get('dead_time_ms', 0)))
+        self.gui.update_param('Jitter rms, us', self.jitter.get('jitter_rms_us', 0))
+        self.gui.update_param('Jitter p-p, us', self.jitter.get('jitter_pp_us', 0))
+
+
+# run if the module is launched as a standalone program
+if __name__ == "__main__":
+    app = QtWidgets.QApplication(sys.argv)
+    dev = TriggerSync()
+    dev.gui.show()
+    app.exec_()
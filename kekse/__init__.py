@@ -1 +1,4 @@
-from .kekse import ProtoKeks
\ No newline at end of file
+from .kekse import ProtoKeks
+from .presets import PresetLibrary
+from . import profiler
+from . import stacks
@@ -5,16 +5,28 @@ Copyright Nikita Vladimirov, @nvladimus 2020
 
 from PyQt5.QtWidgets import (QGroupBox, QLineEdit, QPushButton, QTabWidget, QCheckBox, QComboBox,
                              QVBoxLayout, QWidget, QDoubleSpinBox, QFormLayout, QLabel)
+from PyQt5.QtGui import QImage, QPixmap
 import PyQt5.QtCore
 import numpy as np
+import threading
+import logging
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger('kekse')
 
 
 class ProtoKeks(QWidget):
     """Base class for GUI widgets."""
-    def __init__(self, title='Control window'):
+    sig_invoke = PyQt5.QtCore.pyqtSignal(object)
+
+    def __init__(self, title='Control window', workers=0):
         """
         Parameters:
         :param title: str
+        :param workers: int
+            Number of worker threads executing the widget callbacks (device I/O).
+            If 0 (default), callbacks are executed in the GUI thread.
         """
         super().__init__()
         self.setWindowTitle(title)
@@ -22,6 +34,55 @@ class ProtoKeks(QWidget):
         self.params = {}
         self.layouts = {}
         self.layout_window = QVBoxLayout(self)
+        self._images = {}  # title -> (array, QImage) currently displayed, the array must outlive the QImage
+        self._gui_thread_id = threading.get_ident()
+        self._executor = None
+        self.set_workers(workers)
+        self.sig_invoke.connect(self._invoke)
+
+    def set_workers(self, workers):
+        """Set the number of worker threads that execute widget callbacks.
+        Parameters:
+            :param workers: int
+                If 0, callbacks are executed in the GUI thread. Use 1 worker for devices with a single serial port,
+                so that commands are still executed in the order of user input.
+        """
+        assert workers >= 0, "Number of workers must be non-negative"
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+        if workers > 0:
+            self._executor = ThreadPoolExecutor(max_workers=int(workers),
+                                                thread_name_prefix=self.windowTitle())
+
+    def in_gui_thread(self):
+        """"True if called from the thread that owns the widgets."""
+        return threading.get_ident() == self._gui_thread_id
+
+    def run_in_gui_thread(self, func, *args, **kwargs):
+        """Execute func(*args, **kwargs) in the GUI thread: immediately if called from the GUI thread,
+        otherwise queue it to the GUI event loop and return immediately."""
+        if self.in_gui_thread():
+            func(*args, **kwargs)
+        else:
+            self.sig_invoke.emit(partial(func, *args, **kwargs))
+
+    @PyQt5.QtCore.pyqtSlot(object)
+    def _invoke(self, func):
+        func()
+
+    def _dispatch(self, func, *args, **kwargs):
+        """Execute a widget callback, in the worker pool if it is active, otherwise in the GUI thread."""
+        if self._executor is None:
+            func(*args, **kwargs)
+        else:
+            future = self._executor.submit(func, *args, **kwargs)
+            future.add_done_callback(self._check_callback)
+
+    def _check_callback(self, future):
+        e = future.exception()
+        if e is not None:
+            logger.error(f"{self.windowTitle()}: callback raised {type(e).__name__}: {e}")
 
     def _insert_widget(self, title, parent, container=False, label=False):
         if parent is None:
@@ -115,7 +176,8 @@ class ProtoKeks(QWidget):
         self.params[title].setAlignment(PyQt5.QtCore.Qt.AlignRight)
         self._insert_widget(title, parent, label=True)
         if enabled and func is not None:
-            self.params[title].editingFinished.connect(lambda: func(self.params[title].value(), **func_args))
+            self.params[title].editingFinished.connect(lambda: self._dispatch(func, self.params[title].value(),
+                                                                              **func_args))
             # editingFinished() preferred over valueChanged() because the latter is too jumpy, doesn't let finish input.
 
     def add_string_field(self, title, parent=None, value='', enabled=True, func=None, max_width=100):
@@ -143,7 +205,7 @@ class ProtoKeks(QWidget):
         self.params[title].setAlignment(PyQt5.QtCore.Qt.AlignRight)
         self._insert_widget(title, parent, label=True)
         if enabled and func is not None:
-            self.params[title].editingFinished.connect(lambda: func(self.params[title].text()))
+            self.params[title].editingFinished.connect(lambda: self._dispatch(func, self.params[title].text()))
 
     def add_label(self, title, parent=None):
         assert title not in self.params, f"Widget name already exists: {title}"
@@ -163,7 +225,7 @@ class ProtoKeks(QWidget):
         assert title not in self.params, "Widget name already exists: {title}"
         self.params[title] = QPushButton(title)
         if func is not None:
-            self.params[title].clicked.connect(func)
+            self.params[title].clicked.connect(lambda: self._dispatch(func))
         self._insert_widget(title, parent)
 
     def add_checkbox(self, title, parent=None, value=False, enabled=True, func=None):
@@ -184,7 +246,7 @@ class ProtoKeks(QWidget):
         self.params[title].setChecked(value)
         self.params[title].setEnabled(enabled)
         if enabled and func is not None:
-            self.params[title].stateChanged.connect(lambda: func(self.params[title].isChecked()))
+            self.params[title].stateChanged.connect(lambda: self._dispatch(func, self.params[title].isChecked()))
         self._insert_widget(title, parent)
 
     def add_combobox(self, title, parent=None, items=['Item1', 'Item2'], value='Item1', enabled=True, func=None):
@@ -208,12 +270,65 @@ class ProtoKeks(QWidget):
         self.params[title].setEnabled(enabled)
         self.params[title].setCurrentText(value)
         if enabled and func is not None:
-            self.params[title].currentTextChanged.connect(lambda: func(self.params[title].currentText()))
+            self.params[title].currentTextChanged.connect(lambda: self._dispatch(func,
+                                                                                 self.params[title].currentText()))
         self._insert_widget(title, parent, label=True)
 
+    def add_image(self, title, parent=None, image=None, size=(512, 512), levels=None):
+        """Add an image display (QLabel) to the parent container widget.
+            Parameters
+            :param title: str
+                Name of the image. Also, serves as system name of the widget.
+            :param parent: str
+                Name of the parent container.
+            :param image: 2D numpy array, uint8 or uint16
+                Initial image, optional.
+            :param size: tuple
+                (width, height) of the display in px, the image is scaled to fit it.
+            :param levels: tuple
+                (min, max) display range of the initial image, see update_image().
+        """
+        assert title not in self.params, f"Widget name already exists: {title}"
+        self.params[title] = QLabel()
+        self.params[title].setFixedSize(int(size[0]), int(size[1]))
+        self.params[title].setAlignment(PyQt5.QtCore.Qt.AlignCenter)
+        self._insert_widget(title, parent)
+        if image is not None:
+            self.update_image(title, image, levels)
+
+    def update_image(self, title, image, levels=None):
+        """Display a 2D array (e.g. a frame of a memory-mapped stack).
+        Without levels, uint8 and uint16 images are wrapped by QImage without copying the array.
+        With levels=(min, max), the image is scaled to 8 bit for contrast.
+        Safe to call from any thread."""
+        assert isinstance(self.params.get(title), QLabel), f"Image {title} not found"
+        self.run_in_gui_thread(self._update_image, title, image, levels)
+
+    def _update_image(self, title, image, levels=None):
+        assert image.ndim == 2, f"Image must be 2D, got shape {image.shape}"
+        if levels is not None:
+            vmin, vmax = levels
+            scaled = np.subtract(image, vmin, dtype=np.float32)
+            np.multiply(scaled, 255. / max(vmax - vmin, 1e-9), out=scaled)
+            np.clip(scaled, 0, 255, out=scaled)
+            image = scaled.astype(np.uint8)
+        elif image.dtype not in (np.uint8, np.uint16):
+            image = image.astype(np.uint16)
+        if image.strides[1] != image.itemsize:
+            image = np.ascontiguousarray(image)
+        fmt = QImage.Format_Grayscale16 if image.dtype == np.uint16 else QImage.Format_Grayscale8
+        qimage = QImage(image.data, image.shape[1], image.shape[0], image.strides[0], fmt)
+        self._images[title] = (image, qimage)
+        label = self.params[title]
+        label.setPixmap(QPixmap.fromImage(qimage).scaled(label.size(), PyQt5.QtCore.Qt.KeepAspectRatio))
+
     def update_param(self, title, value):
-        """"Update parameter value, for numeric or string parameter."""
+        """"Update parameter value, for numeric or string parameter.
+        Safe to call from any thread: the widget update is queued to the GUI thread if necessary."""
         assert title in self.params, f"{title} field not found"
+        self.run_in_gui_thread(self._update_param, title, value)
+
+    def _update_param(self, title, value):
         if isinstance(self.params[title], QDoubleSpinBox):
             self.params[title].setValue(value)
         elif isinstance(self.params[title], QLineEdit):
@@ -224,3 +339,40 @@ class ProtoKeks(QWidget):
         assert title in self.params, f"{title} parameter not found"
         return self.params[title]
 
+    def get_values(self):
+        """Values of the enabled numeric, string, checkbox and combobox fields: {title: value}"""
+        values = {}
+        for title, widget in self.params.items():
+            if not widget.isEnabled():
+                continue
+            if isinstance(widget, QDoubleSpinBox):
+                values[title] = widget.value()
+            elif isinstance(widget, QLineEdit):
+                values[title] = widget.text()
+            elif isinstance(widget, QCheckBox):
+                values[title] = widget.isChecked()
+            elif isinstance(widget, QComboBox):
+                values[title] = widget.currentText()
+        return values
+
+    def set_values(self, values):
+        """Set fields from {title: value}, e.g. from get_values(), without calling their functions.
+        Unknown titles are ignored. Safe to call from any thread."""
+        self.run_in_gui_thread(self._set_values, values)
+
+    def _set_values(self, values):
+        for title, value in values.items():
+            widget = self.params.get(title)
+            if widget is None:
+                continue
+            widget.blockSignals(True)
+            if isinstance(widget, QDoubleSpinBox):
+                widget.setValue(value)
+            elif isinstance(widget, QLineEdit):
+                widget.setText(value)
+            elif isinstance(widget, QCheckBox):
+                widget.setChecked(value)
+            elif isinstance(widget, QComboBox):
+                widget.setCurrentText(value)
+            widget.blockSignals(False)
+
@@ -0,0 +1,206 @@
+"""
+Presets of instrument state: snapshot of device configs and GUI fields, saved to a JSON file,
+restored by pushing only the changed values to the devices, in dependency order.
+"""
+import copy
+import json
+import logging
+import os
+logging.basicConfig()
+
+GUI_KEY = '__gui__'  # preset entry of a device holding its ProtoKeks field values
+
+
+def _normalize(value):
+    """Convert tuples into lists (recursively), so that values compare equal before and after JSON round-trip."""
+    if isinstance(value, (list, tuple)):
+        return [_normalize(v) for v in value]
+    if isinstance(value, dict):
+        return {k: _normalize(v) for k, v in value.items()}
+    return value
+
+
+def _denormalize(value, like):
+    """Restore the container type of the current value (e.g. tuple), if the stored value is a list."""
+    if isinstance(like, tuple) and isinstance(value, list):
+        return tuple(value)
+    return value
+
+
+class PresetLibrary:
+    """Library of named presets for a set of devices.
+    Each device is any keks having `config` dictionary and `update_config(key, value)` method,
+    or an explicit config dictionary and setter function.
+    Values of the device GUI fields (ProtoKeks.params) are stored too, and sig_update_gui is emitted after restore.
+    Example:
+        presets = kekse.PresetLibrary('presets.json')
+        presets.add_device('camera', cam)
+        presets.add_device('lightsheet', ls, after=['camera'], commit=ls.setup)
+        presets.save_preset('fast survey')
+        ...
+        presets.restore('fast survey')
+    """
+    def __init__(self, filepath=None, logger_name='Presets'):
+        """
+        Parameters:
+            :param filepath: str
+                JSON file where presets are stored. If it exists, presets are loaded from it.
+        """
+        self.filepath = filepath
+        self.devices = {}
+        self.presets = {}
+        self.logger = logging.getLogger(logger_name)
+        self.logger.setLevel(logging.DEBUG)
+        if filepath is not None and os.path.exists(filepath):
+            self.load(filepath)
+
+    def add_device(self, name, device=None, config=None, setter=None, keys=None, after=(), commit=None, gui=None):
+        """Register a device.
+        Parameters:
+            :param name: str
+                Unique device name used in preset files.
+            :param device: keks object with `config` dict and `update_config(key, value)` method.
+            :param config: dict
+                Device config, if device is None or has no `config` attribute.
+            :param setter: function reference
+                setter(key, value) that pushes the value to the device. Default `device.update_config`.
+            :param keys: list of str
+                Config keys stored in presets. Default: all keys.
+            :param after: list of str
+                Names of devices that must be restored before this one.
+            :param commit: function reference
+                If given, changed values are written directly into the config, and commit() is called
+                once after all of them. Use this for devices which reconfigure hardware on every update_config()
+                call, e.g. `commit=lightsheet.setup`.
+            :param gui: ProtoKeks
+                GUI whose field values are stored in presets. Default `device.gui`, if the device has one.
+        """
+        assert name not in self.devices, f"Device name already exists: {name}"
+        if config is None:
+            assert device is not None and hasattr(device, 'config'), "Device without config, provide config dict"
+            config = device.config
+        if setter is None and commit is None:
+            if device is not None and hasattr(device, 'update_config'):
+                setter = device.update_config
+            else:
+                setter = config.__setitem__
+        if gui is None and device is not None:
+            gui = getattr(device, 'gui', None)
+        for dep in after:
+            assert dep in self.devices, f"Dependency device {dep} must be added before {name}"
+        self.devices[name] = {'config': config,
+                              'gui': gui,
+                              'signal': getattr(device, 'sig_update_gui', None),
+                              'setter': setter,
+                              'keys': list(keys) if keys is not None else None,
+                              'after': list(after),
+                              'commit': commit}
+
+    def _keys(self, name):
+        dev = self.devices[name]
+        return dev['keys'] if dev['keys'] is not None else list(dev['config'].keys())
+
+    def snapshot(self):
+        """Return a copy of the current state of all devices: {device: {key: value}}"""
+        state = {}
+        for name, dev in self.devices.items():
+            state[name] = {key: _normalize(copy.deepcopy(dev['config'][key])) for key in self._keys(name)}
+            if dev['gui'] is not None:
+                state[name][GUI_KEY] = dev['gui'].get_values()
+        return state
+
+    def save_preset(self, preset_name, save_file=True):
+        """Store the current state as a preset, and write the preset file."""
+        self.presets[preset_name] = self.snapshot()
+        self.logger.info(f"Preset saved: {preset_name}")
+        if save_file and self.filepath is not None:
+            self.save()
+
+    def delete_preset(self, preset_name):
+        assert preset_name in self.presets, f"Preset not found: {preset_name}"
+        del self.presets[preset_name]
+        if self.filepath is not None:
+            self.save()
+
+    def save(self, filepath=None):
+        """Write all presets to a JSON file."""
+        if filepath is not None:
+            self.filepath = filepath
+        assert self.filepath is not None, "Preset file path is not set"
+        with open(self.filepath, 'w') as f:
+            json.dump(self.presets, f, indent=2)
+
+    def load(self, filepath=None):
+        """Read presets from a JSON file. Presets with the same name are replaced."""
+        if filepath is not None:
+            self.filepath = filepath
+        with open(self.filepath, 'r') as f:
+            self.presets.update(json.load(f))
+        self.logger.info(f"Loaded {len(self.presets)} presets from {self.filepath}")
+
+    def diff(self, preset_name):
+        """Return the values that differ between a preset and the current state: {device: {key: value}}.
+        Devices and keys missing in the preset are ignored."""
+        assert preset_name in self.presets, f"Preset not found: {preset_name}"
+        changes = {}
+        for name, stored in self.presets[preset_name].items():
+            if name not in self.devices:
+                self.logger.warning(f"Preset {preset_name}: device {name} is not registered, skipped")
+                continue
+            dev = self.devices[name]
+            config = dev['config']
+            dev_changes = {}
+            for key in self._keys(name):
+                if key in stored and _normalize(config.get(key)) != stored[key]:
+                    dev_changes[key] = stored[key]
+            if dev['gui'] is not None and GUI_KEY in stored:
+                values = dev['gui'].get_values()  # fields not in the GUI anymore are skipped
+                gui_changes = {title: value for title, value in stored[GUI_KEY].items()
+                               if title in values and values[title] != value}
+                if gui_changes:
+                    dev_changes[GUI_KEY] = gui_changes
+            if dev_changes:
+                changes[name] = dev_changes
+        return changes
+
+    def device_order(self):
+        """Device names sorted so that each device follows its dependencies."""
+        order, visited = [], set()
+
+        def visit(name):
+            if name not in visited:
+                visited.add(name)
+                for dep in self.devices[name]['after']:
+                    visit(dep)
+                order.append(name)
+        for name in self.devices:
+            visit(name)
+        return order
+
+    def restore(self, preset_name):
+        """Push to the devices only the values that differ from the preset, in dependency order,
+        then set the changed GUI fields and emit sig_update_gui of the changed devices.
+        Returns the applied changes {device: {key: value}}, GUI fields under GUI_KEY."""
+        changes = self.diff(preset_name)
+        for name in self.device_order():
+            if name not in changes:
+                continue
+            dev = self.devices[name]
+            for key, value in changes[name].items():
+                if key == GUI_KEY:
+                    continue
+                value = _denormalize(value, dev['config'].get(key))
+                if dev['commit'] is not None:
+                    dev['config'][key] = value
+                else:
+                    dev['setter'](key, value)
+            if dev['commit'] is not None:
+                dev['commit']()
+            if GUI_KEY in changes[name]:
+                dev['gui'].set_values(changes[name][GUI_KEY])
+            if dev['signal'] is not None:
+                dev['signal'].emit()
+            self.logger.debug(f"{name}: {changes[name]}")
+        n_values = sum(len(c) - (GUI_KEY in c) + len(c.get(GUI_KEY, {})) for c in changes.values())
+        self.logger.info(f"Preset restored: {preset_name}, {n_values} values changed")
+        return changes
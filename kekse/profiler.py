@@ -0,0 +1,192 @@
+"""
+Lightweight timing profiler for device adapters.
+Spans are recorded with nanosecond timestamps into preallocated numpy arrays (ring buffer, oldest spans are
+overwritten), and exported as Chrome trace JSON, to view all devices on one timeline in chrome://tracing or Perfetto.
+Profiling is disabled by default, then a span costs one attribute check.
+Usage:
+    from kekse import profiler
+    @profiler.timed('ETL.send_cmd')
+    def _send_cmd(self, cmd): ...
+
+    with profiler.span('camera.wait'):
+        ...
+    profiler.enable()
+    ...
+    profiler.export_chrome_trace('trace.json')
+"""
+import functools
+import itertools
+import json
+import os
+import threading
+import time
+import numpy as np
+
+
+class _Span:
+    """Context manager recording one span."""
+    __slots__ = ('profiler', 'name', 't_start')
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.t_start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.profiler.record(self.name, self.t_start, time.perf_counter_ns())
+
+
+class _NullSpan:
+    """Context manager doing nothing, returned when the profiler is disabled."""
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+
+_null_span = _NullSpan()
+
+
+class Profiler:
+    def __init__(self, capacity=100000):
+        """
+        Parameters:
+            :param capacity: int
+                Maximum number of stored spans. When full, the oldest spans are overwritten.
+        """
+        self.enabled = False
+        self._lock = threading.Lock()
+        self._name_ids = {}
+        self._names = []
+        self._thread_names = {}
+        self.allocate(capacity)
+
+    def allocate(self, capacity):
+        """(Re)allocate the span arrays, all recorded spans are discarded."""
+        self.capacity = int(capacity)
+        self._start_ns = np.zeros(self.capacity, dtype=np.int64)
+        self._end_ns = np.zeros(self.capacity, dtype=np.int64)
+        self._name_id = np.zeros(self.capacity, dtype=np.int32)
+        self._thread_id = np.zeros(self.capacity, dtype=np.uint64)
+        self._counter = itertools.count()
+        self._n_recorded = 0
+
+    def clear(self):
+        self.allocate(self.capacity)
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def _get_name_id(self, name):
+        name_id = self._name_ids.get(name)
+        if name_id is None:
+            with self._lock:
+                name_id = self._name_ids.setdefault(name, len(self._names))
+                if name_id == len(self._names):
+                    self._names.append(name)
+        return name_id
+
+    def record(self, name, t_start_ns, t_end_ns):
+        """Store a span measured elsewhere, timestamps from time.perf_counter_ns()."""
+        i = next(self._counter)  # atomic under GIL, so each thread writes its own slot
+        idx = i % self.capacity
+        thread_id = threading.get_ident()
+        if thread_id not in self._thread_names:
+            self._thread_names[thread_id] = threading.current_thread().name
+        self._start_ns[idx] = t_start_ns
+        self._end_ns[idx] = t_end_ns
+        self._name_id[idx] = self._get_name_id(name)
+        self._thread_id[idx] = thread_id
+        self._n_recorded = max(self._n_recorded, i + 1)
+
+    def span(self, name):
+        """Context manager measuring the enclosed code: `with profiler.span('name'): ...`"""
+        if not self.enabled:
+            return _null_span
+        return _Span(self, name)
+
+    def timed(self, name=None):
+        """Decorator measuring each call of the function. Default name is the function's qualified name."""
+        def decorator(func):
+            span_name = func.__qualname__ if name is None else name
+
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return func(*args, **kwargs)
+                t_start = time.perf_counter_ns()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    self.record(span_name, t_start, time.perf_counter_ns())
+            return wrapper
+        return decorator
+
+    def spans(self):
+        """Return recorded spans as a structured array sorted by start time,
+        fields: name (str), start_ns, end_ns, duration_ns, thread_id."""
+        n = min(self._n_recorded, self.capacity)
+        order = np.argsort(self._start_ns[:n], kind='stable')
+        name_id = self._name_id[:n][order]
+        names = np.array(self._names, dtype=object)[name_id] if n > 0 else np.array([], dtype=object)
+        out = np.empty(n, dtype=[('name', object), ('start_ns', np.int64), ('end_ns', np.int64),
+                                 ('duration_ns', np.int64), ('thread_id', np.uint64)])
+        out['name'] = names
+        out['start_ns'] = self._start_ns[:n][order]
+        out['end_ns'] = self._end_ns[:n][order]
+        out['duration_ns'] = out['end_ns'] - out['start_ns']
+        out['thread_id'] = self._thread_id[:n][order]
+        return out
+
+    def summary(self):
+        """Statistics per span name: {name: {'count', 'total_ms', 'mean_ms', 'max_ms'}}"""
+        n = min(self._n_recorded, self.capacity)
+        durations_ms = (self._end_ns[:n] - self._start_ns[:n]) / 1e6
+        name_id = self._name_id[:n]
+        stats = {}
+        for i, name in enumerate(self._names):
+            d = durations_ms[name_id == i]
+            if d.size > 0:
+                stats[name] = {'count': int(d.size), 'total_ms': float(d.sum()),
+                               'mean_ms': float(d.mean()), 'max_ms': float(d.max())}
+        return stats
+
+    def export_chrome_trace(self, filepath):
+        """Write the recorded spans in Chrome trace event format (JSON)."""
+        spans = self.spans()
+        pid = os.getpid()
+        t0 = int(spans['start_ns'][0]) if spans.size > 0 else 0
+        events = [{'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': int(tid), 'args': {'name': name}}
+                  for tid, name in self._thread_names.items()]
+        for span in spans:
+            events.append({'name': span['name'],
+                           'cat': span['name'].split('.')[0],
+                           'ph': 'X',
+                           'ts': (int(span['start_ns']) - t0) / 1000.,
+                           'dur': int(span['duration_ns']) / 1000.,
+                           'pid': pid,
+                           'tid': int(span['thread_id'])})
+        with open(filepath, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+
+# default profiler shared by all modules
+profiler = Profiler()
+enable = profiler.enable
+disable = profiler.disable
+clear = profiler.clear
+record = profiler.record
+span = profiler.span
+timed = profiler.timed
+spans = profiler.spans
+summary = profiler.summary
+export_chrome_trace = profiler.export_chrome_trace
@@ -0,0 +1,475 @@
+"""
+Image stacks: reduction of frames on the fly, during acquisition, and lossless compressed stack files.
+"""
+import bz2
+import collections
+import json
+import logging
+import lzma
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait
+from functools import partial
+import numpy as np
+logging.basicConfig()
+
+CODECS = {'raw': (lambda data, level: data, lambda data: data),
+          'zlib': (lambda data, level: zlib.compress(data, level), zlib.decompress),
+          'lzma': (lambda data, level: lzma.compress(data, preset=level), lzma.decompress),
+          'bz2': (lambda data, level: bz2.compress(data, max(level, 1)), bz2.decompress)}
+
+
+def delta_encode(chunk):
+    """Difference of neighbour pixels along rows, modulo 2**bits of the integer dtype (lossless).
+    Smooth images become small numbers, which compress better."""
+    encoded = chunk.copy()
+    np.subtract(chunk[..., 1:], chunk[..., :-1], out=encoded[..., 1:])
+    return encoded
+
+
+def delta_decode(encoded):
+    return np.cumsum(encoded, axis=-1, dtype=encoded.dtype)
+
+
+def encode_chunk(chunk, codec='zlib', level=1, delta=True):
+    """Compress an array of frames. Returns (compressed bytes, encoding time in s).
+    Module-level function, so that it can run in a process pool."""
+    t_start = time.perf_counter()
+    if delta:
+        chunk = delta_encode(chunk)
+    data = CODECS[codec][0](np.ascontiguousarray(chunk).tobytes(), level)
+    return data, time.perf_counter() - t_start
+
+
+def decode_chunk(data, shape, dtype, codec='zlib', delta=True):
+    chunk = np.frombuffer(CODECS[codec][1](data), dtype=dtype).reshape(shape)
+    return delta_decode(chunk) if delta else chunk
+
+
+class FrameReducer:
+    """Reduce each frame of a stack as it arrives: crop -> software binning -> store,
+    and update running projections along z (max, mean) and a downsampled preview.
+    Frames are processed by a pool of worker threads (numpy releases the GIL), all outputs are preallocated.
+    Example:
+        reducer = kekse.stacks.FrameReducer((2048, 2048), n_frames=200, binning=4, projections=('max',))
+        for i, frame in enumerate(frames):
+            reducer.submit(i, frame)
+        result = reducer.finish()  # {'stack': (200, 512, 512), 'max': (512, 512), 'preview': ...}
+    """
+    def __init__(self, frame_shape, n_frames, dtype=np.uint16, crop=None, binning=1,
+                 projections=('max',), preview_factor=8, workers=2, logger_name='FrameReducer'):
+        """
+        Parameters:
+            :param frame_shape: tuple
+                (height, width) of the camera frames.
+            :param n_frames: int
+                Number of frames in the stack.
+            :param crop: tuple or None
+                (top, bottom, left, right) pixel bounds applied before binning, None for full frame.
+            :param binning: int
+                Software binning factor (mean of binning x binning pixels), 1 for no binning.
+            :param projections: tuple of str
+                Running projections along z, any of 'max', 'mean'.
+            :param preview_factor: int
+                Downsampling of the preview image (last frame), 0 for no preview.
+            :param workers: int
+                Number of worker threads, 0 to reduce frames in the calling thread.
+        """
+        self.logger = logging.getLogger(logger_name)
+        self.logger.setLevel(logging.DEBUG)
+        height, width = frame_shape
+        if crop is None:
+            crop = (0, height, 0, width)
+        top, bottom, left, right = crop
+        assert 0 <= top < bottom <= height and 0 <= left < right <= width, f"Crop {crop} outside of frame {frame_shape}"
+        assert binning >= 1, "Binning must be >= 1"
+        for proj in projections:
+            assert proj in ('max', 'mean'), f"Unknown projection: {proj}"
+        # crop to a multiple of binning
+        bottom -= (bottom - top) % binning
+        right -= (right - left) % binning
+        self.frame_shape = tuple(frame_shape)
+        self.crop = (top, bottom, left, right)
+        self.binning = int(binning)
+        self.n_frames = int(n_frames)
+        self.dtype = np.dtype(dtype)
+        self.projections = tuple(projections)
+        self.preview_factor = int(preview_factor)
+        self.out_shape = ((bottom - top) // binning, (right - left) // binning)
+        self.stack = np.zeros((self.n_frames,) + self.out_shape, dtype=self.dtype)
+        self.preview = None
+        self.n_reduced = 0
+        self.workers = int(workers)
+        self._pool = ThreadPoolExecutor(self.workers, thread_name_prefix='FrameReducer') if self.workers > 0 else None
+        self._futures = []
+        self._lock = threading.Lock()
+        # per-worker partial projections, merged by projection(), so the workers never wait for each other
+        self._local = threading.local()
+        self._partials = []
+
+    @property
+    def reduction_factor(self):
+        """Ratio of raw to reduced stack size."""
+        return (self.frame_shape[0] * self.frame_shape[1]) / (self.out_shape[0] * self.out_shape[1])
+
+    def submit(self, index, frame):
+        """Reduce the frame into position index of the stack. Returns a Future, or None if reduced immediately."""
+        assert frame.shape == self.frame_shape, f"Frame shape {frame.shape}, expected {self.frame_shape}"
+        if self._pool is None:
+            self._reduce(index, frame)
+            return None
+        future = self._pool.submit(self._reduce, index, frame)
+        self._futures.append(future)
+        return future
+
+    def submit_frames(self, frames, start_index=0):
+        """Reduce a list of frames into consecutive stack positions."""
+        for i, frame in enumerate(frames):
+            self.submit(start_index + i, frame)
+
+    def _get_partial(self):
+        partial = getattr(self._local, 'partial', None)
+        if partial is None:
+            partial = {'count': 0, 'acc': np.zeros(self.out_shape, dtype=np.uint32)}
+            if 'max' in self.projections:
+                partial['max'] = np.zeros(self.out_shape, dtype=self.dtype)
+            if 'mean' in self.projections:
+                partial['sum'] = np.zeros(self.out_shape, dtype=np.float64)
+            self._local.partial = partial
+            with self._lock:
+                self._partials.append(partial)
+        return partial
+
+    def _reduce(self, index, frame):
+        top, bottom, left, right = self.crop
+        cropped = frame[top:bottom, left:right]
+        out = self.stack[index]
+        partial = self._get_partial()
+        b = self.binning
+        if b == 1:
+            out[:] = cropped
+        else:
+            # sum of b*b strided views into the worker's accumulator, much faster than reshape().sum(axis=(1, 3))
+            acc = partial['acc']
+            acc[:] = 0
+            blocks = cropped.reshape(self.out_shape[0], b, self.out_shape[1], b)
+            for i in range(b):
+                for j in range(b):
+                    np.add(acc, blocks[:, i, :, j], out=acc)
+            np.floor_divide(acc, b * b, out=out, casting='unsafe')
+        if 'max' in partial:
+            np.maximum(partial['max'], out, out=partial['max'])
+        if 'sum' in partial:
+            partial['sum'] += out
+        partial['count'] += 1
+        if self.preview_factor > 0:
+            self.preview = out[::self.preview_factor, ::self.preview_factor]
+        with self._lock:
+            self.n_reduced += 1
+
+    def projection(self, kind='max'):
+        """Current projection along z of the frames reduced so far."""
+        assert kind in self.projections, f"Projection not computed: {kind}"
+        with self._lock:
+            partials = list(self._partials)
+        if kind == 'max':
+            result = np.zeros(self.out_shape, dtype=self.dtype)
+            for partial in partials:
+                np.maximum(result, partial['max'], out=result)
+        else:
+            result = np.zeros(self.out_shape, dtype=np.float64)
+            count = 0
+            for partial in partials:
+                result += partial['sum']
+                count += partial['count']
+            result /= max(count, 1)
+        return result
+
+    def finish(self, timeout_s=None):
+        """Wait until all submitted frames are reduced.
+        Returns dict with the reduced 'stack', projections by name and 'preview'."""
+        done, not_done = wait(self._futures, timeout=timeout_s)
+        for future in done:
+            if future.exception() is not None:
+                self.logger.error(f"Frame reduction failed: {future.exception()}")
+        if not_done:
+            self.logger.error(f"Frame reduction timeout, {len(not_done)} frames not reduced")
+        self._futures = []
+        result = {'stack': self.stack, 'preview': self.preview}
+        for kind in self.projections:
+            result[kind] = self.projection(kind)
+        return result
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=True)
+            self._pool = None
+
+
+class StackWriter:
+    """Write frames into a binary file of independently compressed chunks, and a JSON header describing them.
+    Chunks are compressed by a pool of processes while the next frames arrive, and written in order.
+    Compression ratio and speed are measured for each chunk.
+    Example:
+        with kekse.stacks.StackWriter('stack_t0000', (2048, 2048), codec='zlib', level=1) as writer:
+            for frame in frames:
+                writer.write(frame)
+        print(writer.stats())
+    Files: stack_t0000.bin (chunks) and stack_t0000.json (header).
+    """
+    def __init__(self, filepath, frame_shape, dtype=np.uint16, codec='zlib', level=1, delta=True,
+                 chunk_frames=8, workers=2, executor=None, logger_name='StackWriter'):
+        """
+        Parameters:
+            :param filepath: str
+                File path without extension.
+            :param codec: str
+                'raw' (no compression), 'zlib', 'lzma', 'bz2'. Fast: 'zlib' level 1, small files: 'lzma'.
+            :param level: int
+                Compression level of the codec.
+            :param delta: bool
+                Store differences of neighbour pixels, usually improves the compression ratio of images.
+            :param chunk_frames: int
+                Number of frames per compressed chunk.
+            :param workers: int
+                Number of compressing processes, 0 to compress in the calling thread.
+            :param executor: concurrent.futures.Executor
+                Existing process pool shared by several writers, instead of a new pool of workers.
+        """
+        assert codec in CODECS, f"Unknown codec {codec}, available: {list(CODECS.keys())}"
+        self.logger = logging.getLogger(logger_name)
+        self.logger.setLevel(logging.DEBUG)
+        self.filepath = filepath
+        self.frame_shape = tuple(frame_shape)
+        self.dtype = np.dtype(dtype)
+        self.codec = codec
+        self.level = int(level)
+        self.delta = bool(delta) and codec != 'raw'
+        self.chunk_frames = int(chunk_frames)
+        self.n_frames = 0
+        self.chunks = []
+        self._buffer = np.empty((self.chunk_frames,) + self.frame_shape, dtype=self.dtype)
+        self._n_buffered = 0
+        self._pending = collections.deque()
+        self._max_pending = 2 * max(workers, 1)
+        self._own_pool = executor is None and workers > 0
+        self._pool = executor if executor is not None else (ProcessPoolExecutor(workers) if workers > 0 else None)
+        self._file = open(filepath + '.bin', 'wb')
+        self._offset = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def write(self, frame):
+        """Add one frame to the stack."""
+        assert frame.shape == self.frame_shape, f"Frame shape {frame.shape}, expected {self.frame_shape}"
+        self._buffer[self._n_buffered] = frame
+        self._n_buffered += 1
+        self.n_frames += 1
+        if self._n_buffered == self.chunk_frames:
+            self._submit_chunk()
+
+    def write_frames(self, frames):
+        for frame in frames:
+            self.write(frame)
+
+    def _submit_chunk(self):
+        chunk = self._buffer[:self._n_buffered].copy()
+        self._n_buffered = 0
+        if self._pool is None:
+            self._write_chunk(chunk.shape, *encode_chunk(chunk, self.codec, self.level, self.delta))
+            return
+        self._pending.append((chunk.shape, self._pool.submit(encode_chunk, chunk, self.codec, self.level, self.delta)))
+        # write finished chunks in order, and wait for the oldest one if too many chunks are in flight
+        while self._pending and (self._pending[0][1].done() or len(self._pending) > self._max_pending):
+            shape, future = self._pending.popleft()
+            self._write_chunk(shape, *future.result())
+
+    def _write_chunk(self, shape, data, encode_s):
+        self._file.write(data)
+        raw_nbytes = int(np.prod(shape)) * self.dtype.itemsize
+        self.chunks.append({'offset': self._offset,
+                            'nbytes': len(data),
+                            'n_frames': shape[0],
+                            'ratio': raw_nbytes / max(len(data), 1),
+                            'MB_per_s': raw_nbytes / 1e6 / max(encode_s, 1e-9)})
+        self._offset += len(data)
+
+    def header(self):
+        return {'frame_shape': list(self.frame_shape),
+                'dtype': self.dtype.str,
+                'n_frames': self.n_frames,
+                'codec': self.codec,
+                'level': self.level,
+                'delta': self.delta,
+                'chunk_frames': self.chunk_frames,
+                'chunks': self.chunks}
+
+    def close(self):
+        """Compress the remaining frames, write the header and close the files."""
+        if self._file is None:
+            return
+        if self._n_buffered > 0:
+            self._submit_chunk()
+        while self._pending:
+            shape, future = self._pending.popleft()
+            self._write_chunk(shape, *future.result())
+        if self._own_pool:
+            self._pool.shutdown()
+        self._pool = None
+        self._file.close()
+        self._file = None
+        with open(self.filepath + '.json', 'w') as f:
+            json.dump(self.header(), f, indent=1)
+        stats = self.stats()
+        self.logger.debug(f"{self.filepath}: {self.n_frames} frames, ratio {stats['ratio']:.2f}, "
+                          f"compression {stats['MB_per_s']:.0f} MB/s per worker")
+
+    def stats(self):
+        """Overall compression ratio and mean compression speed (MB/s per worker)."""
+        if not self.chunks:
+            return {'ratio': 1.0, 'MB_per_s': 0.0}
+        raw = sum(c['nbytes'] * c['ratio'] for c in self.chunks)
+        return {'ratio': raw / max(sum(c['nbytes'] for c in self.chunks), 1),
+                'MB_per_s': float(np.mean([c['MB_per_s'] for c in self.chunks]))}
+
+
+def read_stack(filepath):
+    """Read a whole stack written by StackWriter into memory, returns array (n_frames, height, width).
+    For large stacks, use StackReader."""
+    with open(filepath + '.json') as f:
+        header = json.load(f)
+    shape = tuple(header['frame_shape'])
+    stack = np.empty((header['n_frames'],) + shape, dtype=np.dtype(header['dtype']))
+    i = 0
+    with open(filepath + '.bin', 'rb') as f:
+        for chunk in header['chunks']:
+            f.seek(chunk['offset'])
+            data = f.read(chunk['nbytes'])
+            n = chunk['n_frames']
+            stack[i:i + n] = decode_chunk(data, (n,) + shape, stack.dtype, header['codec'], header['delta'])
+            i += n
+    return stack
+
+
+class StackReader:
+    """Lazy read-only (t, z, y, x) array of stacks written by StackWriter, one file per time point.
+    Raw stacks are memory-mapped: indexing returns views of the file, pages are read by the OS on access.
+    Compressed stacks are decoded chunk by chunk on access, the last decoded chunks are cached.
+    Example:
+        data = kekse.stacks.StackReader(['stack_t0000', 'stack_t0001'])
+        data.shape  # (2, n_frames, height, width)
+        frame = data[1, 50]  # 2D array
+        mip = data[0, :, 100:200].max(axis=0)
+    """
+    def __init__(self, filepaths, cache_chunks=4):
+        """
+        Parameters:
+            :param filepaths: str or list of str
+                File path(s) without extension, one per time point. All stacks must have the same shape and dtype.
+            :param cache_chunks: int
+                Number of decoded chunks kept in memory, for compressed stacks.
+        """
+        if isinstance(filepaths, str):
+            filepaths = [filepaths]
+        assert len(filepaths) > 0, "No stack files given"
+        self.filepaths = list(filepaths)
+        self.headers = []
+        for filepath in self.filepaths:
+            with open(filepath + '.json') as f:
+                self.headers.append(json.load(f))
+        h0 = self.headers[0]
+        for filepath, header in zip(self.filepaths, self.headers):
+            assert (header['frame_shape'], header['dtype'], header['n_frames']) == \
+                   (h0['frame_shape'], h0['dtype'], h0['n_frames']), f"Stack {filepath} differs from {self.filepaths[0]}"
+        self.dtype = np.dtype(h0['dtype'])
+        self.shape = (len(self.filepaths), h0['n_frames']) + tuple(h0['frame_shape'])
+        self._maps = [None] * len(self.filepaths)
+        self._chunk_starts = [np.cumsum([0] + [c['n_frames'] for c in h['chunks']]) for h in self.headers]
+        self._cache = collections.OrderedDict()
+        self._cache_chunks = int(cache_chunks)
+        self._lock = threading.Lock()
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def _memmap(self, t):
+        if self._maps[t] is None:
+            self._maps[t] = np.memmap(self.filepaths[t] + '.bin', dtype=self.dtype, mode='r',
+                                      shape=self.shape[1:])
+        return self._maps[t]
+
+    def _chunk(self, t, i_chunk):
+        key = (t, i_chunk)
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                return self._cache[key]
+        header = self.headers[t]
+        chunk = header['chunks'][i_chunk]
+        with open(self.filepaths[t] + '.bin', 'rb') as f:
+            f.seek(chunk['offset'])
+            data = f.read(chunk['nbytes'])
+        frames = decode_chunk(data, (chunk['n_frames'],) + self.shape[2:], self.dtype, header['codec'], header['delta'])
+        with self._lock:
+            self._cache[key] = frames
+            while len(self._cache) > self._cache_chunks:
+                self._cache.popitem(last=False)
+        return frames
+
+    def stack(self, t):
+        """Stack of time point t as (z, y, x) array: a memory map of raw files, decoded frames otherwise."""
+        if self.headers[t]['codec'] == 'raw':
+            return self._memmap(t)
+        return np.concatenate([self._chunk(t, i) for i in range(len(self.headers[t]['chunks']))])
+
+    def frame(self, t, z):
+        """Single frame (y, x), without copying if the stack is raw."""
+        if self.headers[t]['codec'] == 'raw':
+            return self._memmap(t)[z]
+        z = range(self.shape[1])[z]
+        i_chunk = int(np.searchsorted(self._chunk_starts[t], z, side='right')) - 1
+        return self._chunk(t, i_chunk)[z - self._chunk_starts[t][i_chunk]]
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        assert len(key) <= 4, f"Too many indices for a (t, z, y, x) array: {key}"
+        key = key + (slice(None),) * (4 - len(key))
+        t_key, z_key, yx_key = key[0], key[1], key[2:]
+        if isinstance(t_key, (int, np.integer)):
+            return self._get_stack(int(t_key), z_key, yx_key)
+        t_indices = range(self.shape[0])[t_key]
+        return np.stack([self._get_stack(t, z_key, yx_key) for t in t_indices])
+
+    def _get_stack(self, t, z_key, yx_key):
+        if self.headers[t]['codec'] == 'raw':
+            return self._memmap(t)[(z_key,) + yx_key]
+        if isinstance(z_key, (int, np.integer)):
+            return self.frame(t, int(z_key))[yx_key]
+        return np.stack([self.frame(t, z)[yx_key] for z in range(self.shape[1])[z_key]])
+
+
+def view_stack(reader, title='Stack viewer', levels=None):
+    """Build a ProtoKeks window browsing a StackReader by time point and z plane. Returns the window, call show().
+    Only the displayed frame is read from disk."""
+    from .kekse import ProtoKeks
+    gui = ProtoKeks(title)
+    gui.add_groupbox('Position')
+    state = {'t': 0, 'z': 0}
+
+    def show(key, value):
+        state[key] = int(value)
+        gui.update_image('Image', reader.frame(state['t'], state['z']), levels=levels)
+    gui.add_numeric_field('t', 'Position', value=0, vrange=(0, reader.shape[0] - 1, 1), func=partial(show, 't'))
+    gui.add_numeric_field('z', 'Position', value=0, vrange=(0, reader.shape[1] - 1, 1), func=partial(show, 'z'))
+    gui.add_image('Image', image=reader.frame(0, 0), levels=levels)
+    return gui
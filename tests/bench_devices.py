@@ -0,0 +1,299 @@
+"""
+Headless benchmarks of device adapters against simulated hardware (fake serial ports, fake DCAM and DAQmx).
+Results are stored as JSON, and compared against a baseline file, if given.
+Run from the parent directory:
+    python -m tests.bench_devices --output bench.json
+    python -m tests.bench_devices --baseline bench.json --tolerance 0.2
+Exit code is 1 if any benchmark is slower than baseline by more than the tolerance.
+"""
+import argparse
+import ctypes
+import json
+import logging
+import os
+import platform
+import sys
+import time
+import types
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+import numpy as np
+from PyQt5.QtWidgets import QApplication
+
+
+class FakeSerial:
+    """Serial port replying instantly with responder(command) to each write().
+    If command_terminator is given, a write is split into commands, each answered by the responder."""
+    def __init__(self, responder, terminator=b'\r\n', command_terminator=None):
+        self.responder = responder
+        self.terminator = terminator
+        self.command_terminator = command_terminator
+        self.response = b''
+        self.in_waiting = 0
+        self.is_open = True
+
+    def write(self, data):
+        data = bytes(data)
+        if self.command_terminator is None:
+            self.response = self.responder(data)
+        else:
+            commands = data.split(self.command_terminator)[:-1]
+            self.response = b''.join(self.responder(command + self.command_terminator) for command in commands)
+        return len(data)
+
+    def read_until(self, terminator=None, size=None):
+        if self.command_terminator is not None:
+            end = self.response.find(terminator or self.terminator)
+            if end >= 0:
+                end += len(terminator or self.terminator)
+                response, self.response = self.response[:end], self.response[end:]
+                return response
+        response, self.response = self.response, b''
+        return response
+
+    def readline(self):
+        return self.read_until()
+
+    def read(self, size=1):
+        response, self.response = self.response[:size], self.response[size:]
+        return response
+
+    def reset_input_buffer(self):
+        self.response = b''
+
+    def reset_output_buffer(self):
+        pass
+
+    flushInput = reset_input_buffer
+    flushOutput = reset_output_buffer
+
+    def close(self):
+        self.is_open = False
+
+
+class FakeDcam:
+    """Minimal DCAM API: a camera streaming frames into a ring of buffers, k frames per wait."""
+    def __init__(self, frame_shape, n_buffers, frames_per_wait):
+        self.frames = np.zeros((n_buffers,) + tuple(frame_shape), dtype=np.uint16)
+        self.n_buffers = n_buffers
+        self.frames_per_wait = frames_per_wait
+        self.frame_count = 0
+        self.framestamps = np.zeros(n_buffers, dtype=np.int64)
+
+    def dcamwait_start(self, wait_handle, p_param):
+        return 1
+
+    def dcamcap_transferinfo(self, camera_handle, p_param):
+        for i in range(self.frames_per_wait):
+            self.framestamps[(self.frame_count + i) % self.n_buffers] = self.frame_count + i
+        self.frame_count += self.frames_per_wait
+        p_param._obj.nNewestFrameIndex = (self.frame_count - 1) % self.n_buffers
+        p_param._obj.nFrameCount = self.frame_count
+        return 1
+
+    def dcambuf_lockframe(self, camera_handle, p_param):
+        frame = p_param._obj
+        frame.buf = self.frames[frame.iFrame].ctypes.data
+        frame.framestamp = self.framestamps[frame.iFrame]
+        return 1
+
+    def __getattr__(self, name):
+        return lambda *args: 1
+
+
+class FakeTask:
+    """DAQmx task accepting all calls."""
+    def __getattr__(self, name):
+        return lambda *args: 0
+
+
+def fake_pydaqmx():
+    module = types.ModuleType('PyDAQmx')
+    module.Task = FakeTask
+    module.DAQException = type('DAQException', (Exception,), {'message': ''})
+    for name in ('DAQmx_Val_Volts', 'DAQmx_Val_Rising', 'DAQmx_Val_FiniteSamps', 'DAQmx_Val_ContSamps',
+                 'DAQmx_StartTrig_Retriggerable', 'DAQmx_Val_GroupByScanNumber', 'DAQmx_Val_DoNotAllowRegen',
+                 'DAQmx_Val_AllowRegen'):
+        setattr(module, name, 0)
+    return module
+
+
+def install_fakes():
+    """Make the device modules importable without vendor drivers."""
+    if not hasattr(ctypes, 'windll'):
+        ctypes.windll = types.SimpleNamespace(dcamapi=FakeDcam((1, 1), 1, 1))
+    try:
+        import PyDAQmx
+    except (ImportError, OSError, NotImplementedError):
+        sys.modules['PyDAQmx'] = fake_pydaqmx()
+
+
+def measure(func, n_ops, repeat=5):
+    """Best rate (ops/s) of func() performing n_ops operations, over repeat runs."""
+    best_s = float('inf')
+    for _ in range(repeat):
+        t_start = time.perf_counter()
+        func()
+        best_s = min(best_s, time.perf_counter() - t_start)
+    return n_ops / best_s
+
+
+def etl_responder(crc):
+    replies = {b'Start': b'Ready\r\n', b'Ar': b'A\x01\x00', b'TCA': b'TCA\x01\x90', b'Sr': b'S\x00\x00\x00\x00'}
+
+    def respond(cmd):
+        if cmd == b'Start':
+            return replies[cmd]
+        for prefix, payload in replies.items():
+            if cmd.startswith(prefix):
+                return payload + crc(payload) + b'\r\n'
+        return b''
+    return respond
+
+
+def asi_responder(cmd):
+    if cmd.startswith(b'/'):
+        return b'N\r\n'
+    if cmd.startswith(b'W X Y'):
+        return b':A 1000 2000\r\n'
+    if cmd.startswith(b's x? y?'):
+        return b':A X=7.5 Y=7.5\r\n'
+    return b':A\r\n'
+
+
+def bench_etl(n_ops=2000):
+    from devices import etl_controller_Optotune
+    etl = etl_controller_Optotune.ETLController(gui_on=False)
+    etl._ser = FakeSerial(etl_responder(etl.calc_crc))
+    currents = np.linspace(-30, 30, n_ops)
+    results = {'etl_setpoints_per_s': measure(lambda: [etl.set_current(c) for c in currents], n_ops),
+               'etl_queries_per_s': measure(lambda: [etl.get_current() for _ in range(n_ops)], n_ops)}
+    return results
+
+
+def bench_asi(n_ops=500):
+    from devices import stage_ASI_MS2000
+    stage = stage_ASI_MS2000.MotionController(gui_on=False)
+    simulation, stage.config['simulation'] = stage.config['simulation'], False
+    stage._ser = FakeSerial(asi_responder, command_terminator=b'\r')
+    try:
+        rate = measure(lambda: [stage.move_abs((0.1 * i, 0.0), sleep_s=0) for i in range(n_ops)], n_ops)
+        setup_rate = measure(lambda: [stage._setup_scan() for _ in range(n_ops)], n_ops)
+    finally:
+        stage.config['simulation'] = simulation
+    return {'asi_moves_per_s': rate, 'asi_scan_setup_ms': 1000. / setup_rate}
+
+
+def bench_camera(n_waits=50, frames_per_wait=10):
+    from devices import hamamatsu_camera
+    shape = hamamatsu_camera.config['image_shape']
+    n_buffers = 4 * frames_per_wait
+    hamamatsu_camera.dcam = FakeDcam(shape, n_buffers, frames_per_wait)
+    cam = hamamatsu_camera.HamamatsuCamera.__new__(hamamatsu_camera.HamamatsuCamera)
+    cam.camera_handle = cam.wait_handle = None
+    cam.debug = False
+    cam.frame_y, cam.frame_x = shape
+    cam.frame_bytes = 2 * shape[0] * shape[1]
+    cam.number_image_buffers = n_buffers
+    cam.buffer_index = -1
+    cam.last_frame_number = cam.max_backlog = 0
+    cam.allocateMetadata(n_buffers)
+    rate = measure(lambda: [cam.getFrames() for _ in range(n_waits)], n_waits * frames_per_wait, repeat=3)
+    return {'camera_frames_per_s': rate}
+
+
+def bench_reduction(n_frames=100, binning=4):
+    from kekse.stacks import FrameReducer
+    shape = (2048, 2048)
+    frames = [np.zeros(shape, dtype=np.uint16) for _ in range(4)]
+
+    def run():
+        reducer = FrameReducer(shape, n_frames, binning=binning, projections=('max',), workers=2)
+        for i in range(n_frames):
+            reducer.submit(i, frames[i % len(frames)])
+        reducer.finish()
+        reducer.close()
+    return {'reduction_frames_per_s': measure(run, n_frames, repeat=3)}
+
+
+def bench_compression(n_frames=8):
+    """Compression speed of one worker (MB/s) and ratio, on frames of camera-like noise over a smooth background."""
+    import tempfile
+    from kekse.stacks import StackWriter
+    rng = np.random.default_rng(0)
+    y, x = np.mgrid[:1024, :1024]
+    frames = (100 + 50 * np.exp(-((x - 512) ** 2 + (y - 512) ** 2) / 2e5) +
+              rng.poisson(10, size=(n_frames, 1024, 1024))).astype(np.uint16)
+    results = {}
+    for codec, level in (('zlib', 1), ('lzma', 0)):
+        filepath = os.path.join(tempfile.mkdtemp(), 'stack')
+        writer = StackWriter(filepath, frames.shape[1:], codec=codec, level=level, chunk_frames=n_frames, workers=0)
+        writer.write_frames(frames)
+        writer.close()
+        stats = writer.stats()
+        results[f'{codec}_MB_per_s'] = stats['MB_per_s']
+        results[f'{codec}_ratio'] = stats['ratio']
+    return results
+
+
+def bench_waveform(n_ops=200):
+    from devices import lightsheet_generator
+    ls = lightsheet_generator.LightsheetGenerator(gui_on=False)
+    ls.daqmx_task = FakeTask()
+    rate = measure(lambda: [ls.task_config(1.0, 0.0, 0.5, 5.0) for _ in range(n_ops)], n_ops)
+    return {'waveform_rebuild_ms': 1000. / rate}
+
+
+def bench_gui(n_ops=20):
+    from devices import device_template
+    rate = measure(lambda: [device_template.Device(gui_on=True) for _ in range(n_ops)], n_ops, repeat=3)
+    return {'panel_build_ms': 1000. / rate}
+
+
+LOWER_IS_BETTER = ('_ms',)
+
+
+def compare(results, baseline, tolerance):
+    """Return list of regressions: (name, value, baseline value)."""
+    regressions = []
+    for name, value in results.items():
+        if name not in baseline:
+            continue
+        ref = baseline[name]
+        if name.endswith(LOWER_IS_BETTER):
+            regressed = value > ref * (1 + tolerance)
+        else:
+            regressed = value < ref * (1 - tolerance)
+        print(f"{name:28s} {value:12.3f}  baseline {ref:12.3f}  {'REGRESSION' if regressed else 'ok'}")
+        if regressed:
+            regressions.append((name, value, ref))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--output', help='JSON file to store the results')
+    parser.add_argument('--baseline', help='JSON file with baseline results')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed relative slowdown, default 0.2')
+    args = parser.parse_args(argv)
+    logging.disable(logging.INFO)  # measure device code, not console output
+    install_fakes()
+    app = QApplication.instance() or QApplication(sys.argv)
+    results = {}
+    for bench in (bench_etl, bench_asi, bench_camera, bench_reduction, bench_compression, bench_waveform, bench_gui):
+        results.update(bench())
+    for name, value in results.items():
+        print(f"{name:28s} {value:12.3f}")
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'python': platform.python_version(), 'numpy': np.__version__,
+                       'time': time.strftime('%Y-%m-%d %H:%M:%S'), 'results': results}, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        if compare(results, baseline, args.tolerance):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
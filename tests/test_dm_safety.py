@@ -0,0 +1,51 @@
+import os
+import unittest
+import numpy as np
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+from tests.bench_devices import install_fakes
+
+
+class TestSafety(unittest.TestCase):
+    def setUp(self):
+        install_fakes()
+        from devices import deformable_mirror_Mirao52e
+        self.dm = deformable_mirror_Mirao52e
+        rng = np.random.default_rng(0)
+        self.commands = rng.uniform(-3, 3, (200, 52))
+        self.commands[0, 5] = np.nan
+        self.commands[1, 7] = np.inf
+
+    def test_neighbor_pairs(self):
+        """
+        8 x 8 grid without corners: 52 actuators, 88 horizontal and vertical neighbor pairs.
+        """
+        self.assertEqual(len(self.dm.actuator_layout()), 52)
+        self.assertEqual(len(self.dm.NEIGHBOR_PAIRS), 88)
+
+    def test_check_commands(self):
+        """
+        Each limit is checked: actuator range, total stroke, neighbor difference, finite values.
+        """
+        safe = np.full((5, 52), 0.1)
+        safe[1, 0] = 1.5
+        safe[2, :] = 0.6
+        safe[3, 0] = 0.8
+        safe[4, 0] = np.nan
+        np.testing.assert_array_equal(self.dm.check_commands(safe, 0.6), [True, False, False, False, False])
+        np.testing.assert_array_equal(self.dm.check_commands(safe), [True, False, False, True, False])
+
+    def test_clip_then_check(self):
+        """
+        Clipped commands pass the check, for every neighbor limit, without NaN.
+        """
+        for limit in (None, 0.6, 0.01, 0.0):
+            clipped = self.dm.clip_commands(self.commands, limit)
+            self.assertTrue(np.all(np.isfinite(clipped)))
+            self.assertFalse(np.any(~self.dm.check_commands(clipped, limit)), f"max_neighbor_diff {limit}")
+        # safe commands are not changed
+        safe = np.full((1, 52), 0.1)
+        np.testing.assert_array_equal(self.dm.clip_commands(safe, 0.6), safe)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,48 @@
+import os
+import unittest
+import numpy as np
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+from tests.bench_devices import install_fakes
+
+
+class TestCalibration(unittest.TestCase):
+    def setUp(self):
+        install_fakes()
+        from devices import etl_controller_Optotune
+        self.calibration = etl_controller_Optotune.ETLCalibration(lut_step_um=0.05)
+
+    def test_monotonic_inversion(self):
+        """
+        Noisy non-monotonic points are fitted monotonically, current(z) inverts z(current).
+        """
+        rng = np.random.default_rng(0)
+        currents = np.linspace(-100, 100, 41)
+        for c in currents:
+            self.calibration.add_point(c, -2.0 * c + rng.normal(0, 1.0), 25.0)
+        self.calibration.fit()
+        self.assertEqual(self.calibration.sign, -1)
+        z = self.calibration.z(currents)
+        self.assertTrue(np.all(np.diff(z) <= 0))
+        z_min, z_max = self.calibration.z_range()
+        z_grid = np.linspace(z_min, z_max, 200)
+        current = self.calibration.current(z_grid)
+        self.assertTrue(np.all(np.diff(current) <= 1e-9))
+        np.testing.assert_allclose(self.calibration.z(current), z_grid, atol=0.05)
+        # outside of the calibrated range, the current is clipped
+        self.assertAlmostEqual(self.calibration.current(z_max + 100), self.calibration.current(z_max))
+
+    def test_temperature_compensation(self):
+        """
+        Temperature coefficient is fitted, and shifts the current at the same z.
+        """
+        for temp in (20.0, 30.0):
+            for c in np.linspace(-50, 50, 11):
+                self.calibration.add_point(c, 1.5 * c + 0.4 * (temp - 25.0), temp)
+        self.calibration.fit()
+        self.assertAlmostEqual(self.calibration.temp_coeff, 0.4, places=6)
+        self.assertAlmostEqual(self.calibration.current(10.0, temperature_C=25.0), 10.0 / 1.5, places=3)
+        self.assertAlmostEqual(self.calibration.current(10.0, temperature_C=30.0), 8.0 / 1.5, places=3)
+
+
+if __name__ == '__main__':
+    unittest.main()
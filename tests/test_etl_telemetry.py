@@ -0,0 +1,53 @@
+import os
+import sys
+import threading
+import time
+import unittest
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+from PyQt5.QtWidgets import QApplication
+from tests.bench_devices import FakeSerial, etl_responder, install_fakes
+
+
+class TestTelemetry(unittest.TestCase):
+    def setUp(self):
+        install_fakes()
+        from devices import etl_controller_Optotune
+        self.app = QApplication.instance() or QApplication(sys.argv)
+        self.etl = etl_controller_Optotune.ETLController(gui_on=True)
+        self.etl._ser = FakeSerial(etl_responder(self.etl.calc_crc))
+
+    def tearDown(self):
+        self.etl.stop_telemetry()
+
+    def test_telemetry_cycle_with_gui(self):
+        """One telemetry cycle updates the GUI, status is shown as text."""
+        self.etl.start_telemetry(period_s=10.0)
+        t_end = time.time() + 2.0
+        while len(self.etl.telemetry()) == 0 and time.time() < t_end:
+            time.sleep(0.01)
+        self.app.processEvents()  # deliver sig_update_gui from the telemetry thread
+        self.assertEqual(len(self.etl.telemetry()), 1)
+        self.assertIsInstance(self.etl._status, str)
+        self.assertEqual(self.etl.gui.get_param('Status').text(), self.etl._status)
+
+    def test_commands_during_stop(self):
+        """Commands sent from other threads while telemetry starts and stops never block."""
+        stop = threading.Event()
+
+        def send():
+            while not stop.is_set():
+                self.etl.get_current()
+        threads = [threading.Thread(target=send, daemon=True) for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        for _ in range(50):
+            self.etl.start_telemetry(period_s=0.001)
+            self.etl.stop_telemetry()
+        stop.set()
+        for thread in threads:
+            thread.join(timeout=2.0)
+            self.assertFalse(thread.is_alive())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+import unittest
+import os
+import sys
+import tempfile
+import kekse
+from PyQt5 import QtCore
+from PyQt5.QtWidgets import QApplication
+
+
+class GuiDevice(QtCore.QObject):
+    sig_update_gui = QtCore.pyqtSignal()
+
+    def __init__(self):
+        super().__init__()
+        self.config = {'exposure_ms': 10.0}
+        self.updates = 0
+        self.gui = kekse.ProtoKeks('Device')
+        self.gui.add_groupbox('Settings')
+        self.gui.add_numeric_field('Exposure, ms', 'Settings', value=10.0, vrange=[0, 100, 0.1])
+        self.gui.add_checkbox('Loop', 'Settings', value=False, func=lambda value: self.update_config('loop', value))
+        self.gui.add_string_field('Status', 'Settings', value='Idle', enabled=False)
+        self.sig_update_gui.connect(self._update_gui)
+
+    def update_config(self, key, value):
+        self.config[key] = value
+
+    def _update_gui(self):
+        self.updates += 1
+
+
+class TestPresets(unittest.TestCase):
+    def setUp(self):
+        self.calls = []
+        self.stage = {'speed': 1.0, 'limits': (0.0, 1.0)}
+        self.ls = {'swipe_duration_ms': 1.0, 'active_arm': 'left'}
+        self.filepath = os.path.join(tempfile.mkdtemp(), 'presets.json')
+
+    def _stage_setter(self, key, value):
+        self.calls.append(('stage', key, value))
+        self.stage[key] = value
+
+    def _library(self):
+        presets = kekse.PresetLibrary(self.filepath)
+        presets.add_device('stage', config=self.stage, setter=self._stage_setter)
+        presets.add_device('lightsheet', config=self.ls, after=['stage'],
+                           commit=lambda: self.calls.append(('lightsheet', 'commit', None)))
+        return presets
+
+    def test_restore_diff_only(self):
+        """
+        Only changed values are pushed, dependencies first, types preserved after JSON round-trip.
+        """
+        self._library().save_preset('A')
+        self.stage['limits'] = (0.5, 2.0)
+        self.ls['active_arm'] = 'right'
+        presets = self._library()
+        changes = presets.restore('A')
+        self.assertEqual(changes, {'stage': {'limits': [0.0, 1.0]}, 'lightsheet': {'active_arm': 'left'}})
+        self.assertEqual(self.calls, [('stage', 'limits', (0.0, 1.0)), ('lightsheet', 'commit', None)])
+        self.assertEqual(self.ls['active_arm'], 'left')
+        self.assertEqual(presets.diff('A'), {})
+
+
+    def test_restore_gui(self):
+        """
+        Enabled GUI fields are stored and restored without calling their functions, and the GUI is updated.
+        """
+        app = QApplication.instance() or QApplication(sys.argv)
+        device = GuiDevice()
+        presets = kekse.PresetLibrary(self.filepath)
+        presets.add_device('device', device)
+        presets.save_preset('A')
+        self.assertEqual(presets.presets['A']['device'][kekse.presets.GUI_KEY],
+                         {'Exposure, ms': 10.0, 'Loop': False})
+        device.gui.get_param('Exposure, ms').setValue(20.0)
+        device.gui.get_param('Loop').setChecked(True)  # calls update_config('loop', True)
+        changes = presets.restore('A')
+        self.assertEqual(changes['device'][kekse.presets.GUI_KEY], {'Exposure, ms': 10.0, 'Loop': False})
+        self.assertEqual(device.gui.get_values(), {'Exposure, ms': 10.0, 'Loop': False})
+        self.assertTrue(device.config['loop'])  # the checkbox function was not called again
+        self.assertEqual(device.updates, 1)
+        self.assertEqual(presets.diff('A'), {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,52 @@
+import unittest
+import json
+import os
+import tempfile
+import threading
+from kekse.profiler import Profiler
+
+
+class TestProfiler(unittest.TestCase):
+    def test_spans_and_trace(self):
+        """
+        Spans from several threads are recorded and exported as Chrome trace events.
+        """
+        prof = Profiler(capacity=100)
+        prof.enable()
+
+        @prof.timed('dev.func')
+        def func():
+            with prof.span('dev.inner'):
+                pass
+        threads = [threading.Thread(target=func) for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        stats = prof.summary()
+        self.assertEqual(stats['dev.func']['count'], 4)
+        self.assertEqual(stats['dev.inner']['count'], 4)
+        filepath = os.path.join(tempfile.mkdtemp(), 'trace.json')
+        prof.export_chrome_trace(filepath)
+        with open(filepath) as f:
+            events = [e for e in json.load(f)['traceEvents'] if e['ph'] == 'X']
+        self.assertEqual(len(events), 8)
+
+    def test_ring_buffer(self):
+        """
+        When the capacity is exceeded, only the latest spans are kept. Disabled profiler records nothing.
+        """
+        prof = Profiler(capacity=10)
+        with prof.span('ignored'):
+            pass
+        self.assertEqual(prof.spans().size, 0)
+        prof.enable()
+        for i in range(25):
+            prof.record('dev.step', i, i + 1)
+        spans = prof.spans()
+        self.assertEqual(spans.size, 10)
+        self.assertEqual(spans['start_ns'][0], 15)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,6 +2,8 @@ import unittest
 import kekse
 import numpy as np
 import sys
+import threading
+import time
 from PyQt5.QtWidgets import (QGroupBox, QLineEdit, QPushButton, QTabWidget, QCheckBox, QComboBox,
                              QVBoxLayout, QWidget, QDoubleSpinBox, QFormLayout, QApplication)
 
@@ -30,5 +32,37 @@ class TestInputFields(unittest.TestCase):
         app.exec_()
 
 
+class TestThreading(unittest.TestCase):
+    def setUp(self):
+        self.app = QApplication.instance() or QApplication(sys.argv)
+        self.gui = kekse.ProtoKeks("Threaded Keks", workers=1)
+        self.gui.add_groupbox('Group')
+
+    def test_update_param_from_thread(self):
+        """
+        update_param() called from a worker thread is applied in the GUI thread.
+        """
+        self.gui.add_numeric_field('Value', 'Group', value=0, vrange=[0, 100, 1])
+        thread = threading.Thread(target=self.gui.update_param, args=('Value', 42))
+        thread.start()
+        thread.join()
+        self.assertEqual(self.gui.get_param('Value').value(), 0)
+        self.app.processEvents()
+        self.assertEqual(self.gui.get_param('Value').value(), 42)
+
+    def test_callback_in_worker(self):
+        """
+        Widget callbacks are executed outside of the GUI thread if workers are set.
+        """
+        threads = []
+        self.gui.add_button('Button', 'Group', func=lambda: threads.append(threading.get_ident()))
+        self.gui.get_param('Button').click()
+        t_end = time.time() + 1.0
+        while len(threads) == 0 and time.time() < t_end:
+            time.sleep(0.01)
+        self.assertEqual(len(threads), 1)
+        self.assertNotEqual(threads[0], threading.get_ident())
+
+
 if __name__ == '__main__':
     unittest.main()
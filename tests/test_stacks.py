@@ -0,0 +1,72 @@
+import unittest
+import os
+import tempfile
+import numpy as np
+import kekse.stacks
+
+
+class TestFrameReducer(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.frames = rng.integers(0, 4000, size=(20, 64, 48), dtype=np.uint16)
+
+    def test_crop_bin_projections(self):
+        """
+        Reduced stack and projections, computed by worker threads, are equal to the ones computed after acquisition.
+        """
+        reducer = kekse.stacks.FrameReducer((64, 48), 20, crop=(2, 62, 4, 46), binning=4,
+                                            projections=('max', 'mean'), preview_factor=2, workers=3)
+        reducer.submit_frames(self.frames)
+        result = reducer.finish()
+        reducer.close()
+        cropped = self.frames[:, 2:62, 4:44].astype(np.uint32)  # right edge cropped to a multiple of binning
+        expected = (cropped.reshape(20, 15, 4, 10, 4).sum(axis=(2, 4)) // 16).astype(np.uint16)
+        self.assertEqual(reducer.out_shape, (15, 10))
+        np.testing.assert_array_equal(result['stack'], expected)
+        np.testing.assert_array_equal(result['max'], expected.max(axis=0))
+        np.testing.assert_allclose(result['mean'], expected.mean(axis=0))
+        self.assertEqual(result['preview'].shape, (8, 5))
+        self.assertEqual(reducer.n_reduced, 20)
+
+
+class TestStackWriter(unittest.TestCase):
+    def test_lossless_round_trip(self):
+        """
+        Frames compressed by worker processes are written in order, and decoded without loss, for each codec.
+        """
+        y, x = np.mgrid[:32, :40]
+        frames = np.array([(1000 + 20 * np.sin((x + i) / 5.) * y) for i in range(11)]).astype(np.uint16)
+        frames[3, 5, 7] = 65535  # wrap-around of the delta encoding
+        for codec, workers in (('raw', 0), ('zlib', 2), ('lzma', 0)):
+            filepath = os.path.join(tempfile.mkdtemp(), 'stack')
+            with kekse.stacks.StackWriter(filepath, (32, 40), codec=codec, chunk_frames=4, workers=workers) as writer:
+                writer.write_frames(frames)
+            self.assertEqual([c['n_frames'] for c in writer.chunks], [4, 4, 3])
+            np.testing.assert_array_equal(kekse.stacks.read_stack(filepath), frames)
+            if codec != 'raw':
+                self.assertGreater(writer.stats()['ratio'], 1.5)
+
+
+class TestStackReader(unittest.TestCase):
+    def test_lazy_tzyx(self):
+        """
+        Raw and compressed time points read as one (t, z, y, x) array, raw frames are memory-mapped views.
+        """
+        rng = np.random.default_rng(1)
+        data = rng.integers(0, 1000, size=(2, 10, 16, 12), dtype=np.uint16)
+        folder = tempfile.mkdtemp()
+        filepaths = [os.path.join(folder, f'stack_t{t}') for t in range(2)]
+        for t, codec in enumerate(('raw', 'zlib')):
+            with kekse.stacks.StackWriter(filepaths[t], (16, 12), codec=codec, chunk_frames=3, workers=0) as writer:
+                writer.write_frames(data[t])
+        reader = kekse.stacks.StackReader(filepaths, cache_chunks=2)
+        self.assertEqual(reader.shape, data.shape)
+        np.testing.assert_array_equal(reader[:], data)
+        np.testing.assert_array_equal(reader[1, 4], data[1, 4])
+        np.testing.assert_array_equal(reader[:, -1, 2:5, ::2], data[:, -1, 2:5, ::2])
+        np.testing.assert_array_equal(reader[1, 2:8, 3], data[1, 2:8, 3])
+        self.assertIsInstance(reader.frame(0, 3), np.memmap)
+
+
+if __name__ == '__main__':
+    unittest.main()
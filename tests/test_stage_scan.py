@@ -0,0 +1,42 @@
+import os
+import unittest
+import numpy as np
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+from tests.bench_devices import install_fakes
+
+
+class TestScanTrajectory(unittest.TestCase):
+    def setUp(self):
+        install_fakes()
+        from devices import stage_ASI_MS2000
+        self.scan_trajectory = stage_ASI_MS2000.scan_trajectory
+        self.args = dict(scan_limits_xx_yy=[0.0, 0.1, 0.0, 0.02], n_lines=3, speed_x=0.5, speed_y=1.0,
+                         interval_mm=0.002, acceleration_ms=50)
+
+    def test_even_spacing_with_runup(self):
+        """
+        With run-up >= min_runup_mm, all triggers are at full speed, evenly spaced in position and time.
+        """
+        min_runup = self.scan_trajectory(**self.args)['min_runup_mm']
+        traj = self.scan_trajectory(runup_mm=min_runup, **self.args)
+        self.assertFalse(np.any(traj['trigger_in_accel']))
+        for line in range(3):
+            on_line = traj['trigger_line'] == line
+            self.assertEqual(np.count_nonzero(on_line), 51)
+            np.testing.assert_allclose(np.abs(np.diff(traj['trigger_x_mm'][on_line])), 0.002)
+            np.testing.assert_allclose(np.diff(traj['trigger_t_s'][on_line]), traj['trigger_period_s'], rtol=1e-6)
+        self.assertTrue(np.all(np.diff(traj['trigger_t_s']) > 0))
+
+    def test_triggers_in_accel_without_runup(self):
+        """
+        Without run-up, the first and last triggers of each line are flagged, their spacing in time is uneven.
+        """
+        traj = self.scan_trajectory(runup_mm=0.0, **self.args)
+        first_line = traj['trigger_in_accel'][traj['trigger_line'] == 0]
+        self.assertTrue(first_line[0] and first_line[-1])
+        dt = np.diff(traj['trigger_t_s'][traj['trigger_line'] == 0])
+        self.assertGreater(dt[0], traj['trigger_period_s'] * 1.01)
+
+
+if __name__ == '__main__':
+    unittest.main()
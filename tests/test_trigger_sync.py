@@ -0,0 +1,47 @@
+import os
+import types
+import unittest
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+from tests.bench_devices import install_fakes
+
+
+class TestTiming(unittest.TestCase):
+    def setUp(self):
+        install_fakes()
+        from devices import trigger_sync
+        self.sync = trigger_sync.TriggerSync(gui_on=False)
+        self.camera = types.SimpleNamespace(frame_readout_ms=10.0, config={'trig_out_kind': 'EXPOSURE'})
+        self.sync.add_device('camera', self.camera)
+        self.sync.add_device('lightsheet', types.SimpleNamespace(config={'DAQ_sample_rate_Hz': 20000}))
+
+    def test_dead_time(self):
+        """
+        Laser is on only within the global exposure, dead time is the rest of the frame period.
+        """
+        timing = self.sync.compute_timing(50.0)
+        sample, margin = 0.05, self.sync.config['margin_ms']
+        self.assertAlmostEqual(timing['period_ms'], 20.0)
+        self.assertAlmostEqual(timing['exposure_ms'], 20.0 - self.sync.config['exposure_overhead_ms'])
+        self.assertAlmostEqual(timing['dead_time_ms'], timing['period_ms'] - timing['laser_on_ms'])
+        laser_start = timing['readout_ms'] + timing['laser_delay_ms']
+        self.assertGreaterEqual(laser_start, timing['readout_ms'] + margin)
+        self.assertLessEqual(laser_start + sample + timing['laser_on_ms'], timing['exposure_ms'] - margin + 1e-9)
+        rearm = self.sync.config['daq_rearm_samples'] * sample
+        self.assertLessEqual(timing['readout_ms'] + timing['swipe_duration_ms'] + rearm, timing['period_ms'])
+        self.assertAlmostEqual(timing['swipe_duration_ms'] / sample, round(timing['swipe_duration_ms'] / sample))
+
+    def test_limits(self):
+        """
+        Frame rates above max_frame_rate() and frame-start triggers are rejected.
+        """
+        fps_max = self.sync.max_frame_rate()
+        self.sync.compute_timing(fps_max)
+        with self.assertRaises(ValueError):
+            self.sync.compute_timing(fps_max + 1.0)
+        self.camera.config['trig_out_kind'] = 'PROGRAMMABLE'
+        with self.assertRaises(ValueError):
+            self.sync.compute_timing(10.0)
+
+
+if __name__ == '__main__':
+    unittest.main()